@@ -13,5 +13,11 @@ setup(
     install_requires=[
         "pywin32",
         "jupyterhub",
+        "prometheus_client",
     ],
+    entry_points={
+        "console_scripts": [
+            "winlocalprocessspawner-launcher = winlocalprocessspawner.launcher:main",
+        ],
+    },
 )
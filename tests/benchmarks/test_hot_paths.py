@@ -0,0 +1,171 @@
+"""Micro-benchmarks of the pure-Python hot paths of a launch, against a simulated Win32 layer.
+
+They run once, as plain tests, with the rest of the suite. To measure them, and to compare them
+with a baseline saved from an earlier run on the same machine:
+
+    pytest tests/benchmarks --benchmark-enable --benchmark-only --benchmark-save=baseline
+    pytest tests/benchmarks --benchmark-enable --benchmark-only --benchmark-compare \
+        --benchmark-compare-fail=min:25%
+"""
+
+from subprocess import list2cmdline
+
+import pytest
+import winlocalprocessspawner.win_utils as win_utils
+import winlocalprocessspawner.winlocalprocessspawner as wps
+from jupyterhub.objects import Hub
+
+PROFILE_KEYS = 100
+
+
+class User:
+    """JupyterHub user stub."""
+
+    name = "alice"
+    url = "/user/alice/"
+
+
+class Win32Handle:
+    """pywin32 PyHANDLE stub."""
+
+    def __init__(self, value):
+        """Initializes a Win32Handle wrapping the given value."""
+        self.value = value
+
+    def Detach(self):  # noqa: N802
+        return self.value
+
+    def Close(self):  # noqa: N802
+        pass
+
+
+class StartupInfo:
+    """win32process.STARTUPINFO stub."""
+
+    dwFlags = 0
+
+
+@pytest.fixture
+def spawner():
+    """A spawner of a user with a realistic configuration."""
+    return wps.WinLocalProcessSpawner(
+        user=User(),
+        hub=Hub(),
+        api_token="0123456789abcdef",
+        oauth_client_id="jupyterhub-user-alice",
+        cmd=["C:\\Program Files\\Python38\\Scripts\\jupyterhub-singleuser.exe"],
+        args=["--SingleUserNotebookApp.default_url=/lab", "--debug"],
+        environment={"JUPYTER_ENV_{}".format(i): "value {}".format(i) for i in range(10)},
+    )
+
+
+@pytest.fixture
+def profile_env():
+    """An environment block of a user profile, as returned by CreateEnvironmentBlock."""
+    env = {"PROFILE_VAR_{}".format(i): "C:\\Users\\alice\\dir{}".format(i) for i in range(90)}
+    env.update(
+        APPDATA="C:\\Users\\alice\\AppData\\Roaming",
+        LOCALAPPDATA="C:\\Users\\alice\\AppData\\Local",
+        USERPROFILE="C:\\Users\\alice",
+        PUBLIC="C:\\Users\\Public",
+        TEMP="C:\\Users\\alice\\AppData\\Local\\Temp",
+        TMP="C:\\Users\\alice\\AppData\\Local\\Temp",
+        PATH=";".join("C:\\Tools\\bin{}".format(i) for i in range(30)),
+        SYSTEMROOT="C:\\Windows",
+        USERNAME="alice",
+        HOMEDRIVE="C:",
+    )
+    assert len(env) == PROFILE_KEYS
+    return env
+
+
+@pytest.fixture
+def win32(monkeypatch):
+    """Simulate the Win32 calls of PopenAsUser.do_execute_child."""
+    monkeypatch.setattr(win_utils.win32process, "STARTUPINFO", StartupInfo)
+    monkeypatch.setattr(
+        win_utils.win32process,
+        "CreateProcessAsUser",
+        lambda *args: (Win32Handle(1), Win32Handle(2), 4242, 4243),
+    )
+    monkeypatch.setattr(win_utils.win32api, "CloseHandle", lambda handle: None)
+    monkeypatch.setattr(win_utils.win32event, "WaitForSingleObject", lambda handle, ms: 0)
+    monkeypatch.setattr(win_utils.win32process, "GetExitCodeProcess", lambda handle: 259)
+    monkeypatch.setattr(win_utils.win32con, "STILL_ACTIVE", 259, raising=False)
+
+
+def test_get_env(benchmark, spawner):
+    """Build the environment of a server."""
+    env = benchmark(spawner.get_env)
+
+    assert env["JUPYTERHUB_USER"] == "alice"
+
+
+def test_user_env(benchmark, spawner):
+    """Add the user specific variables to an environment."""
+    env = benchmark(spawner.user_env, {})
+
+    assert env["USER"] == "alice"
+
+
+def test_apply_user_env_overrides(benchmark, spawner, profile_env):
+    """Merge a 100 variable profile environment block."""
+    base_env = spawner.get_env()
+
+    def apply():
+        env = dict(base_env)
+        spawner._apply_user_env_overrides(env, profile_env, token=object())
+        return env
+
+    env = benchmark(apply)
+
+    assert env["APPDATA"] == profile_env["APPDATA"]
+
+
+def test_command_line_assembly(benchmark, spawner):
+    """Build the command line of a server run through a shell."""
+    spawner.shell_cmd = ["cmd.exe", "/c"]
+
+    def assemble():
+        return list2cmdline(spawner._get_cmd())
+
+    cmdline = benchmark(assemble)
+
+    assert "--debug" in cmdline
+
+
+def test_do_execute_child(benchmark, win32, profile_env):
+    """Prepare the arguments of CreateProcessAsUser and record the new process."""
+    popen = win_utils.PopenAsUser.__new__(win_utils.PopenAsUser)
+    popen._token = Win32Handle(3)
+    popen._job = None
+    args = [
+        "C:\\Program Files\\Python38\\Scripts\\jupyterhub-singleuser.exe",
+        "--SingleUserNotebookApp.default_url=/lab",
+        "--port=54321",
+        '--notebook-dir="C:\\Users\\alice\\My Notebooks"',
+    ]
+
+    def execute():
+        popen.do_execute_child(
+            args,
+            None,
+            None,
+            False,
+            (),
+            "C:\\Users\\alice",
+            profile_env,
+            None,
+            0,
+            False,
+            -1,
+            -1,
+            -1,
+            -1,
+            -1,
+            -1,
+        )
+
+    benchmark(execute)
+
+    assert popen.pid == 4242
@@ -0,0 +1,91 @@
+"""Unit tests for authstate."""
+
+import asyncio
+
+from winlocalprocessspawner.authstate import AuthStateCache
+
+
+class DummyUser:
+    """User stub counting auth_state decryptions."""
+
+    def __init__(self, name, auth_state, encrypted=b"encrypted"):
+        """Initializes a DummyUser with the given auth_state and its encrypted form."""
+        self.name = name
+        self.auth_state = auth_state
+        self.encrypted_auth_state = encrypted
+        self.decrypted = 0
+
+    async def get_auth_state(self):
+        self.decrypted += 1
+        return self.auth_state
+
+
+class TestAuthStateCache:
+    """Unit tests for AuthStateCache."""
+
+    def test_repeated_lookups_decrypt_once(self):
+        cache = AuthStateCache()
+        user = DummyUser("alice", {"auth_token": 123})
+
+        for _ in range(3):
+            assert asyncio.run(cache.get(user)) == {"auth_token": 123}
+
+        assert user.decrypted == 1
+
+    def test_only_needed_fields_are_cached(self):
+        cache = AuthStateCache()
+        user = DummyUser("alice", {"auth_token": 123, "password": "secret"})
+
+        assert asyncio.run(cache.get(user)) == {"auth_token": 123}
+
+    def test_new_encrypted_auth_state_invalidates_entry(self):
+        cache = AuthStateCache()
+        user = DummyUser("alice", {"auth_token": 123})
+        asyncio.run(cache.get(user))
+
+        user.auth_state = {"auth_token": 456}
+        user.encrypted_auth_state = b"refreshed"
+
+        assert asyncio.run(cache.get(user)) == {"auth_token": 456}
+        assert user.decrypted == 2
+
+    def test_cleared_auth_state_is_not_served_from_cache(self):
+        cache = AuthStateCache()
+        user = DummyUser("alice", {"auth_token": 123})
+        asyncio.run(cache.get(user))
+
+        user.auth_state = None
+        user.encrypted_auth_state = None
+
+        assert asyncio.run(cache.get(user)) is None
+
+    def test_invalidate_forgets_user(self):
+        cache = AuthStateCache()
+        user = DummyUser("alice", {"auth_token": 123})
+        asyncio.run(cache.get(user))
+
+        cache.invalidate("alice")
+        asyncio.run(cache.get(user))
+
+        assert user.decrypted == 2
+
+    def test_least_recently_used_user_is_evicted(self):
+        cache = AuthStateCache(maxsize=2)
+        alice, bob, carol = (DummyUser(name, {"auth_token": 1}) for name in ["a", "b", "c"])
+        for user in (alice, bob, alice, carol):
+            asyncio.run(cache.get(user))
+
+        asyncio.run(cache.get(alice))
+        asyncio.run(cache.get(bob))
+
+        assert alice.decrypted == 1
+        assert bob.decrypted == 2
+
+    def test_maxsize_zero_disables_cache(self):
+        cache = AuthStateCache(maxsize=0)
+        user = DummyUser("alice", {"auth_token": 123})
+
+        asyncio.run(cache.get(user))
+        asyncio.run(cache.get(user))
+
+        assert user.decrypted == 2
@@ -0,0 +1,75 @@
+"""Unit tests for bytecode."""
+
+import os
+import sys
+
+import pytest
+import winlocalprocessspawner.bytecode as bytecode
+
+from .test_hostpressure import FakeClock
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    """A directory of modules, as the only import directory of the environment."""
+    modules = tmp_path / "site-packages"
+    modules.mkdir()
+    (modules / "package_module.py").write_text("VALUE = 1\n")
+    secured = []
+    monkeypatch.setattr(bytecode, "environment", lambda python: ("3.8.10", [str(modules)]))
+    monkeypatch.setattr(bytecode, "read_only_for_users", secured.append)
+    return modules, secured
+
+
+class TestUnitBytecode:
+    """Unit tests for bytecode."""
+
+    def test_environment_lists_existing_import_directories(self):
+        version, paths = bytecode.environment(sys.executable)
+
+        assert version == sys.version
+        assert paths
+        assert all(os.path.isdir(path) for path in paths)
+
+    def test_fingerprint_changes_when_a_directory_changes(self, tmp_path):
+        before = bytecode.fingerprint("3.8.10", [str(tmp_path)])
+        os.utime(str(tmp_path), ns=(0, 0))
+
+        assert bytecode.fingerprint("3.8.10", [str(tmp_path)]) != before
+        assert bytecode.fingerprint("3.8.11", [str(tmp_path)]) != before
+
+    def test_refresh_compiles_into_a_new_read_only_cache(self, tmp_path, environment):
+        modules, secured = environment
+        cache_dir = str(tmp_path / "cache")
+
+        assert bytecode.BytecodeCache().refresh(cache_dir, sys.executable)
+
+        assert secured == [cache_dir]
+        compiled = [name for _, _, files in os.walk(cache_dir) for name in files]
+        assert any(name.startswith("package_module.") for name in compiled)
+        assert bytecode.FINGERPRINT_FILE in compiled
+
+    def test_refresh_recompiles_only_when_the_environment_changes(self, tmp_path, environment):
+        modules, _ = environment
+        cache_dir = str(tmp_path / "cache")
+        cache = bytecode.BytecodeCache()
+        cache.refresh(cache_dir, sys.executable)
+
+        assert not cache.refresh(cache_dir, sys.executable)
+        (modules / "new_module.py").write_text("VALUE = 2\n")
+        os.utime(str(modules), ns=(0, 0))
+        assert cache.refresh(cache_dir, sys.executable)
+
+    def test_due_once_per_check_interval(self, tmp_path, environment):
+        clock = FakeClock()
+        cache = bytecode.BytecodeCache(check_interval=300, clock=clock)
+        cache_dir = str(tmp_path / "cache")
+
+        assert cache.due(cache_dir, sys.executable)
+        # being checked
+        assert not cache.due(cache_dir, sys.executable)
+        cache.refresh(cache_dir, sys.executable)
+        clock.now = 299
+        assert not cache.due(cache_dir, sys.executable)
+        clock.now = 300
+        assert cache.due(cache_dir, sys.executable)
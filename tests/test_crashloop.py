@@ -0,0 +1,59 @@
+"""Unit tests for crashloop."""
+
+from winlocalprocessspawner.crashloop import CrashLoopTracker
+
+
+class FakeClock:
+    """Monotonic clock stub that only moves when told to."""
+
+    def __init__(self):
+        """Initializes FakeClock at time 0."""
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCrashLoopTracker:
+    """Unit tests for CrashLoopTracker."""
+
+    def test_no_backoff_without_early_exits(self):
+        tracker = CrashLoopTracker(clock=FakeClock())
+
+        assert tracker.retry_after(("alice", ""), 10, 600) == 0
+        assert tracker.early_exits(("alice", "")) == 0
+
+    def test_backoff_doubles_with_each_early_exit_up_to_max_delay(self):
+        clock = FakeClock()
+        tracker = CrashLoopTracker(clock=clock)
+        key = ("alice", "")
+
+        delays = []
+        for _ in range(5):
+            tracker.record_early_exit(key)
+            delays.append(tracker.retry_after(key, 10, 60))
+
+        assert delays == [10, 20, 40, 60, 60]
+        assert tracker.early_exits(key) == 5
+
+    def test_backoff_decreases_as_time_passes(self):
+        clock = FakeClock()
+        tracker = CrashLoopTracker(clock=clock)
+        key = ("alice", "")
+        tracker.record_early_exit(key)
+
+        clock.now = 4.0
+        assert tracker.retry_after(key, 10, 600) == 6.0
+        clock.now = 20.0
+        assert tracker.retry_after(key, 10, 600) == 0
+
+    def test_reset_forgets_early_exits_of_that_server_only(self):
+        tracker = CrashLoopTracker(clock=FakeClock())
+        tracker.record_early_exit(("alice", ""))
+        tracker.record_early_exit(("alice", "gpu"))
+
+        tracker.reset(("alice", ""))
+
+        assert tracker.early_exits(("alice", "")) == 0
+        assert tracker.early_exits(("alice", "gpu")) == 1
+        assert len(tracker) == 1
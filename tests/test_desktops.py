@@ -0,0 +1,145 @@
+"""Unit tests for desktops."""
+
+import threading
+import time
+
+import pytest
+import winlocalprocessspawner.desktops as desktops
+
+
+class FakeUser32:
+    """Stubs the window station and desktop functions of user32."""
+
+    def __init__(self):
+        """Initializes FakeUser32 with the Hub's window station only."""
+        self.next_handle = 100
+        self.process_window_station = 1
+        self.window_stations = {}
+        self.desktops = {}
+        self.fail_desktops = False
+        self.races = 0
+
+    def _handle(self):
+        self.next_handle += 1
+        return self.next_handle
+
+    def CreateWindowStationW(self, name, flags, access, security):  # noqa: N802
+        handle = self._handle()
+        self.window_stations[handle] = name
+        return handle
+
+    def GetProcessWindowStation(self):  # noqa: N802
+        return self.process_window_station
+
+    def SetProcessWindowStation(self, handle):  # noqa: N802
+        self.process_window_station = handle
+        return True
+
+    def CreateDesktopExW(
+        self, name, device, mode, flags, access, sa, heap_size, param
+    ):  # noqa: N802
+        if self.fail_desktops:
+            return None
+        window_station = self.process_window_station
+        # let other threads change the window station of the process meanwhile, if they can
+        time.sleep(0.01)
+        handle = self._handle()
+        self.desktops[handle] = (self.window_stations[window_station], name, heap_size)
+        if self.process_window_station != window_station:
+            self.races += 1
+        return handle
+
+    def CloseDesktop(self, handle):  # noqa: N802
+        del self.desktops[handle]
+        return True
+
+    def CloseWindowStation(self, handle):  # noqa: N802
+        del self.window_stations[handle]
+        return True
+
+
+@pytest.fixture
+def user32(monkeypatch):
+    """Returns FakeUser32 installed in the desktops module."""
+    fake = FakeUser32()
+    monkeypatch.setattr(desktops, "_user32", fake)
+    monkeypatch.setattr(desktops, "_set_access", lambda handle, user, owner: None)
+    monkeypatch.setattr(desktops.ctypes, "get_last_error", lambda: 8, raising=False)
+    monkeypatch.setattr(desktops.ctypes, "WinError", lambda code: OSError(code), raising=False)
+    return fake
+
+
+class TestUnitDesktopPool:
+    """Unit tests for DesktopPool."""
+
+    def test_desktops_are_created_in_a_dedicated_window_station(self, user32):
+        pool = desktops.DesktopPool(heap_size=2048, max_servers=2)
+
+        names = [pool.acquire(server) for server in ("a", "b", "c")]
+
+        (window_station,) = user32.window_stations.values()
+        assert names == [
+            window_station + "\\jupyterhub-1",
+            window_station + "\\jupyterhub-1",
+            window_station + "\\jupyterhub-2",
+        ]
+        assert sorted(user32.desktops.values()) == [
+            (window_station, "jupyterhub-1", 2048),
+            (window_station, "jupyterhub-2", 2048),
+        ]
+        # the Hub is back in its own window station
+        assert user32.process_window_station == 1
+
+    def test_server_keeps_its_desktop(self, user32):
+        pool = desktops.DesktopPool(max_servers=1)
+
+        assert pool.acquire("a") == pool.acquire("a")
+        assert len(pool) == 1
+
+    def test_desktops_and_window_station_are_closed_once_unused(self, user32):
+        pool = desktops.DesktopPool(max_servers=2)
+        for server in ("a", "b", "c"):
+            pool.acquire(server)
+
+        pool.release("c")
+        assert len(user32.desktops) == 1
+        pool.release("a")
+        assert len(user32.desktops) == 1
+        pool.release("b")
+        pool.release("b")
+
+        assert user32.desktops == {}
+        assert user32.window_stations == {}
+        assert len(pool) == 0
+
+    def test_freed_slot_is_reused(self, user32):
+        pool = desktops.DesktopPool(max_servers=2)
+        first = pool.acquire("a")
+        pool.acquire("b")
+        pool.release("a")
+
+        assert pool.acquire("c") == first
+        assert len(pool) == 1
+
+    def test_pools_do_not_change_the_window_station_concurrently(self, user32):
+        pools = [desktops.DesktopPool(), desktops.DesktopPool()]
+        threads = [threading.Thread(target=pool.acquire, args=("a",)) for pool in pools]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(user32.desktops) == 2
+        assert user32.races == 0
+        assert user32.process_window_station == 1
+
+    def test_failed_desktop_creation_closes_the_window_station(self, user32):
+        user32.fail_desktops = True
+        pool = desktops.DesktopPool()
+
+        with pytest.raises(OSError):
+            pool.acquire("a")
+
+        assert user32.window_stations == {}
+        assert user32.process_window_station == 1
@@ -0,0 +1,73 @@
+"""Unit tests for hostpressure."""
+
+import pytest
+import winlocalprocessspawner.hostpressure as hostpressure
+from winlocalprocessspawner.hostpressure import HostPressure
+
+GIB = 2**30
+
+
+class FakeClock:
+    """Clock stub, advanced by the test."""
+
+    def __init__(self):
+        """Initializes FakeClock at time 0."""
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestUnitHostPressure:
+    """Unit tests for hostpressure."""
+
+    def _install(self, monkeypatch, system_times):
+        system_times = iter(system_times)
+        monkeypatch.setattr(hostpressure, "memory_status", lambda: (2 * GIB, 6 * GIB, 8 * GIB))
+        monkeypatch.setattr(hostpressure, "system_times", lambda: next(system_times))
+
+    def test_cpu_percent_is_measured_between_two_samples(self, monkeypatch):
+        self._install(monkeypatch, [(100, 200), (175, 300)])
+        clock = FakeClock()
+        sampler = hostpressure.HostPressureSampler(max_age=1, clock=clock)
+
+        first = sampler.sample()
+        clock.now = 1
+        second = sampler.sample()
+
+        assert first == HostPressure(2 * GIB, 6 * GIB, 8 * GIB, None)
+        assert second.cpu_percent == pytest.approx(25)
+
+    def test_recent_sample_is_reused(self, monkeypatch):
+        self._install(monkeypatch, [(100, 200)])
+        clock = FakeClock()
+        sampler = hostpressure.HostPressureSampler(max_age=1, clock=clock)
+
+        first = sampler.sample()
+        clock.now = 0.5
+
+        assert sampler.sample() is first
+
+    @pytest.mark.parametrize(
+        "thresholds, reasons",
+        [
+            ({}, []),
+            ({"min_available_memory": 4 * GIB}, ["available memory"]),
+            ({"max_commit_percent": 70}, ["commit charge"]),
+            ({"max_commit_percent": 80}, []),
+            ({"max_cpu_percent": 50}, ["CPU load"]),
+            (
+                {"min_available_memory": 4 * GIB, "max_cpu_percent": 50},
+                ["available memory", "CPU load"],
+            ),
+        ],
+    )
+    def test_exceeded_returns_crossed_thresholds(self, thresholds, reasons):
+        pressure = HostPressure(2 * GIB, 6 * GIB, 8 * GIB, 60)
+
+        assert hostpressure.exceeded(pressure, **thresholds) == reasons
+
+    def test_unknown_cpu_usage_does_not_cross_cpu_threshold(self):
+        pressure = HostPressure(2 * GIB, 6 * GIB, 8 * GIB, None)
+
+        assert hostpressure.exceeded(pressure, max_cpu_percent=50) == []
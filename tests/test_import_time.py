@@ -0,0 +1,94 @@
+"""Import-time budgets of the public entry points of the package, measured with -X importtime."""
+
+import subprocess
+import sys
+
+import pytest
+
+# statement -> (budget in seconds, modules it must not import)
+# The budgets are about 3 times the import times measured when they were set: 0.3 ms, 10 ms,
+# 80 ms and 0.75 s. Lower them when an import gets faster.
+ENTRY_POINTS = {
+    "import winlocalprocessspawner": (
+        0.002,
+        {"jupyterhub", "winlocalprocessspawner.winlocalprocessspawner"},
+    ),
+    "import winlocalprocessspawner.token_utils": (
+        0.03,
+        {
+            "jupyterhub",
+            "prometheus_client",
+            "win32profile",
+            "winlocalprocessspawner.winlocalprocessspawner",
+        },
+    ),
+    "import winlocalprocessspawner.launcher": (
+        0.25,
+        {"jupyterhub", "winlocalprocessspawner.winlocalprocessspawner"},
+    ),
+    "from winlocalprocessspawner import WinLocalProcessSpawner": (2.5, set()),
+}
+
+
+def import_times(statement):
+    """Run statement in a new interpreter with -X importtime.
+
+    Returns the (module, cumulative import time in seconds, nesting depth) of each import.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        try:
+            seconds = int(cumulative) / 10**6
+        except ValueError:
+            # the header line
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), seconds, depth))
+    return imports
+
+
+def import_cost(statement):
+    """Returns the modules imported by statement, and the time taken to import them in seconds.
+
+    Modules imported at interpreter startup are not counted.
+    """
+    startup = {name for name, _, _ in import_times("pass")}
+    imports = [entry for entry in import_times(statement) if entry[0] not in startup]
+    total = sum(seconds for _, seconds, depth in imports if depth == 0)
+    return {name for name, _, _ in imports}, total
+
+
+@pytest.mark.parametrize("statement", ENTRY_POINTS)
+def test_import_stays_within_budget(statement):
+    budget, forbidden = ENTRY_POINTS[statement]
+    # the first run may have to compile the modules
+    import_times(statement)
+
+    modules, total = import_cost(statement)
+
+    assert not forbidden & modules, "imported by {!r}".format(statement)
+    assert total <= budget, "{!r} took {:.3f} seconds".format(statement, total)
+
+
+def test_lazy_attribute_is_the_spawner_class():
+    import winlocalprocessspawner
+    from winlocalprocessspawner.winlocalprocessspawner import WinLocalProcessSpawner
+
+    assert winlocalprocessspawner.WinLocalProcessSpawner is WinLocalProcessSpawner
+    assert "WinLocalProcessSpawner" in dir(winlocalprocessspawner)
+
+
+def test_unknown_attribute_raises_attribute_error():
+    import winlocalprocessspawner
+
+    with pytest.raises(AttributeError):
+        winlocalprocessspawner.NoSuchSpawner
@@ -0,0 +1,192 @@
+"""Unit tests for job_utils."""
+
+import pywintypes
+import winlocalprocessspawner.job_utils as job_utils
+
+
+class DummyProcessHandles:
+    """Stubs OpenProcess and the memory APIs for a fixed set of processes."""
+
+    def __init__(self, working_sets, trimmed_working_sets=None):
+        """Initializes the stub with a {pid: working set size} mapping."""
+        self.working_sets = dict(working_sets)
+        self.trimmed_working_sets = trimmed_working_sets or {}
+        self.closed = []
+        self.trimmed = []
+
+    def open_process(self, access, inherit, pid):
+        if pid not in self.working_sets:
+            raise pywintypes.error(87, "OpenProcess", "The parameter is incorrect.")
+        return pid
+
+    def close_handle(self, handle):
+        self.closed.append(handle)
+
+    def get_process_memory_info(self, handle):
+        return {"WorkingSetSize": self.working_sets[handle]}
+
+    def set_process_working_set_size(self, handle, minimum, maximum):
+        self.trimmed.append((handle, minimum, maximum))
+        self.working_sets[handle] = self.trimmed_working_sets.get(handle, 0)
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(job_utils.win32api, "OpenProcess", self.open_process)
+        monkeypatch.setattr(job_utils.win32api, "CloseHandle", self.close_handle)
+        monkeypatch.setattr(
+            job_utils.win32process, "GetProcessMemoryInfo", self.get_process_memory_info
+        )
+        monkeypatch.setattr(
+            job_utils.win32process, "SetProcessWorkingSetSize", self.set_process_working_set_size
+        )
+
+
+class DummyNtdll:
+    """Records NtSuspendProcess and NtResumeProcess calls."""
+
+    def __init__(self):
+        """Initializes DummyNtdll with no recorded calls."""
+        self.suspended = []
+        self.resumed = []
+
+    def NtSuspendProcess(self, handle):  # noqa: N802
+        self.suspended.append(handle)
+        return 0
+
+    def NtResumeProcess(self, handle):  # noqa: N802
+        self.resumed.append(handle)
+        return 0
+
+
+class TestUnitJobUtils:
+    """Unit tests for job_utils."""
+
+    def test_job_name_is_session_local(self):
+        assert job_utils.job_name("abc") == "Local\\jupyterhub-winlocalprocessspawner-abc"
+
+    def test_pin_job_duplicates_a_synchronize_handle_into_the_process(self, monkeypatch):
+        duplicated = []
+
+        def duplicate_handle(source_process, handle, target_process, access, inherit, options):
+            duplicated.append((source_process, handle, target_process, access, inherit))
+            return pywintypes.HANDLE(99)
+
+        monkeypatch.setattr(job_utils.win32api, "GetCurrentProcess", lambda: -1)
+        monkeypatch.setattr(job_utils.win32api, "DuplicateHandle", duplicate_handle)
+        monkeypatch.setattr(job_utils.win32con, "SYNCHRONIZE", 0x100000, raising=False)
+
+        job_utils.pin_job(1111, 2222)
+
+        assert duplicated == [(-1, 1111, 2222, 0x100000, False)]
+
+    def test_get_job_pids_returns_list_of_process_ids(self, monkeypatch):
+        monkeypatch.setattr(
+            job_utils.win32job, "QueryInformationJobObject", lambda job, info_class: (10, 20)
+        )
+
+        assert job_utils.get_job_pids(1111) == [10, 20]
+
+    def test_get_working_set_size_sums_processes_and_skips_exited_ones(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+
+        assert job_utils.get_working_set_size([10, 20, 30]) == 3000
+        assert sorted(handles.closed) == [10, 20]
+
+    def test_trim_working_sets_returns_reclaimed_bytes(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000}, trimmed_working_sets={20: 500})
+        handles.install(monkeypatch)
+
+        assert job_utils.trim_working_sets([10, 20, 30]) == 2500
+        assert [(pid, minimum == maximum) for pid, minimum, maximum in handles.trimmed] == [
+            (10, True),
+            (20, True),
+        ]
+        assert sorted(handles.closed) == [10, 20]
+
+    def test_trim_job_skips_jobs_below_min_working_set(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+        monkeypatch.setattr(job_utils, "get_job_pids", lambda job: [10, 20])
+
+        assert job_utils.trim_job(1111, min_working_set=5000) == 0
+        assert handles.trimmed == []
+
+    def test_trim_job_trims_jobs_at_or_above_min_working_set(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+        monkeypatch.setattr(job_utils, "get_job_pids", lambda job: [10, 20])
+
+        assert job_utils.trim_job(1111, min_working_set=3000) == 3000
+
+    def test_suspend_processes_skips_exited_processes(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+        ntdll = DummyNtdll()
+        monkeypatch.setattr(job_utils, "_ntdll", ntdll)
+
+        assert job_utils.suspend_processes([10, 20, 30]) == 2
+        assert ntdll.suspended == [10, 20]
+        assert sorted(handles.closed) == [10, 20]
+
+    def test_suspend_job_suspends_then_trims_all_processes(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+        ntdll = DummyNtdll()
+        monkeypatch.setattr(job_utils, "_ntdll", ntdll)
+        monkeypatch.setattr(job_utils, "get_job_pids", lambda job: [10, 20])
+
+        assert job_utils.suspend_job(1111) == 3000
+        assert ntdll.suspended == [10, 20]
+        assert [pid for pid, _, _ in handles.trimmed] == [10, 20]
+
+    def test_resume_job_resumes_all_processes(self, monkeypatch):
+        handles = DummyProcessHandles({10: 1000, 20: 2000})
+        handles.install(monkeypatch)
+        ntdll = DummyNtdll()
+        monkeypatch.setattr(job_utils, "_ntdll", ntdll)
+        monkeypatch.setattr(job_utils, "get_job_pids", lambda job: [10, 20])
+
+        assert job_utils.resume_job(1111) == 2
+        assert ntdll.resumed == [10, 20]
+
+    def test_get_job_accounting_converts_cpu_time_and_reads_memory(self, monkeypatch):
+        info = {
+            job_utils.win32job.JobObjectBasicAndIoAccountingInformation: {
+                "BasicInfo": {
+                    "TotalUserTime": 30 * 10**7,
+                    "TotalKernelTime": 5 * 10**7,
+                    "ActiveProcesses": 3,
+                },
+                "IoInfo": {
+                    "ReadTransferCount": 100,
+                    "WriteTransferCount": 200,
+                    "OtherTransferCount": 300,
+                },
+            },
+            job_utils.win32job.JobObjectExtendedLimitInformation: {"PeakJobMemoryUsed": 4096},
+        }
+        monkeypatch.setattr(
+            job_utils.win32job,
+            "QueryInformationJobObject",
+            lambda job, info_class: info[info_class],
+        )
+        monkeypatch.setattr(job_utils, "get_job_memory", lambda job: 2048)
+
+        assert job_utils.get_job_accounting(1111) == {
+            "cpu_seconds": 35,
+            "io_read_bytes": 100,
+            "io_write_bytes": 200,
+            "io_other_bytes": 300,
+            "active_processes": 3,
+            "peak_memory_bytes": 4096,
+            "memory_bytes": 2048,
+        }
+
+    def test_get_job_memory_is_none_when_not_reported(self, monkeypatch):
+        class Kernel32:
+            def QueryInformationJobObject(self, *args):  # noqa: N802
+                return 0
+
+        monkeypatch.setattr(job_utils, "_kernel32", Kernel32())
+
+        assert job_utils.get_job_memory(1111) is None
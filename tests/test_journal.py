@@ -0,0 +1,103 @@
+"""Unit tests for journal."""
+
+import pytest
+import pywintypes
+from winlocalprocessspawner.journal import RollingPercentiles, SpawnJournal, win32_error
+
+
+class TestUnitJournal:
+    """Unit tests for SpawnJournal and its helpers."""
+
+    def test_rolling_percentiles_only_cover_the_window(self):
+        percentiles = RollingPercentiles(size=4)
+        for value in [100, 1, 2, 3, 4]:
+            percentiles.add(value)
+
+        assert len(percentiles) == 4
+        assert percentiles.percentile(50) == 2
+        assert percentiles.percentile(95) == 4
+
+    def test_rolling_percentiles_of_empty_window_are_none(self):
+        assert RollingPercentiles(size=4).percentile(50) is None
+
+    def test_journal_keeps_the_latest_events(self):
+        journal = SpawnJournal(size=2, clock=lambda: 1.5)
+        for pid in [1, 2, 3]:
+            journal.record("exit", "alice", pid=pid, exit_code=0)
+
+        assert [entry["pid"] for entry in journal.events()] == [2, 3]
+        assert journal.events()[0] == {
+            "time": 1.5,
+            "event": "exit",
+            "user": "alice",
+            "server": "",
+            "pid": 2,
+            "exit_code": 0,
+        }
+        assert journal.stats()["exits"] == {"total": 3, "errors": 0}
+
+    def test_events_are_filtered_by_user_kind_and_limit(self):
+        journal = SpawnJournal()
+        journal.record("spawn", "alice", pid=1)
+        journal.record("stop", "alice", pid=1)
+        journal.record("spawn", "bob", pid=2)
+        journal.record("spawn", "alice", pid=3)
+
+        assert [e["pid"] for e in journal.events(user="alice", event="spawn")] == [1, 3]
+        assert [e["pid"] for e in journal.events(limit=2)] == [2, 3]
+        assert journal.events(limit=0) == []
+
+    def test_resize_keeps_the_latest_events(self):
+        journal = SpawnJournal(size=3)
+        for pid in [1, 2, 3]:
+            journal.record("stop", "alice", pid=pid)
+
+        journal.resize(2)
+
+        assert journal.size == 2
+        assert [entry["pid"] for entry in journal.events()] == [2, 3]
+
+    def test_stats_cover_failure_rates_and_phases_of_recent_spawns(self):
+        journal = SpawnJournal(window=4)
+        journal.record("spawn", "alice", result="failed", durations={"profile": 100})
+        for seconds in [1, 2, 3]:
+            journal.record("spawn", "alice", result="ok", durations={"profile": seconds})
+        journal.record("spawn", "bob", result="rejected", durations={"admission": 5})
+
+        stats = journal.stats()
+
+        assert stats["spawns"] == {"total": 5, "ok": 3, "failed": 1, "rejected": 1}
+        # the failed spawn left the window
+        assert stats["window"] == {"spawns": 4, "failure_rate": 0, "rejection_rate": 0.25}
+        assert stats["phases"] == {"profile": {"samples": 3, "p50": 2, "p95": 3}}
+
+    def test_stats_of_empty_journal(self):
+        stats = SpawnJournal().stats()
+
+        assert stats["window"] == {"spawns": 0, "failure_rate": None, "rejection_rate": None}
+        assert stats["phases"] == {}
+
+    @pytest.mark.parametrize(
+        "exc, expected",
+        [
+            (
+                pywintypes.error(5, "CreateProcessAsUser", "Access is denied."),
+                {"winerror": 5, "message": "CreateProcessAsUser: Access is denied."},
+            ),
+            (RuntimeError("not a Win32 error"), None),
+            (None, None),
+        ],
+    )
+    def test_win32_error(self, exc, expected):
+        assert win32_error(exc) == expected
+
+    def test_win32_error_is_found_behind_other_exceptions(self):
+        try:
+            try:
+                raise pywintypes.error(1314, "CreateProcessAsUser", "A required privilege...")
+            except pywintypes.error as exc:
+                raise PermissionError("Cannot start the server") from exc
+        except PermissionError as exc:
+            error = win32_error(exc)
+
+        assert error["winerror"] == 1314
@@ -0,0 +1,598 @@
+"""Unit tests for the launcher service and its client, talking over a localhost TCP socket."""
+
+import asyncio
+import shutil
+import ssl
+import subprocess
+
+import pytest
+import pywintypes
+import winlocalprocessspawner.launcher as launcher
+from winlocalprocessspawner.hostpressure import HostPressure
+
+KEY = "launcher-key"
+
+
+class FakeJob:
+    """Job object stub, holding the FakeProcs assigned to it."""
+
+    def __init__(self):
+        """Initializes an open FakeJob without processes."""
+        self.procs = []
+        self.closed = False
+
+    def Close(self):  # noqa: N802
+        self.closed = True
+
+
+class FakeProc:
+    """PopenAsUser stub, whose exit code is set by the test."""
+
+    next_pid = 5000
+
+    def __init__(self, cmd, token=None, cwd=None, env=None, job=None, **kwargs):
+        """Initializes a running FakeProc with a new pid."""
+        FakeProc.next_pid += 1
+        self.pid = FakeProc.next_pid
+        self.cmd = cmd
+        self.token = token
+        self.cwd = cwd
+        self.env = env
+        self.kwargs = kwargs
+        self.exit_code = None
+        if job is not None:
+            job.procs.append(self)
+
+    def poll(self):
+        return self.exit_code
+
+    def terminate(self):
+        self.exit_code = 1
+
+    def wait(self, timeout=None):
+        return self.exit_code
+
+
+class FakeLaunches:
+    """Stubs the process and job creation of the launcher."""
+
+    def __init__(self):
+        """Initializes FakeLaunches without launched processes."""
+        self.procs = []
+        self.jobs = []
+
+    def popen(self, cmd, **kwargs):
+        proc = FakeProc(cmd, **kwargs)
+        self.procs.append(proc)
+        return proc
+
+    def create_job(self, name):
+        self.jobs.append(FakeJob())
+        return self.jobs[-1]
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(launcher, "PopenAsUser", self.popen)
+        monkeypatch.setattr(launcher.tempfile, "mkdtemp", lambda: "C:/Temp/tmpserver")
+        monkeypatch.setattr(launcher.job_utils, "create_job", self.create_job)
+        monkeypatch.setattr(
+            launcher.job_utils, "terminate_job", lambda job: [p.terminate() for p in job.procs]
+        )
+
+
+STILL_ACTIVE = 259
+
+
+class FakeProcessHandle:
+    """Handle to a process opened by pid."""
+
+    def __init__(self, pid):
+        """Initializes an open FakeProcessHandle to the process pid."""
+        self.pid = pid
+        self.closed = False
+
+    def Close(self):  # noqa: N802
+        self.closed = True
+
+
+class FakeProcesses:
+    """Stubs the functions opening processes by pid and their jobs by name."""
+
+    def __init__(self, exit_codes, jobs=()):
+        """Initializes FakeProcesses with the {pid: exit code} of the existing processes.
+
+        jobs maps the ids of the existing job objects to the pids of their processes.
+        """
+        self.exit_codes = dict(exit_codes)
+        self.jobs = dict(jobs)
+        self.error = None
+        self.handles = {}
+        self.opened_jobs = []
+        self.terminated = []
+
+    def open_process(self, access, inherit, pid):
+        if self.error is not None:
+            raise self.error
+        if pid not in self.exit_codes:
+            raise pywintypes.error(
+                launcher.winerror.ERROR_INVALID_PARAMETER, "OpenProcess", "Invalid parameter."
+            )
+        self.handles[pid] = FakeProcessHandle(pid)
+        return self.handles[pid]
+
+    def open_job(self, name):
+        for job_id, pids in self.jobs.items():
+            if launcher.job_utils.job_name(job_id) == name:
+                job = FakeJob()
+                job.pids = pids
+                self.opened_jobs.append(job)
+                return job
+        raise pywintypes.error(2, "OpenJobObject", "The system cannot find the file.")
+
+    def terminate_job(self, job):
+        for pid in job.pids:
+            self.terminated.append(pid)
+            self.exit_codes[pid] = 1
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(launcher.win32api, "OpenProcess", self.open_process)
+        monkeypatch.setattr(launcher.job_utils, "open_job", self.open_job)
+        monkeypatch.setattr(launcher.job_utils, "terminate_job", self.terminate_job)
+        monkeypatch.setattr(
+            launcher.win32job,
+            "IsProcessInJob",
+            lambda process, job: process.pid in job.pids,
+            raising=False,
+        )
+        monkeypatch.setattr(
+            launcher.win32process,
+            "GetExitCodeProcess",
+            lambda handle: self.exit_codes[handle.pid],
+        )
+        monkeypatch.setattr(
+            launcher.win32event, "WaitForSingleObject", lambda handle, milliseconds: 0
+        )
+        monkeypatch.setattr(launcher.win32con, "STILL_ACTIVE", STILL_ACTIVE, raising=False)
+
+
+async def start_service(**kwargs):
+    """Start a LauncherService on a free localhost port. Returns it and its address."""
+    service = launcher.LauncherService(key=KEY, poll_interval=0.01, **kwargs)
+    await service.start("tcp:127.0.0.1:0")
+    port = service._server.sockets[0].getsockname()[1]
+    return service, "tcp:127.0.0.1:{}".format(port)
+
+
+def run_with_service(scenario, **kwargs):
+    """Run scenario(client) against a new service, closing both afterwards."""
+
+    async def run():
+        service, address = await start_service(**kwargs)
+        client = launcher.LauncherClient(address, KEY)
+        try:
+            return await scenario(client)
+        finally:
+            client.close()
+            await service.close()
+
+    return asyncio.run(run())
+
+
+class TestParseAddress:
+    """Tests for launcher.parse_address."""
+
+    def test_short_pipe_address(self):
+        assert launcher.parse_address("pipe:hub") == ("pipe", "\\\\.\\pipe\\hub")
+
+    def test_full_pipe_name(self):
+        assert launcher.parse_address("\\\\.\\pipe\\hub") == ("pipe", "\\\\.\\pipe\\hub")
+
+    def test_tcp_address(self):
+        assert launcher.parse_address("tcp:127.0.0.1:8765") == ("tcp", "127.0.0.1", 8765)
+
+    @pytest.mark.parametrize("address", ["", "pipe:", "tcp:127.0.0.1", "http://localhost"])
+    def test_invalid_address_raises(self, address):
+        with pytest.raises(ValueError):
+            launcher.parse_address(address)
+
+
+class FakeAcl:
+    """win32security ACL stub, recording its access allowed ACEs."""
+
+    def __init__(self):
+        """Initializes an empty FakeAcl."""
+        self.aces = []
+
+    def AddAccessAllowedAce(self, revision, access, sid):  # noqa: N802
+        self.aces.append((sid, access))
+
+
+class TestPipeSecurity:
+    """Tests for the security of the launcher's named pipe."""
+
+    def test_dacl_grants_read_write_to_allowed_accounts_only(self, monkeypatch):
+        monkeypatch.setattr(launcher.win32security, "ACL", FakeAcl)
+        monkeypatch.setattr(launcher.token_utils, "current_user_sid", lambda: "launcher")
+        monkeypatch.setattr(
+            launcher.win32security, "CreateWellKnownSid", lambda sid_type: ("well-known", sid_type)
+        )
+        monkeypatch.setattr(
+            launcher.win32security,
+            "LookupAccountName",
+            lambda system, account: ("sid:" + account, "DOMAIN", 1),
+        )
+
+        dacl = launcher.pipe_dacl(["NT SERVICE\\jupyterhub", "DOMAIN\\hub-admins"])
+
+        full_access = launcher.ntsecuritycon.FILE_ALL_ACCESS
+        assert dacl.aces == [
+            ("launcher", full_access),
+            (("well-known", launcher.win32security.WinLocalSystemSid), full_access),
+            (("well-known", launcher.win32security.WinBuiltinAdministratorsSid), full_access),
+            ("sid:NT SERVICE\\jupyterhub", launcher.PIPE_CLIENT_ACCESS),
+            ("sid:DOMAIN\\hub-admins", launcher.PIPE_CLIENT_ACCESS),
+        ]
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    """Returns the paths of a self-signed certificate for 127.0.0.1 and of its private key."""
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is needed to create a certificate")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            str(key),
+            "-out",
+            str(cert),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+class TestTls:
+    """Tests for the launchers serving TCP over TLS."""
+
+    def _status(self, certificate, client_context):
+        cert, key = certificate
+
+        async def run():
+            service, address = await start_service(
+                ssl_context=launcher.server_ssl_context(cert, key, cafile=cert)
+            )
+            client = launcher.LauncherClient(address, KEY, client_context)
+            try:
+                return await client.request("status")
+            finally:
+                client.close()
+                await service.close()
+
+        return asyncio.run(run())
+
+    def test_client_trusting_the_launcher_certificate_is_served(self, certificate):
+        cert, key = certificate
+
+        status = self._status(certificate, launcher.client_ssl_context(cert, cert, key))
+
+        assert status["servers"] == 0
+
+    def test_client_not_trusting_the_launcher_certificate_fails(self, certificate):
+        cert, key = certificate
+
+        with pytest.raises(ssl.SSLCertVerificationError):
+            self._status(certificate, launcher.client_ssl_context(None, cert, key))
+
+    def test_only_loopback_addresses_are_served_without_tls(self):
+        assert launcher.is_loopback_address("tcp:127.0.0.1:8765")
+        assert launcher.is_loopback_address("tcp:localhost:8765")
+        assert launcher.is_loopback_address("pipe:hub")
+        assert not launcher.is_loopback_address("tcp:0.0.0.0:8765")
+        assert not launcher.is_loopback_address("tcp:launcher-1:8765")
+
+    def test_launcher_refuses_to_serve_other_addresses_without_certificate(self, monkeypatch):
+        monkeypatch.setenv(launcher.KEY_ENV_VAR, KEY)
+
+        with pytest.raises(SystemExit):
+            launcher.main(["--address", "tcp:0.0.0.0:8765"])
+
+
+class TestLauncherService:
+    """Tests for LauncherService and LauncherClient."""
+
+    def test_launch_then_poll_running_process(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        async def scenario(client):
+            result = await client.request("launch", cmd=["python"], env={"A": "B"}, cwd="C:/")
+            return result, await client.poll(result["pid"], result["job_id"])
+
+        result, exit_code = run_with_service(scenario)
+
+        assert result["pid"] == launches.procs[0].pid
+        assert result["job_id"]
+        assert exit_code is None
+        assert launches.procs[0].env == {"A": "B"}
+        assert launches.jobs[0].procs == [launches.procs[0]]
+
+    def test_launch_without_cwd_starts_in_the_user_profile(self, monkeypatch, tmp_path):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"], env={"USERPROFILE": str(tmp_path)})
+            await client.request("launch", cmd=["python"], env={"USERPROFILE": "C:/Missing"})
+
+        run_with_service(scenario)
+
+        assert [proc.cwd for proc in launches.procs] == [str(tmp_path), "C:/Temp/tmpserver"]
+
+    def test_exit_event_is_streamed_to_the_client(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        async def scenario(client):
+            result = await client.request("launch", cmd=["python"])
+            exited = asyncio.get_event_loop().create_future()
+            client.on_exit(result["pid"], exited.set_result)
+            launches.procs[0].exit_code = 3
+            exit_code = await asyncio.wait_for(exited, 5)
+            return exit_code, await client.poll(result["pid"])
+
+        assert run_with_service(scenario) == (3, 3)
+        assert launches.jobs[0].closed
+
+    def test_batched_requests_return_results_in_order(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        async def scenario(client):
+            return await client.request_batch(
+                [("launch", {"cmd": ["first"]}), ("launch", {"cmd": ["second"]})]
+            )
+
+        results = run_with_service(scenario)
+
+        # the launches run concurrently on the executor, so they may start in any order
+        cmds = {proc.pid: proc.cmd for proc in launches.procs}
+        assert [cmds[result["pid"]] for result in results] == [["first"], ["second"]]
+
+    def test_invalid_key_is_rejected(self, monkeypatch):
+        FakeLaunches().install(monkeypatch)
+
+        async def scenario(client):
+            client.key = "wrong"
+            await client.request("poll", pid=1)
+
+        with pytest.raises(PermissionError):
+            run_with_service(scenario)
+
+    def test_launch_error_is_raised_by_client_and_job_is_closed(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        def failing_popen(cmd, **kwargs):
+            raise PermissionError("Access is denied")
+
+        monkeypatch.setattr(launcher, "PopenAsUser", failing_popen)
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"])
+
+        with pytest.raises(PermissionError, match="Access is denied"):
+            run_with_service(scenario)
+        assert launches.jobs[0].closed
+
+    def test_unknown_operation_raises_value_error(self):
+        async def scenario(client):
+            await client.request("reboot")
+
+        with pytest.raises(ValueError, match="reboot"):
+            run_with_service(scenario)
+
+    def test_stop_terminates_the_job(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+
+        async def scenario(client):
+            result = await client.request("launch", cmd=["python"])
+            return await client.stop(result["pid"], result["job_id"])
+
+        assert run_with_service(scenario) == 1
+        assert launches.procs[0].exit_code == 1
+        assert launches.jobs[0].closed
+
+    def test_poll_of_process_that_no_longer_exists_reports_exit(self, monkeypatch):
+        FakeProcesses({}).install(monkeypatch)
+
+        async def scenario(client):
+            return await client.poll(1234, "0123")
+
+        assert run_with_service(scenario) == 0
+
+    def test_process_launched_before_a_restart_is_adopted(self, monkeypatch):
+        processes = FakeProcesses({1234: STILL_ACTIVE, 1235: STILL_ACTIVE}, {"0123": [1234, 1235]})
+        processes.install(monkeypatch)
+
+        async def scenario(client):
+            return await client.poll(1234, "0123"), await client.stop(1234, "0123")
+
+        assert run_with_service(scenario) == (None, 1)
+        assert processes.terminated == [1234, 1235]
+        assert processes.handles[1234].closed
+        assert processes.opened_jobs[0].closed
+
+    @pytest.mark.parametrize("jobs", [{}, {"0123": [4321]}], ids=["job gone", "reused pid"])
+    def test_process_outside_of_its_job_is_reported_exited_and_not_stopped(self, monkeypatch, jobs):
+        processes = FakeProcesses({1234: STILL_ACTIVE}, jobs)
+        processes.install(monkeypatch)
+
+        async def scenario(client):
+            return await client.poll(1234, "0123"), await client.stop(1234, "0123")
+
+        assert run_with_service(scenario) == (0, 0)
+        assert processes.terminated == []
+        assert all(handle.closed for handle in processes.handles.values())
+        assert all(job.closed for job in processes.opened_jobs)
+
+    def test_process_launched_without_a_job_is_not_adopted(self, monkeypatch):
+        processes = FakeProcesses({1234: STILL_ACTIVE})
+        processes.install(monkeypatch)
+
+        async def scenario(client):
+            return await client.stop(1234, None)
+
+        assert run_with_service(scenario) == 0
+        assert processes.handles == {}
+
+    def test_process_that_cannot_be_adopted_is_reported_running(self, monkeypatch):
+        processes = FakeProcesses({1234: STILL_ACTIVE}, {"0123": [1234]})
+        processes.error = pywintypes.error(5, "OpenProcess", "Access is denied.")
+        processes.install(monkeypatch)
+
+        async def scenario(client):
+            return await client.poll(1234, "0123")
+
+        assert run_with_service(scenario) is None
+
+    def test_stop_of_process_that_cannot_be_adopted_fails(self, monkeypatch):
+        processes = FakeProcesses({1234: STILL_ACTIVE}, {"0123": [1234]})
+        processes.error = pywintypes.error(5, "OpenProcess", "Access is denied.")
+        processes.install(monkeypatch)
+
+        async def scenario(client):
+            await client.stop(1234, "0123")
+
+        with pytest.raises(launcher.LauncherError, match="Access is denied"):
+            run_with_service(scenario)
+
+    def test_hub_token_is_duplicated_for_the_launch_and_closed(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        duplicated = []
+
+        class Token:
+            closed = False
+
+            def Close(self):  # noqa: N802
+                self.closed = True
+
+        def duplicate_token_from_process(pid, handle):
+            duplicated.append((pid, handle, Token()))
+            return duplicated[-1][2]
+
+        monkeypatch.setattr(
+            launcher.token_utils, "duplicate_token_from_process", duplicate_token_from_process
+        )
+        # as if connected over a named pipe
+        monkeypatch.setattr(launcher, "_client_pid", lambda writer: 4242)
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"], token={"pid": 42, "handle": 123})
+
+        run_with_service(scenario)
+
+        pid, handle, token = duplicated[0]
+        # the token is duplicated from the connected client, whatever pid it claims
+        assert (pid, handle) == (4242, 123)
+        assert launches.procs[0].token is token
+        assert token.closed
+
+    def test_token_handles_are_rejected_without_a_named_pipe(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        monkeypatch.setattr(
+            launcher.token_utils,
+            "duplicate_token_from_process",
+            lambda pid, handle: pytest.fail("token was duplicated"),
+        )
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"], token={"pid": 4, "handle": 123})
+
+        with pytest.raises(PermissionError, match="named pipe"):
+            run_with_service(scenario)
+        assert launches.procs == []
+
+    def test_profile_env_is_cached_per_user(self, monkeypatch):
+        loads = []
+
+        def create_environment_block(token, inherit):
+            loads.append(token)
+            return {"USERPROFILE": "C:/Users/alice"}
+
+        monkeypatch.setattr(
+            launcher.win32profile, "CreateEnvironmentBlock", create_environment_block
+        )
+
+        async def scenario(client):
+            return [
+                await client.request("profile_env", token=None, username="alice") for _ in range(2)
+            ]
+
+        results = run_with_service(scenario)
+
+        assert results == [{"USERPROFILE": "C:/Users/alice"}] * 2
+        assert len(loads) == 1
+
+    def test_status_reports_number_of_running_servers_and_host_pressure(self, monkeypatch):
+        FakeLaunches().install(monkeypatch)
+        pressure = HostPressure(available_memory=1, commit=2, commit_limit=3, cpu_percent=None)
+        monkeypatch.setattr(launcher.hostpressure, "memory_status", lambda: pressure[:3])
+        monkeypatch.setattr(launcher.hostpressure, "system_times", lambda: (0, 0))
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"])
+            return await client.request("status")
+
+        assert run_with_service(scenario) == {"servers": 1, "pressure": pressure._asdict()}
+
+    def test_random_port_returns_a_port(self):
+        async def scenario(client):
+            return await client.request("random_port")
+
+        assert 0 < run_with_service(scenario)["port"] < 65536
+
+    def test_user_token_spec_is_resolved_by_token_provider(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        provided = []
+
+        class Token:
+            def Close(self):  # noqa: N802
+                pass
+
+        def token_provider(username):
+            provided.append(username)
+            return Token()
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"], token={"user": "alice"})
+
+        run_with_service(scenario, token_provider=token_provider)
+
+        assert provided == ["alice"]
+        assert isinstance(launches.procs[0].token, Token)
+
+    def test_user_token_spec_without_token_provider_is_rejected(self, monkeypatch):
+        FakeLaunches().install(monkeypatch)
+
+        async def scenario(client):
+            await client.request("launch", cmd=["python"], token={"user": "alice"})
+
+        with pytest.raises(PermissionError, match="token provider"):
+            run_with_service(scenario)
@@ -0,0 +1,62 @@
+"""Unit tests for placement."""
+
+import random
+
+import pytest
+from winlocalprocessspawner import placement
+
+HOSTS = placement.agent_hosts(
+    {
+        "tcp:10.0.0.1:8765": {},
+        "tcp:10.0.0.2:8765": {"weight": 2},
+        "tcp:agent3:8765": {"ip": "10.0.0.3", "max_servers": 10},
+    }
+)
+
+
+class TestUnitPlacement:
+    """Unit tests for placement."""
+
+    def test_agent_hosts_defaults_ip_to_host_of_address(self):
+        assert HOSTS[0] == placement.AgentHost("tcp:10.0.0.1:8765", "10.0.0.1", 1.0, 0)
+        assert HOSTS[2].ip == "10.0.0.3"
+
+    def test_least_loaded_takes_weights_into_account(self):
+        loads = {"tcp:10.0.0.1:8765": 5, "tcp:10.0.0.2:8765": 8, "tcp:agent3:8765": 6}
+
+        host = placement.place("least_loaded", HOSTS, loads, "alice")
+
+        assert host.address == "tcp:10.0.0.2:8765"
+
+    def test_sticky_only_moves_users_of_unavailable_hosts(self):
+        loads = {host.address: 0 for host in HOSTS}
+        users = ["user{}".format(i) for i in range(100)]
+        before = {user: placement.place("sticky", HOSTS, loads, user) for user in users}
+
+        del loads[HOSTS[0].address]
+        after = {user: placement.place("sticky", HOSTS, loads, user) for user in users}
+
+        assert len(set(before.values())) == 3
+        for user in users:
+            if before[user] != HOSTS[0]:
+                assert after[user] == before[user]
+
+    def test_weighted_skips_hosts_with_zero_weight(self):
+        hosts = placement.agent_hosts({"tcp:a:1": {"weight": 0}, "tcp:b:1": {}})
+        loads = {"tcp:a:1": 0, "tcp:b:1": 0}
+        rng = random.Random(0)
+
+        chosen = {
+            placement.place("weighted", hosts, loads, "alice", rng).address for _ in range(20)
+        }
+
+        assert chosen == {"tcp:b:1"}
+
+    def test_place_skips_unavailable_and_full_hosts(self):
+        loads = {"tcp:agent3:8765": 10}
+
+        assert placement.place("least_loaded", HOSTS, loads, "alice") is None
+
+    def test_place_rejects_unknown_policy(self):
+        with pytest.raises(ValueError):
+            placement.place("round_robin", HOSTS, {HOSTS[0].address: 0}, "alice")
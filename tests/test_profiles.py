@@ -0,0 +1,144 @@
+"""Unit tests for profiles."""
+
+import threading
+
+import pytest
+import pywintypes
+import winlocalprocessspawner.profiles as profiles
+
+from .test_hostpressure import FakeClock
+
+
+class FakeProfiles:
+    """Stubs the loading and unloading of user profiles."""
+
+    def __init__(self):
+        """Initializes FakeProfiles without loaded profiles."""
+        self.loaded = []
+        self.unloaded = []
+        self.closed = []
+        self.unload_error = None
+
+    def duplicate_token(self, token):
+        return ("duplicate", token)
+
+    def load(self, token, profile_info):
+        self.loaded.append((token, profile_info["UserName"]))
+        return len(self.loaded)
+
+    def unload(self, token, handle):
+        if self.unload_error is not None:
+            raise self.unload_error
+        self.unloaded.append((token, handle))
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(profiles.token_utils, "duplicate_token", self.duplicate_token)
+        monkeypatch.setattr(profiles.win32profile, "LoadUserProfile", self.load)
+        monkeypatch.setattr(profiles.win32profile, "UnloadUserProfile", self.unload)
+        monkeypatch.setattr(
+            profiles.win32profile,
+            "CreateEnvironmentBlock",
+            lambda token, inherit: {"APPDATA": "C:/Users/{}/AppData".format(token[1])},
+        )
+        monkeypatch.setattr(profiles.win32api, "CloseHandle", self.closed.append)
+
+
+@pytest.fixture
+def fake_profiles(monkeypatch):
+    """Returns FakeProfiles installed in the profiles module."""
+    fake = FakeProfiles()
+    fake.install(monkeypatch)
+    return fake
+
+
+class TestUnitUserProfileManager:
+    """Unit tests for UserProfileManager."""
+
+    def test_profile_is_loaded_once_for_all_servers_of_a_user(self, fake_profiles):
+        manager = profiles.UserProfileManager()
+
+        first = manager.acquire("alice", "alice", "server-1")
+        second = manager.acquire("alice", "alice", "server-2")
+        manager.acquire("bob", "bob", "server-1")
+
+        assert first == second == {"APPDATA": "C:/Users/alice/AppData"}
+        assert fake_profiles.loaded == [
+            (("duplicate", "alice"), "alice"),
+            (("duplicate", "bob"), "bob"),
+        ]
+        assert manager.holders("alice") == {"server-1", "server-2"}
+
+    def test_profile_is_unloaded_after_grace_period_of_last_release(self, fake_profiles):
+        clock = FakeClock()
+        manager = profiles.UserProfileManager(grace=300, clock=clock)
+        manager.acquire("alice", "alice", "server-1")
+        manager.acquire("alice", "alice", "server-2")
+
+        assert not manager.release("alice", "server-1")
+        assert manager.release("alice", "server-2")
+        clock.now = 299
+        assert manager.unload_expired() == []
+        clock.now = 300
+        assert manager.unload_expired() == ["alice"]
+
+        assert fake_profiles.unloaded == [(("duplicate", "alice"), 1)]
+        assert fake_profiles.closed == [("duplicate", "alice")]
+        assert len(manager) == 0
+
+    def test_acquire_within_grace_period_reuses_the_profile(self, fake_profiles):
+        clock = FakeClock()
+        manager = profiles.UserProfileManager(grace=300, clock=clock)
+        manager.acquire("alice", "alice", "server-1")
+        manager.release("alice", "server-1")
+
+        clock.now = 200
+        manager.acquire("alice", "alice", "server-1")
+        clock.now = 600
+
+        assert manager.unload_expired() == []
+        assert len(fake_profiles.loaded) == 1
+
+    def test_holder_takes_a_single_reference(self, fake_profiles):
+        manager = profiles.UserProfileManager(grace=0)
+        manager.acquire("alice", "alice", "server-1")
+        manager.acquire("alice", "alice", "server-1")
+
+        assert manager.release("alice", "server-1")
+        assert not manager.release("alice", "server-1")
+        assert manager.unload_expired() == ["alice"]
+
+    def test_failed_load_closes_the_token(self, fake_profiles, monkeypatch):
+        def load(token, profile_info):
+            raise pywintypes.error(1314, "LoadUserProfile", "A required privilege is not held.")
+
+        monkeypatch.setattr(profiles.win32profile, "LoadUserProfile", load)
+        manager = profiles.UserProfileManager()
+
+        with pytest.raises(pywintypes.error):
+            manager.acquire("alice", "alice", "server-1")
+
+        assert fake_profiles.closed == [("duplicate", "alice")]
+        assert len(manager) == 0
+
+    def test_failed_unload_still_closes_the_token(self, fake_profiles):
+        fake_profiles.unload_error = pywintypes.error(32, "UnloadUserProfile", "In use.")
+        manager = profiles.UserProfileManager(grace=0)
+        manager.acquire("alice", "alice", "server-1")
+        manager.release("alice", "server-1")
+
+        assert manager.unload_expired() == ["alice"]
+        assert fake_profiles.closed == [("duplicate", "alice")]
+
+    def test_concurrent_first_acquisitions_load_once(self, fake_profiles):
+        manager = profiles.UserProfileManager()
+        threads = [
+            threading.Thread(target=manager.acquire, args=("alice", "alice", index))
+            for index in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(fake_profiles.loaded) == 1
+        assert len(manager.holders("alice")) == 8
@@ -0,0 +1,89 @@
+"""Unit tests for ratelimit."""
+
+from winlocalprocessspawner.ratelimit import SpawnRateLimiter, TokenBucket
+
+
+class FakeClock:
+    """Monotonic clock stub that only moves when told to."""
+
+    def __init__(self):
+        """Initializes FakeClock at time 0."""
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket:
+    """Unit tests for TokenBucket."""
+
+    def test_allows_burst_then_waits_for_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=0.5, burst=2, clock=clock)
+
+        for _ in range(2):
+            assert bucket.wait_time() == 0
+            bucket.take()
+
+        assert bucket.wait_time() == 2.0
+        clock.now = 1.0
+        assert bucket.wait_time() == 1.0
+        clock.now = 2.0
+        assert bucket.wait_time() == 0
+
+    def test_does_not_refill_beyond_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, burst=2, clock=clock)
+        bucket.take()
+
+        clock.now = 100.0
+
+        assert bucket.full
+        bucket.take()
+        bucket.take()
+        assert bucket.wait_time() == 1.0
+
+
+class TestSpawnRateLimiter:
+    """Unit tests for SpawnRateLimiter."""
+
+    def test_acquire_takes_from_all_buckets_when_all_allow_it(self):
+        limiter = SpawnRateLimiter(clock=FakeClock())
+        limits = [("user", "alice", 1, 1), ("global", "", 1, 2)]
+
+        assert limiter.acquire(limits) is None
+        assert limiter.acquire([("global", "", 1, 2)]) is None
+        assert limiter.acquire([("global", "", 1, 2)]) == ("global", 1.0)
+
+    def test_acquire_takes_nothing_when_one_bucket_is_empty(self):
+        limiter = SpawnRateLimiter(clock=FakeClock())
+        assert limiter.acquire([("user", "alice", 0.5, 1)]) is None
+
+        assert limiter.acquire([("user", "alice", 0.5, 1), ("global", "", 1, 1)]) == ("user", 2.0)
+        # the global token was not taken by the rejected attempt
+        assert limiter.acquire([("global", "", 1, 1)]) is None
+
+    def test_acquire_reports_the_longest_wait(self):
+        limiter = SpawnRateLimiter(clock=FakeClock())
+        limits = [("user", "alice", 1, 1), ("group", "class", 0.1, 1)]
+        assert limiter.acquire(limits) is None
+
+        assert limiter.acquire(limits) == ("group", 10.0)
+
+    def test_limits_with_zero_rate_are_ignored(self):
+        limiter = SpawnRateLimiter(clock=FakeClock())
+
+        for _ in range(10):
+            assert limiter.acquire([("user", "alice", 0, 1)]) is None
+
+    def test_full_buckets_are_pruned(self):
+        clock = FakeClock()
+        limiter = SpawnRateLimiter(clock=clock)
+        limiter.prune_threshold = 2
+        for name in ["alice", "bob"]:
+            limiter.acquire([("user", name, 1, 1)])
+
+        clock.now = 10.0
+        limiter.acquire([("user", "carol", 1, 1)])
+
+        assert list(limiter._buckets) == [("user", "carol")]
@@ -4,8 +4,10 @@ Unit tests are under class `TestUnitTokenUtils`.
 Integration tests are under class `TestIntegrationTokenUtils`.
 """
 
+import asyncio
 import ctypes
 import secrets
+import threading
 import string
 
 import ntsecuritycon
@@ -82,6 +84,56 @@ def temporary_service_user():
         win32net.NetUserDel(None, username)
 
 
+class DummyTokens:
+    """Stubs LogonUser and the handle APIs used by ServiceTokenCache."""
+
+    def __init__(self):
+        """Initializes the stub with no open handles."""
+        self.next_handle = 1000
+        self.logons = 0
+        self.open = set()
+        self.invalid = set()
+
+    def _new_handle(self):
+        self.next_handle += 1
+        self.open.add(self.next_handle)
+        return self.next_handle
+
+    def logon_user(self, *args):
+        self.logons += 1
+        return self._new_handle()
+
+    def duplicate_handle(self, source_process, handle, target_process, access, inherit, options):
+        return self._new_handle()
+
+    def close_handle(self, handle):
+        self.open.remove(handle)
+
+    def get_token_information(self, handle, info_class):
+        if handle in self.invalid:
+            raise pywintypes.error(6, "GetTokenInformation", "The handle is invalid.")
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(token_utils.win32security, "LogonUser", self.logon_user)
+        monkeypatch.setattr(
+            token_utils.win32security, "GetTokenInformation", self.get_token_information
+        )
+        monkeypatch.setattr(token_utils.win32api, "GetCurrentProcess", lambda: -1)
+        monkeypatch.setattr(token_utils.win32api, "DuplicateHandle", self.duplicate_handle)
+        monkeypatch.setattr(token_utils.win32api, "CloseHandle", self.close_handle)
+
+
+class FakeClock:
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        """Initializes the clock at time 0."""
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
 class TestUnitTokenUtils:
     """Unit tests for token_utils."""
 
@@ -147,6 +199,190 @@ class TestUnitTokenUtils:
         with pytest.raises(pywintypes.error):
             token_utils.restrict_token(1111)
 
+    def test_create_token_async_returns_token_from_thread_pool(self, monkeypatch):
+        threads = []
+
+        def mock_logon_user(*args):
+            threads.append(threading.current_thread())
+            return pywintypes.HANDLE(9999)
+
+        monkeypatch.setattr(token_utils.win32security, "LogonUser", mock_logon_user)
+
+        token_handle = asyncio.run(token_utils.create_service_token_async("test_user", "pass"))
+        assert token_handle.handle == 9999
+        assert threads[0] is not threading.main_thread()
+
+    def test_restrict_token_async_propagates_exception(self, monkeypatch):
+        def mock_create_restricted_token(*args):
+            raise pywintypes.error
+
+        monkeypatch.setattr(
+            token_utils.win32security, "CreateRestrictedToken", mock_create_restricted_token
+        )
+        monkeypatch.setattr(token_utils.win32api, "GetLastError", lambda: -1)
+
+        with pytest.raises(pywintypes.error):
+            asyncio.run(token_utils.restrict_token_async(1111))
+
+    def test_restrict_token_async_closes_token_returned_after_timeout(self, monkeypatch):
+        release = threading.Event()
+        closed = []
+
+        def mock_create_restricted_token(*args):
+            release.wait(5)
+            return 9999
+
+        monkeypatch.setattr(
+            token_utils.win32security, "CreateRestrictedToken", mock_create_restricted_token
+        )
+        monkeypatch.setattr(token_utils.win32security, "SetTokenInformation", lambda *args: None)
+        monkeypatch.setattr(token_utils.win32api, "CloseHandle", closed.append)
+
+        async def restrict_with_timeout():
+            with pytest.raises(asyncio.TimeoutError):
+                await token_utils.restrict_token_async(1111, timeout=0.01)
+            release.set()
+            # let the late result reach its done callback
+            for _ in range(50):
+                if closed:
+                    break
+                await asyncio.sleep(0.01)
+
+        asyncio.run(restrict_with_timeout())
+        assert closed == [9999]
+
+    def test_restrict_tokens_returns_per_token_results_in_order(self, monkeypatch):
+        def mock_create_restricted_token(token, *args):
+            if token == 2:
+                raise pywintypes.error(6, "CreateRestrictedToken", "The handle is invalid.")
+            return token * 100
+
+        monkeypatch.setattr(
+            token_utils.win32security, "CreateRestrictedToken", mock_create_restricted_token
+        )
+        monkeypatch.setattr(token_utils.win32security, "SetTokenInformation", lambda *args: None)
+
+        results = token_utils.restrict_tokens([1, 2, 3])
+
+        assert [result.token for result in results] == [100, None, 300]
+        assert results[0].error is None
+        assert isinstance(results[1].error, pywintypes.error)
+
+    def test_restrict_tokens_async_returns_per_token_results_in_order(self, monkeypatch):
+        def mock_create_restricted_token(token, *args):
+            if token == 2:
+                raise pywintypes.error(6, "CreateRestrictedToken", "The handle is invalid.")
+            return token * 100
+
+        monkeypatch.setattr(
+            token_utils.win32security, "CreateRestrictedToken", mock_create_restricted_token
+        )
+        monkeypatch.setattr(token_utils.win32security, "SetTokenInformation", lambda *args: None)
+
+        results = asyncio.run(token_utils.restrict_tokens_async([1, 2, 3]))
+
+        assert [result.token for result in results] == [100, None, 300]
+        assert isinstance(results[1].error, pywintypes.error)
+
+    def test_restrict_tokens_async_closes_restricted_tokens_when_cancelled(self, monkeypatch):
+        release = threading.Event()
+        closed = []
+
+        def mock_create_restricted_token(token, *args):
+            if token == 2:
+                release.wait(5)
+            return token * 100
+
+        monkeypatch.setattr(
+            token_utils.win32security, "CreateRestrictedToken", mock_create_restricted_token
+        )
+        monkeypatch.setattr(token_utils.win32security, "SetTokenInformation", lambda *args: None)
+        monkeypatch.setattr(token_utils.win32api, "CloseHandle", closed.append)
+
+        async def cancel_batch():
+            batch = asyncio.ensure_future(token_utils.restrict_tokens_async([1, 2]))
+            await asyncio.sleep(0.1)
+            batch.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await batch
+            release.set()
+            # let the late result reach its done callback
+            await asyncio.sleep(0.2)
+
+        asyncio.run(cancel_batch())
+        assert sorted(closed) == [100, 200]
+
+    def test_service_token_cache_logs_on_once_and_hands_out_duplicates(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        cache = token_utils.ServiceTokenCache()
+
+        first = cache.get_token("test_user", "test_pass")
+        second = cache.get_token("test_user", "test_pass")
+
+        assert tokens.logons == 1
+        assert first != second
+        # the cached token and both duplicates
+        assert len(tokens.open) == 3
+
+    def test_service_token_cache_logs_on_again_with_another_password(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        cache = token_utils.ServiceTokenCache()
+
+        cache.get_token("test_user", "test_pass")
+        cache.get_token("test_user", "other_pass")
+
+        assert tokens.logons == 2
+
+    def test_service_token_cache_does_not_keep_password(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        cache = token_utils.ServiceTokenCache()
+
+        cache.get_token("test_user", "test_pass")
+
+        assert all("test_pass" not in key for key in cache._entries)
+
+    def test_service_token_cache_evicts_and_closes_expired_tokens(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        clock = FakeClock()
+        cache = token_utils.ServiceTokenCache(ttl=60, clock=clock)
+
+        duplicate = cache.get_token("test_user", "test_pass")
+        tokens.close_handle(duplicate)
+        clock.now = 60
+        duplicate = cache.get_token("test_user", "test_pass")
+        tokens.close_handle(duplicate)
+
+        assert tokens.logons == 2
+        assert len(tokens.open) == 1
+
+    def test_service_token_cache_evicts_tokens_failing_validation(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        cache = token_utils.ServiceTokenCache()
+
+        cache.get_token("test_user", "test_pass")
+        tokens.invalid.update(tokens.open)
+        cache.get_token("test_user", "test_pass")
+
+        assert tokens.logons == 2
+        assert len(cache) == 1
+
+    def test_service_token_cache_invalidate_closes_tokens_of_user(self, monkeypatch):
+        tokens = DummyTokens()
+        tokens.install(monkeypatch)
+        cache = token_utils.ServiceTokenCache()
+
+        tokens.close_handle(cache.get_token("test_user", "test_pass"))
+        tokens.close_handle(cache.get_token("other_user", "test_pass"))
+        cache.invalidate("test_user")
+
+        assert len(cache) == 1
+        assert len(tokens.open) == 1
+
 
 @pytest.mark.requires_admin
 class TestIntegrationTokenUtils:
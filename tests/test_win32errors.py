@@ -0,0 +1,43 @@
+"""Unit tests for win32errors."""
+
+import pywintypes
+import winlocalprocessspawner.win32errors as win32errors
+
+
+class MaxRandom:
+    """random stub, always drawing the upper bound."""
+
+    def uniform(self, low, high):
+        return high
+
+
+class TestUnitWin32Errors:
+    """Unit tests for win32errors."""
+
+    def test_load_and_locking_errors_are_transient(self):
+        for code in (8, 32, 1450, 1455, 1816):
+            assert win32errors.classify(code) == win32errors.TRANSIENT
+
+    def test_other_errors_are_permanent(self):
+        for code in (2, 5, 193, 1314, 12345, None):
+            assert win32errors.classify(code) == win32errors.PERMANENT
+
+    def test_error_name(self):
+        assert win32errors.error_name(1816) == "ERROR_NOT_ENOUGH_QUOTA"
+        assert win32errors.error_name(5) == "ERROR_ACCESS_DENIED"
+        assert win32errors.error_name(12345) == "other"
+
+    def test_winerror_of_pywin32_and_os_errors(self):
+        assert win32errors.winerror(pywintypes.error(32, "CreateProcessAsUser", "In use")) == 32
+        assert win32errors.winerror(ValueError("not a Win32 error")) is None
+
+    def test_retry_delay_doubles_up_to_max_delay(self):
+        delays = [win32errors.retry_delay(attempt, 0.5, 3, rng=MaxRandom()) for attempt in range(4)]
+
+        assert delays == [0.5, 1, 2, 3]
+
+    def test_retry_delay_is_jittered_below_its_bound(self):
+        delays = {win32errors.retry_delay(2, 0.5, 10) for _ in range(20)}
+
+        assert len(delays) > 1
+        assert all(0 <= delay <= 2 for delay in delays)
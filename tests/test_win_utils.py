@@ -1,9 +1,14 @@
 """Tests for win_utils module."""
 
+import ctypes
 import subprocess
+from ctypes import wintypes
 from unittest import mock
 
+import pytest
+import pywintypes
 import winlocalprocessspawner.win_utils as win_utils
+from prometheus_client import REGISTRY
 
 
 class TestPopenAsUser:
@@ -24,6 +29,15 @@ class TestPopenAsUser:
 
         assert popen._token is None
 
+    def test_init_stores_job(self):
+        """Store the job object the process is assigned to."""
+        job = mock.Mock()
+
+        with mock.patch.object(subprocess.Popen, "__init__", return_value=None):
+            popen = win_utils.PopenAsUser(["python", "-c", "pass"], token=None, job=job)
+
+        assert popen._job is job
+
     def test_exit_detaches_token_if_present(self):
         """Detach token if one is stored."""
         token = mock.Mock()
@@ -55,3 +69,322 @@ class TestPopenAsUser:
 
         # Verify Popen.__init__ was called with expected args
         assert mock_popen_init.called
+
+    def test_init_passes_close_fds_and_keeps_handle_list(self):
+        """Pass close_fds to Popen, and keep the extra handles to inherit."""
+        mock_popen_init = mock.Mock(return_value=None)
+
+        with mock.patch.object(subprocess.Popen, "__init__", mock_popen_init):
+            popen = win_utils.PopenAsUser(["python"], token=None, handle_list=[8])
+
+        assert mock_popen_init.call_args[0][7] is True
+        assert popen._handle_list == (8,)
+
+
+class StartupInfo:
+    """win32process.STARTUPINFO stub."""
+
+    dwFlags = 0
+
+
+class Win32Handle:
+    """pywin32 PyHANDLE stub."""
+
+    def __init__(self, value):
+        """Initializes a Win32Handle wrapping the given value."""
+        self.value = value
+
+    def Detach(self):  # noqa: N802
+        return self.value
+
+
+class TestInheritedHandles:
+    """Tests for the handles inherited by the processes of PopenAsUser."""
+
+    STD_HANDLES = (subprocess.Handle(12), subprocess.Handle(16), subprocess.Handle(20))
+
+    def _execute(
+        self,
+        monkeypatch,
+        close_fds,
+        std_handles=(-1, -1, -1),
+        handle_list=(),
+        desktop=None,
+        job=None,
+        parent_std_handles=(None, None, None),
+        inheritable=(),
+        exit_code=259,
+        pin_error=None,
+    ):
+        calls = {}
+        std_handle_ids = (-10, -11, -12)
+
+        def create_process_as_user(token, executable, args, sa1, sa2, inherit, *rest):
+            calls["inherit"] = inherit
+            if getattr(rest[-1], "lpDesktop", None):
+                calls["desktop"] = rest[-1].lpDesktop
+            return Win32Handle(1), Win32Handle(2), 4242, 4243
+
+        def create_process_as_user_with_handles(token, executable, args, handles, *rest):
+            calls["handles"] = handles
+            return Win32Handle(1), Win32Handle(2), 4242, 4243
+
+        monkeypatch.setattr(win_utils.win32process, "STARTUPINFO", StartupInfo, raising=False)
+        monkeypatch.setattr(win_utils.win32process, "STARTF_USESTDHANDLES", 0x100, raising=False)
+        monkeypatch.setattr(
+            win_utils.win32process, "CreateProcessAsUser", create_process_as_user, raising=False
+        )
+        monkeypatch.setattr(
+            win_utils, "create_process_as_user_with_handles", create_process_as_user_with_handles
+        )
+        monkeypatch.setattr(win_utils.win32api, "CloseHandle", lambda handle: None, raising=False)
+        for name, std_handle in zip(("INPUT", "OUTPUT", "ERROR"), std_handle_ids):
+            monkeypatch.setattr(
+                win_utils.win32api, "STD_%s_HANDLE" % name, std_handle, raising=False
+            )
+        monkeypatch.setattr(
+            win_utils.win32api,
+            "GetStdHandle",
+            lambda std_handle: parent_std_handles[std_handle_ids.index(std_handle)],
+            raising=False,
+        )
+        monkeypatch.setattr(win_utils.win32con, "HANDLE_FLAG_INHERIT", 1, raising=False)
+        monkeypatch.setattr(
+            win_utils.win32api,
+            "GetHandleInformation",
+            lambda handle: int(handle in inheritable),
+            raising=False,
+        )
+        monkeypatch.setattr(
+            win_utils.win32event, "WaitForSingleObject", lambda handle, ms: 0, raising=False
+        )
+        monkeypatch.setattr(
+            win_utils.win32process, "GetExitCodeProcess", lambda handle: exit_code, raising=False
+        )
+        monkeypatch.setattr(win_utils.win32con, "STILL_ACTIVE", 259, raising=False)
+        monkeypatch.setattr(win_utils, "Handle", lambda value: value)
+        monkeypatch.setattr(
+            win_utils.win32job,
+            "AssignProcessToJobObject",
+            lambda job, process: calls.setdefault("job", job),
+            raising=False,
+        )
+
+        def pin_job(job, process):
+            if pin_error is not None:
+                raise pin_error
+            calls["pinned"] = job
+
+        monkeypatch.setattr(win_utils.job_utils, "pin_job", pin_job)
+        monkeypatch.setattr(
+            win_utils.win32process,
+            "ResumeThread",
+            lambda thread: calls.setdefault("resumed", True),
+            raising=False,
+        )
+        popen = win_utils.PopenAsUser.__new__(win_utils.PopenAsUser)
+        popen._token = None
+        popen._job = job
+        popen._handle_list = tuple(handle_list)
+        popen._desktop = desktop
+        p2cread, c2pwrite, errwrite = std_handles
+        popen.do_execute_child(
+            ["python"],
+            None,
+            None,
+            close_fds,
+            (),
+            None,
+            None,
+            None,
+            0,
+            False,
+            p2cread,
+            -1,
+            -1,
+            c2pwrite,
+            -1,
+            errwrite,
+        )
+        return calls
+
+    def test_only_std_handles_are_inherited(self, monkeypatch):
+        """Inherit only the std handles of the process with close_fds."""
+        calls = self._execute(monkeypatch, close_fds=True, std_handles=self.STD_HANDLES)
+
+        assert calls == {"handles": [12, 16, 20]}
+        assert all(handle.closed for handle in self.STD_HANDLES)
+
+    def test_nothing_is_inherited_without_std_handles(self, monkeypatch):
+        """Inherit no handles with close_fds when the std handles are not redirected."""
+        assert self._execute(monkeypatch, close_fds=True) == {"inherit": 0}
+
+    def test_handle_list_is_inherited_with_std_handles(self, monkeypatch):
+        """Inherit the given handles on top of the std handles."""
+        calls = self._execute(
+            monkeypatch, close_fds=True, std_handles=self.STD_HANDLES, handle_list=[24, 12]
+        )
+
+        assert calls == {"handles": [24, 12, 16, 20]}
+
+    def test_inheritable_std_handles_of_the_hub_are_inherited(self, monkeypatch):
+        """Inherit the inheritable std handles of the calling process if they are not redirected."""
+        calls = self._execute(
+            monkeypatch, close_fds=True, parent_std_handles=(28, 32, 7), inheritable=(28, 7)
+        )
+
+        assert calls == {"handles": [28]}
+
+    def test_handle_list_is_inherited_with_std_handles_without_close_fds(self, monkeypatch):
+        """Inherit the given handles and the std handles only when close_fds is False."""
+        calls = self._execute(
+            monkeypatch, close_fds=False, std_handles=self.STD_HANDLES, handle_list=[24]
+        )
+
+        assert calls == {"handles": [24, 12, 16, 20]}
+
+    def test_handle_list_is_inherited_with_hub_std_handles_without_close_fds(self, monkeypatch):
+        """Inherit the given handles and the inheritable std handles of the calling process."""
+        calls = self._execute(
+            monkeypatch,
+            close_fds=False,
+            handle_list=[24],
+            parent_std_handles=(28, None, 32),
+            inheritable=(28, 32),
+        )
+
+        assert calls == {"handles": [24, 28, 32]}
+
+    def test_all_handles_are_inherited_without_close_fds(self, monkeypatch):
+        """Inherit all inheritable handles without close_fds."""
+        assert self._execute(monkeypatch, close_fds=False) == {"inherit": 1}
+
+    def test_process_is_started_in_the_given_desktop(self, monkeypatch):
+        """Start the process in the desktop given to PopenAsUser."""
+        calls = self._execute(monkeypatch, close_fds=True, desktop="jupyterhub-0\\jupyterhub-1")
+
+        assert calls == {"inherit": 0, "desktop": "jupyterhub-0\\jupyterhub-1"}
+
+    def test_job_is_pinned_into_the_process(self, monkeypatch):
+        """Assign the process to its job, and keep the job alive in the process."""
+        calls = self._execute(monkeypatch, close_fds=True, job="job")
+
+        assert calls == {"inherit": 0, "job": "job", "pinned": "job", "resumed": True}
+
+    def test_failure_to_pin_the_job_is_reported_as_such(self, monkeypatch, caplog):
+        """Start the process in its job, warning that the job cannot be found after a restart."""
+        error = pywintypes.error(5, "DuplicateHandle", "Access is denied.")
+
+        with caplog.at_level("WARNING", logger="winlocalprocessspawner"):
+            calls = self._execute(monkeypatch, close_fds=True, job="job", pin_error=error)
+
+        assert calls == {"inherit": 0, "job": "job", "resumed": True}
+        assert "Failed to pin the job object of process 4242" in caplog.text
+        assert "assign" not in caplog.text
+
+    def test_early_exit_is_logged(self, monkeypatch, caplog):
+        """Log the exit code of a process that exits within its first second."""
+        monkeypatch.setattr(
+            win_utils.win32api, "GetLastError", lambda: pytest.fail("stale error"), raising=False
+        )
+
+        with caplog.at_level("ERROR", logger="winlocalprocessspawner"):
+            self._execute(monkeypatch, close_fds=True, exit_code=3)
+
+        assert "ExitCode 3 " in caplog.text
+
+    def test_filter_handle_list_drops_duplicates_null_and_console_handles(self):
+        """Keep only the handles that can be in an inherited handle list."""
+        assert win_utils.filter_handle_list([8, None, 0, 8, 7, subprocess.Handle(12)]) == [8, 12]
+
+    def test_handles_and_sizes_are_passed_as_pointer_sized_arguments(self):
+        """Declare the prototypes of the ctypes calls, so that 64-bit values are not truncated."""
+        update = win_utils._kernel32.UpdateProcThreadAttribute.argtypes
+        create = win_utils._advapi32.CreateProcessAsUserW.argtypes
+
+        assert (update[2], update[4]) == (ctypes.c_size_t, ctypes.c_size_t)
+        assert create[0] is wintypes.HANDLE
+        assert len(create) == 11
+        assert win_utils.job_utils._ntdll.NtSuspendProcess.argtypes == [wintypes.HANDLE]
+        assert win_utils.job_utils._ntdll.NtResumeProcess.argtypes == [wintypes.HANDLE]
+        assert win_utils.job_utils._kernel32.QueryInformationJobObject.argtypes[0] is (
+            wintypes.HANDLE
+        )
+
+    def test_environment_block(self):
+        """Build the environment block of CreateProcess."""
+        assert win_utils.environment_block({"A": "1", "B": "2"}) == "A=1\0B=2\0\0"
+
+
+class TestCreateProcessRetries:
+    """Tests for the retries of the transient CreateProcessAsUser failures."""
+
+    @pytest.fixture
+    def popen(self, monkeypatch):
+        """Returns a PopenAsUser whose CreateProcessAsUser first raises popen.errors."""
+        popen = win_utils.PopenAsUser.__new__(win_utils.PopenAsUser)
+        popen._token = None
+        popen._retries = 3
+        popen._retry_delay = 0.5
+        popen.errors = []
+        popen.calls = []
+        popen.sleeps = []
+
+        def create_process_as_user(*args):
+            popen.calls.append(args)
+            if len(popen.calls) <= len(popen.errors):
+                raise popen.errors[len(popen.calls) - 1]
+            return Win32Handle(1), Win32Handle(2), 4242, 4243
+
+        monkeypatch.setattr(
+            win_utils.win32process, "CreateProcessAsUser", create_process_as_user, raising=False
+        )
+        monkeypatch.setattr(win_utils.time, "sleep", popen.sleeps.append)
+        return popen
+
+    def _create_process(self, popen):
+        return popen._create_process("python", "python", True, (), 0, None, None, None)
+
+    def test_transient_error_is_retried(self, popen):
+        """Retry once after a quota error, waiting at most retry_delay."""
+        popen.errors = [pywintypes.error(1816, "CreateProcessAsUser", "Not enough quota.")]
+
+        assert self._create_process(popen)[2] == 4242
+        assert len(popen.calls) == 2
+        assert len(popen.sleeps) == 1 and 0 <= popen.sleeps[0] <= 0.5
+
+    def test_permanent_error_is_not_retried(self, popen):
+        """Raise access denied errors without retrying."""
+        popen.errors = [pywintypes.error(5, "CreateProcessAsUser", "Access is denied.")]
+
+        with pytest.raises(pywintypes.error):
+            self._create_process(popen)
+
+        assert len(popen.calls) == 1
+        assert popen.sleeps == []
+
+    def test_retries_are_bounded(self, popen):
+        """Raise the transient error once the retries are exhausted."""
+        popen._retries = 2
+        popen.errors = [
+            pywintypes.error(1450, "CreateProcessAsUser", "Insufficient resources.")
+        ] * 3
+
+        with pytest.raises(pywintypes.error):
+            self._create_process(popen)
+
+        assert len(popen.calls) == 3
+        assert len(popen.sleeps) == 2
+
+    def test_errors_are_counted_by_class(self, popen):
+        """Count the failures by error class and error."""
+        sample = (
+            "winlocalprocessspawner_create_process_errors_total",
+            {"error_class": "transient", "error": "ERROR_SHARING_VIOLATION"},
+        )
+        before = REGISTRY.get_sample_value(*sample) or 0
+        popen.errors = [pywintypes.error(32, "CreateProcessAsUser", "In use.")] * 2
+
+        self._create_process(popen)
+
+        assert REGISTRY.get_sample_value(*sample) == before + 2
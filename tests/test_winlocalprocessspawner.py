@@ -7,9 +7,22 @@ reside in test_winlocalprocessspawner_ported.py.
 import asyncio
 import subprocess
 import sys
+import threading
+from datetime import datetime, timedelta
 
 import pytest
+import winlocalprocessspawner.launcher as launcher
 import winlocalprocessspawner.winlocalprocessspawner as wps
+from prometheus_client import REGISTRY
+from tornado import web
+from winlocalprocessspawner.authstate import AuthStateCache
+from winlocalprocessspawner.crashloop import CrashLoopTracker
+from winlocalprocessspawner.hostpressure import HostPressure
+from winlocalprocessspawner.journal import SpawnJournal
+from winlocalprocessspawner.launcher import KEY_ENV_VAR
+from winlocalprocessspawner.ratelimit import SpawnRateLimiter
+
+from .test_launcher import FakeLaunches, start_service
 
 
 class DummyLog:
@@ -19,6 +32,9 @@ class DummyLog:
         """Initializes DummyLog with an empty list of messages."""
         self.messages = []
 
+    def debug(self, msg, *args):
+        self.messages.append(("debug", msg, args))
+
     def info(self, msg, *args):
         self.messages.append(("info", msg, args))
 
@@ -30,17 +46,22 @@ class DummyLog:
 
 
 class DummyToken:
-    """Simple token stub that records detach calls."""
+    """Simple token stub that records detach and close calls."""
 
     def __init__(self, value):
-        """Initializes a DummyToken with given value, and which has not been detached."""
+        """Initializes a DummyToken with given value, and which has not been detached or closed."""
         self.value = value
         self.detached = 0
+        self.closed = 0
 
     def Detach(self):  # noqa: N802
         """Increment the detach counter."""
         self.detached += 1
 
+    def Close(self):  # noqa: N802
+        """Increment the close counter."""
+        self.closed += 1
+
 
 class DummyHandleFactory:
     """Pywin32 HANDLE factory stub."""
@@ -55,6 +76,23 @@ class DummyHandleFactory:
         return token
 
 
+class DummyDuplicateHandle:
+    """Pywin32 DuplicateHandle stub, duplicating DummyTokens."""
+
+    def __init__(self):
+        """Initializes DummyDuplicateHandle with an empty list of duplicated tokens."""
+        self.created = []
+
+    def __call__(self, source_process, handle, target_process, access, inherit, options):
+        token = DummyToken(handle.value)
+        self.created.append(token)
+        return token
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(wps.token_utils.win32api, "GetCurrentProcess", lambda: -1)
+        monkeypatch.setattr(wps.token_utils.win32api, "DuplicateHandle", self)
+
+
 class DummyUser:
     """Minimal user object used by tests."""
 
@@ -78,6 +116,16 @@ class DummyDB:
         self.commit_calls += 1
 
 
+class DummyORMSpawner:
+    """Holds the last activity recorded by the Hub for the default server."""
+
+    def __init__(self, last_activity):
+        """Initializes DummyORMSpawner with the given last activity."""
+        self.name = ""
+        self.server = None
+        self.last_activity = last_activity
+
+
 class DummyServer:
     """Server state holder."""
 
@@ -96,6 +144,8 @@ def make_spawner(auth_state=None):
     spawner.log = DummyLog()
     spawner.notebook_dir = ""
     spawner.popen_kwargs = {"creationflags": 1}
+    # the profile environments are stubbed through CreateEnvironmentBlock
+    spawner.load_user_profile = False
     spawner.ip = "127.0.0.1"
     spawner.server = DummyServer()
     spawner.db = DummyDB()
@@ -143,6 +193,8 @@ def test_start_uses_userprofile_as_cwd_when_notebook_dir_unset(monkeypatch):
 
     monkeypatch.setattr(wps, "random_port", lambda: 9999)
     monkeypatch.setattr(wps.pywintypes, "HANDLE", handle_factory)
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
     monkeypatch.setattr(
         wps.win32profile,
         "CreateEnvironmentBlock",
@@ -169,6 +221,12 @@ def test_start_uses_userprofile_as_cwd_when_notebook_dir_unset(monkeypatch):
     assert created_token.value == 123
     assert created_token.detached == 1
 
+    # the process is created with a duplicate of the token, closed once the process is created
+    duplicated_token = duplicate_handle.created[0]
+    assert kwargs["token"] is duplicated_token
+    assert duplicated_token.value == 123
+    assert duplicated_token.closed == 1
+
 
 def test_start_preserves_get_env_vars_not_present_in_user_env(monkeypatch):
     """Vars set by get_env() that are absent from user_env must survive the merge.
@@ -192,6 +250,8 @@ def test_start_preserves_get_env_vars_not_present_in_user_env(monkeypatch):
 
     monkeypatch.setattr(wps, "random_port", lambda: 9998)
     monkeypatch.setattr(wps.pywintypes, "HANDLE", handle_factory)
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
     monkeypatch.setattr(
         wps.win32profile,
         "CreateEnvironmentBlock",
@@ -240,6 +300,8 @@ def test_start_cwd_uses_userprofile_from_profile_env(monkeypatch):
 
     monkeypatch.setattr(wps, "random_port", lambda: 9997)
     monkeypatch.setattr(wps.pywintypes, "HANDLE", handle_factory)
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
     monkeypatch.setattr(
         wps.win32profile,
         "CreateEnvironmentBlock",
@@ -322,13 +384,15 @@ def test_start_falls_back_to_tempdir_when_user_env_load_fails(monkeypatch):
     assert "Failed to load user environment" in warning_logs[0][1]
 
 
-def test_start_permission_error_logs_and_detaches_token(monkeypatch):
-    """Start should log permission errors and detach token before re-raising."""
+def test_start_permission_error_logs_and_releases_token(monkeypatch):
+    """Start should log permission errors and release the tokens before re-raising."""
     spawner = make_spawner(auth_state={"auth_token": 456})
     handle_factory = DummyHandleFactory()
 
     monkeypatch.setattr(wps, "random_port", lambda: 7777)
     monkeypatch.setattr(wps.pywintypes, "HANDLE", handle_factory)
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
     monkeypatch.setattr(
         wps.win32profile,
         "CreateEnvironmentBlock",
@@ -352,6 +416,1389 @@ def test_start_permission_error_logs_and_detaches_token(monkeypatch):
 
     created_token = handle_factory.created[0]
     assert created_token.detached == 1
+    assert duplicate_handle.created[0].closed == 1
+
+
+def test_start_failure_releases_token_job_profile_and_desktop(monkeypatch):
+    """Start should release everything acquired for the launch whatever the error."""
+    spawner = make_spawner(auth_state={"auth_token": 456})
+    spawner.dedicated_desktops = True
+    spawner.desktop_heap_size = 4096
+    spawner.desktop_max_servers = 100
+    desktops = TestDedicatedDesktops.RecordingDesktops()
+    monkeypatch.setattr(wps, "_desktops", desktops)
+    released = []
+    monkeypatch.setattr(spawner, "_release_profile", lambda: released.append(True))
+    jobs = []
+
+    def fake_create_job():
+        spawner._job = DummyJob()
+        jobs.append(spawner._job)
+        return spawner._job
+
+    monkeypatch.setattr(spawner, "_create_job", fake_create_job)
+    monkeypatch.setattr(wps, "random_port", lambda: 7777)
+    monkeypatch.setattr(wps.pywintypes, "HANDLE", DummyHandleFactory())
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
+    monkeypatch.setattr(wps.win32profile, "CreateEnvironmentBlock", lambda token, _: None)
+    monkeypatch.setattr(
+        wps,
+        "PopenAsUser",
+        lambda *args, **kwargs: (_ for _ in ()).throw(FileNotFoundError("python.exe")),
+    )
+
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(spawner.start())
+
+    assert duplicate_handle.created[0].closed == 1
+    assert jobs[0].closed
+    assert released == [True]
+    assert desktops.servers == set()
+
+
+def test_concurrent_starts_of_named_servers_use_their_own_tokens(monkeypatch):
+    """Named servers of one user launch concurrently, each with its own duplicated token."""
+
+    class NamedSpawner(wps.WinLocalProcessSpawner):
+        name = ""
+
+    first = make_spawner(auth_state={"auth_token": 123})
+    second = make_spawner()
+    second.user = first.user
+    for spawner, name in [(first, "first"), (second, "second")]:
+        spawner.__class__ = NamedSpawner
+        spawner.name = name
+    duplicate_handle = DummyDuplicateHandle()
+    duplicate_handle.install(monkeypatch)
+
+    popen_tokens = []
+
+    def fake_popen(cmd, **kwargs):
+        popen_tokens.append(kwargs["token"])
+        return subprocess.Popen([sys.executable, "-c", "raise SystemExit(0)"])
+
+    monkeypatch.setattr(wps, "random_port", lambda: 9994)
+    monkeypatch.setattr(wps.pywintypes, "HANDLE", DummyHandleFactory())
+    monkeypatch.setattr(wps.win32profile, "CreateEnvironmentBlock", lambda token, _: None)
+    monkeypatch.setattr(wps, "PopenAsUser", fake_popen)
+
+    async def start_both():
+        return await asyncio.gather(first.start(), second.start())
+
+    asyncio.run(start_both())
+
+    assert len(popen_tokens) == 2
+    assert popen_tokens[0] is not popen_tokens[1]
+    assert [token.closed for token in duplicate_handle.created] == [1, 1]
+
+
+class TestTrimIdleServers:
+    """Tests for the batched working set trimming of idle servers."""
+
+    def _make_spawner(self, idle_seconds, job):
+        spawner = make_spawner()
+        spawner.trim_idle_working_set_after = 600
+        spawner.trim_min_working_set = 1000
+        spawner.orm_spawner = DummyORMSpawner(datetime.utcnow() - timedelta(seconds=idle_seconds))
+        spawner._job = job
+        return spawner
+
+    def test_trims_only_servers_idle_for_long_enough(self, monkeypatch):
+        trimmed = []
+
+        def fake_trim_job(job, min_working_set):
+            trimmed.append((job, min_working_set))
+            return 4096
+
+        monkeypatch.setattr(wps.job_utils, "trim_job", fake_trim_job)
+        idle = self._make_spawner(idle_seconds=3600, job="idle-job")
+        busy = self._make_spawner(idle_seconds=10, job="busy-job")
+
+        asyncio.run(wps._trim_idle_servers([idle, busy]))
+
+        assert trimmed == [("idle-job", 1000)]
+        assert any(entry[0] == "debug" for entry in idle.log.messages)
+
+    def test_skips_servers_without_job_or_activity(self, monkeypatch):
+        trimmed = []
+        monkeypatch.setattr(
+            wps.job_utils, "trim_job", lambda job, min_working_set: trimmed.append(job)
+        )
+        no_job = self._make_spawner(idle_seconds=3600, job=None)
+        no_activity = self._make_spawner(idle_seconds=3600, job="job")
+        no_activity.orm_spawner = None
+
+        asyncio.run(wps._trim_idle_servers([no_job, no_activity]))
+
+        assert trimmed == []
+
+    def test_server_whose_job_was_closed_does_not_fail_the_pass(self, monkeypatch):
+        def fake_trim_job(job, min_working_set):
+            if job == "closed-job":
+                raise wps.pywintypes.error(6, "QueryInformationJobObject", "The handle is invalid.")
+            return 4096
+
+        monkeypatch.setattr(wps.job_utils, "trim_job", fake_trim_job)
+        closed = self._make_spawner(idle_seconds=3600, job="closed-job")
+        idle = self._make_spawner(idle_seconds=3600, job="idle-job")
+
+        asyncio.run(wps._trim_idle_servers([closed, idle]))
+
+        assert not any(entry[0] == "debug" for entry in closed.log.messages)
+        assert any(entry[0] == "debug" for entry in idle.log.messages)
+
+
+def job_accounting(cpu_seconds, memory_bytes=1000):
+    """Return a job_utils.get_job_accounting result."""
+    return {
+        "cpu_seconds": cpu_seconds,
+        "io_read_bytes": 10,
+        "io_write_bytes": 20,
+        "io_other_bytes": 30,
+        "active_processes": 2,
+        "peak_memory_bytes": 2000,
+        "memory_bytes": memory_bytes,
+    }
+
+
+class TestResourceSampling:
+    """Tests for the batched sampling of the resource usage of running servers."""
+
+    def _make_spawner(self, job):
+        spawner = make_spawner()
+        spawner._job = job
+        return spawner
+
+    def test_samples_all_servers_with_a_job(self, monkeypatch):
+        sampled = []
+
+        def get_job_accounting(job):
+            sampled.append(job)
+            return job_accounting(cpu_seconds=5)
+
+        monkeypatch.setattr(wps.job_utils, "get_job_accounting", get_job_accounting)
+        running = self._make_spawner(job="job")
+        no_job = self._make_spawner(job=None)
+
+        asyncio.run(wps._sample_servers([running, no_job]))
+
+        assert sampled == ["job"]
+        assert running.resource_usage["cpu_seconds"] == 5
+        assert running.resource_usage["cpu_percent"] is None
+        assert no_job.resource_usage is None
+        assert (
+            REGISTRY.get_sample_value(
+                "winlocalprocessspawner_server_io_bytes",
+                {"user": "alice", "server": "", "operation": "write"},
+            )
+            == 20
+        )
+        running._clear_resource_usage()
+
+    def test_cpu_percent_is_computed_between_two_samples(self):
+        spawner = self._make_spawner(job="job")
+
+        spawner._record_resource_usage(job_accounting(cpu_seconds=5), sampled_at=100)
+        spawner._record_resource_usage(job_accounting(cpu_seconds=8), sampled_at=110)
+
+        assert spawner.resource_usage["cpu_percent"] == pytest.approx(30)
+        spawner._clear_resource_usage()
+
+    def test_stopping_monitoring_clears_usage_and_metrics(self):
+        spawner = self._make_spawner(job="job")
+        spawner._record_resource_usage(job_accounting(cpu_seconds=5, memory_bytes=None), 100)
+
+        spawner._stop_monitoring()
+
+        assert spawner.resource_usage is None
+        assert (
+            REGISTRY.get_sample_value(
+                "winlocalprocessspawner_server_cpu_seconds", {"user": "alice", "server": ""}
+            )
+            is None
+        )
+
+    def test_server_whose_job_was_closed_does_not_fail_the_pass(self, monkeypatch):
+        def get_job_accounting(job):
+            if job == "closed-job":
+                raise wps.pywintypes.error(6, "QueryInformationJobObject", "The handle is invalid.")
+            return job_accounting(cpu_seconds=5)
+
+        monkeypatch.setattr(wps.job_utils, "get_job_accounting", get_job_accounting)
+        closed = self._make_spawner(job="closed-job")
+        running = self._make_spawner(job="job")
+
+        asyncio.run(wps._sample_servers([closed, running]))
+
+        assert closed.resource_usage is None
+        assert running.resource_usage is not None
+        running._clear_resource_usage()
+
+
+class TestResourceIdleDetection:
+    """Tests for detecting idle servers from their resource samples."""
+
+    def _make_spawner(self):
+        spawner = make_spawner()
+        spawner._job = "job"
+        spawner.resource_sample_interval = 10
+        spawner.idle_sample_count = 2
+        spawner.idle_max_cpu_percent = 2
+        spawner.idle_max_io_rate = 1000
+        spawner.orm_spawner = DummyORMSpawner(datetime(2020, 1, 1))
+        return spawner
+
+    def _sample(self, spawner, sampled_at, cpu_seconds, io_bytes=0, processes=1):
+        usage = dict(
+            job_accounting(cpu_seconds), io_other_bytes=io_bytes, active_processes=processes
+        )
+        return spawner._record_resource_usage(usage, sampled_at)
+
+    def test_server_is_idle_after_enough_quiet_samples(self):
+        spawner = self._make_spawner()
+        self._sample(spawner, 100, cpu_seconds=5)
+
+        assert not self._sample(spawner, 110, cpu_seconds=5.1)
+        assert spawner.idle_since is None
+        assert not self._sample(spawner, 120, cpu_seconds=5.2)
+
+        assert spawner.idle_since == 100
+        assert spawner.is_idle()
+        spawner._clear_resource_usage()
+
+    @pytest.mark.parametrize(
+        "cpu_seconds, io_bytes, processes", [(8, 0, 1), (5, 50000, 1), (5, 0, 3)]
+    )
+    def test_busy_sample_resets_idleness_and_reports_activity(
+        self, cpu_seconds, io_bytes, processes
+    ):
+        spawner = self._make_spawner()
+        spawner.idle_max_processes = 2
+        spawner.idle_sample_count = 1
+        self._sample(spawner, 100, cpu_seconds=5)
+        self._sample(spawner, 110, cpu_seconds=5)
+        assert spawner.is_idle()
+
+        assert self._sample(spawner, 120, cpu_seconds, io_bytes, processes)
+
+        assert spawner.idle_since is None
+        spawner._clear_resource_usage()
+
+    def test_sampling_pass_reports_activity_of_busy_servers(self, monkeypatch):
+        cpu_seconds = iter([5, 9])
+        monkeypatch.setattr(
+            wps.job_utils,
+            "get_job_accounting",
+            lambda job: job_accounting(cpu_seconds=next(cpu_seconds)),
+        )
+        monkeypatch.setattr(wps.time, "time", iter([100, 110]).__next__)
+        spawner = self._make_spawner()
+
+        asyncio.run(wps._sample_servers([spawner]))
+        asyncio.run(wps._sample_servers([spawner]))
+
+        assert spawner.orm_spawner.last_activity > datetime(2020, 1, 1)
+        assert spawner.user.last_activity == spawner.orm_spawner.last_activity
+        assert spawner.db.commit_calls == 1
+        spawner._clear_resource_usage()
+
+    def test_idle_detection_is_disabled_by_default(self):
+        spawner = make_spawner()
+        spawner._record_resource_usage(job_accounting(cpu_seconds=5), 100)
+
+        assert not spawner._record_resource_usage(job_accounting(cpu_seconds=9), 110)
+        assert spawner.idle_since is None
+        spawner._clear_resource_usage()
+
+
+class DummyJob:
+    """Job object handle stub."""
+
+    def __init__(self):
+        """Initializes a DummyJob which has not been closed."""
+        self.closed = False
+
+    def Close(self):  # noqa: N802
+        self.closed = True
+
+
+class DummyProc(subprocess.Popen):
+    """Popen stub for a process that is still running."""
+
+    pid = 4242
+
+    def __init__(self):
+        """Initializes DummyProc without starting any process."""
+
+    def poll(self):
+        return None
+
+
+class TestSuspendIdleServers:
+    """Tests for suspending idle servers and resuming them on start."""
+
+    def _make_spawner(self, idle_seconds=3600):
+        spawner = make_spawner()
+        spawner.suspend_idle_after = 600
+        spawner.orm_spawner = DummyORMSpawner(datetime.utcnow() - timedelta(seconds=idle_seconds))
+        spawner.orm_spawner.state = None
+        spawner._job_id = "job-id"
+        spawner.proc = DummyProc()
+        spawner.pid = DummyProc.pid
+        spawner.port = 8888
+        spawner.api_token = "api-token"
+        spawner._job = DummyJob()
+        return spawner
+
+    def test_suspends_idle_servers_and_reports_them_stopped(self, monkeypatch):
+        suspended = []
+        monkeypatch.setattr(wps.job_utils, "suspend_job", suspended.append)
+        idle = self._make_spawner(idle_seconds=3600)
+        busy = self._make_spawner(idle_seconds=10)
+
+        asyncio.run(wps._suspend_idle_servers([idle, busy]))
+
+        assert suspended == [idle._job]
+        assert asyncio.run(idle.poll()) == 0
+        assert asyncio.run(busy.poll()) is None
+        assert idle.will_resume
+
+    def test_state_of_suspended_server_survives_clear_state(self, monkeypatch):
+        monkeypatch.setattr(wps.job_utils, "suspend_job", lambda job: 0)
+        spawner = self._make_spawner()
+
+        asyncio.run(wps._suspend_idle_servers([spawner]))
+        spawner.clear_state()
+        state = spawner.get_state()
+
+        assert state["pid"] == DummyProc.pid
+        assert state["job_id"] == "job-id"
+        assert state["port"] == 8888
+        assert "suspended_since" in state
+
+    def test_start_resumes_suspended_server_with_its_api_token(self, monkeypatch):
+        resumed = []
+        monkeypatch.setattr(wps.job_utils, "suspend_job", lambda job: 0)
+        monkeypatch.setattr(wps.job_utils, "resume_job", resumed.append)
+        monkeypatch.setattr(
+            wps, "PopenAsUser", lambda *args, **kwargs: pytest.fail("server was relaunched")
+        )
+        spawner = self._make_spawner()
+
+        asyncio.run(wps._suspend_idle_servers([spawner]))
+        spawner.api_token = "new-api-token-from-hub"
+        ip, port = asyncio.run(spawner.start())
+
+        assert (ip, port) == ("127.0.0.1", 8888)
+        assert resumed == [spawner._job]
+        assert spawner.api_token == "api-token"
+        assert not spawner.will_resume
+        assert asyncio.run(spawner.poll()) is None
+
+    def test_suspended_server_is_terminated_after_suspended_timeout(self, monkeypatch):
+        terminated = []
+        monkeypatch.setattr(wps.job_utils, "suspend_job", lambda job: 0)
+        monkeypatch.setattr(wps.job_utils, "terminate_job", terminated.append)
+        spawner = self._make_spawner()
+        spawner.suspended_timeout = 60
+        job = spawner._job
+
+        asyncio.run(wps._suspend_idle_servers([spawner]))
+        spawner._suspended_since -= 120
+        asyncio.run(wps._suspend_idle_servers([spawner]))
+
+        assert terminated == [job]
+        assert job.closed
+        assert "suspended_since" not in spawner.get_state()
+
+
+class TestSpawnRateLimits:
+    """Tests for the spawn rate limits applied by start()."""
+
+    def test_rejects_launches_over_the_user_limit_with_retry_after(self, monkeypatch):
+        monkeypatch.setattr(wps, "_spawn_rate_limiter", SpawnRateLimiter())
+        spawner = make_spawner()
+        spawner.user_spawn_rate_limit = 1
+        spawner.user_spawn_burst = 1
+
+        asyncio.run(spawner._acquire_spawn_rate_limits())
+        with pytest.raises(web.HTTPError) as exc_info:
+            asyncio.run(spawner._acquire_spawn_rate_limits())
+
+        assert exc_info.value.status_code == 429
+        assert 55 <= int(exc_info.value.headers["Retry-After"]) <= 60
+
+    def test_defers_launches_that_can_wait_for_a_token(self, monkeypatch):
+        monkeypatch.setattr(wps, "_spawn_rate_limiter", SpawnRateLimiter())
+        slept = []
+
+        async def fake_sleep(seconds):
+            slept.append(seconds)
+            wps._spawn_rate_limiter._buckets.clear()
+
+        monkeypatch.setattr(wps.asyncio, "sleep", fake_sleep)
+        spawner = make_spawner()
+        spawner.global_spawn_rate_limit = 60
+        spawner.global_spawn_burst = 1
+        spawner.spawn_rate_limit_max_wait = 5
+
+        asyncio.run(spawner._acquire_spawn_rate_limits())
+        asyncio.run(spawner._acquire_spawn_rate_limits())
+
+        assert len(slept) == 1
+        assert 0 < slept[0] <= 1
+
+    def test_users_do_not_share_user_limits(self, monkeypatch):
+        monkeypatch.setattr(wps, "_spawn_rate_limiter", SpawnRateLimiter())
+        alice = make_spawner()
+        bob = make_spawner()
+        bob.user = DummyUser("bob", None)
+        for spawner in (alice, bob):
+            spawner.user_spawn_rate_limit = 1
+            spawner.user_spawn_burst = 1
+
+        asyncio.run(alice._acquire_spawn_rate_limits())
+        asyncio.run(bob._acquire_spawn_rate_limits())
+
+
+class ExitedProc(subprocess.Popen):
+    """Popen stub for a process that exited with an error."""
+
+    pid = 4242
+
+    def __init__(self):
+        """Initializes ExitedProc without starting any process."""
+
+    def poll(self):
+        return 1
+
+
+class DummyHostPressure:
+    """HostPressureSampler stub returning the given samples, then repeating the last one."""
+
+    def __init__(self, *samples):
+        """Initializes DummyHostPressure with the HostPressures to return."""
+        self.samples = list(samples)
+
+    def sample(self):
+        if len(self.samples) > 1:
+            return self.samples.pop(0)
+        return self.samples[0]
+
+
+CALM = HostPressure(available_memory=8 * 2**30, commit=10, commit_limit=100, cpu_percent=20)
+COMMIT_PRESSURE = CALM._replace(commit=95)
+
+
+class TestHostPressure:
+    """Tests for the host pressure admission control applied by start()."""
+
+    def _make_spawner(self, monkeypatch, *samples):
+        monkeypatch.setattr(wps, "_host_pressure", DummyHostPressure(*samples))
+        spawner = make_spawner()
+        spawner.host_max_commit_percent = 90
+        return spawner
+
+    def test_launch_is_admitted_under_the_thresholds(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, CALM)
+
+        asyncio.run(spawner._wait_for_host_capacity())
+
+        assert (
+            REGISTRY.get_sample_value(
+                "winlocalprocessspawner_host_commit_bytes", {"host": "localhost"}
+            )
+            == 10
+        )
+
+    def test_launch_is_rejected_with_retry_after_when_action_is_reject(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, COMMIT_PRESSURE)
+        spawner.host_pressure_action = "reject"
+
+        with pytest.raises(web.HTTPError) as exc_info:
+            asyncio.run(spawner._wait_for_host_capacity())
+
+        assert exc_info.value.status_code == 503
+        assert exc_info.value.headers["Retry-After"] == "30"
+
+    def test_launch_is_queued_until_the_pressure_goes_down(self, monkeypatch):
+        slept = []
+
+        async def fake_sleep(seconds):
+            slept.append(seconds)
+
+        monkeypatch.setattr(wps.asyncio, "sleep", fake_sleep)
+        spawner = self._make_spawner(monkeypatch, COMMIT_PRESSURE, COMMIT_PRESSURE, CALM)
+
+        asyncio.run(spawner._wait_for_host_capacity())
+
+        assert len(slept) == 2
+        assert [entry[0] for entry in spawner.log.messages] == ["info"]
+
+    def test_queued_launch_is_rejected_after_max_wait(self, monkeypatch):
+        async def fake_sleep(seconds):
+            pass
+
+        clock = iter(range(0, 1000, 10))
+        monkeypatch.setattr(wps.asyncio, "sleep", fake_sleep)
+        monkeypatch.setattr(wps.time, "monotonic", lambda: next(clock))
+        spawner = self._make_spawner(monkeypatch, COMMIT_PRESSURE)
+        spawner.host_pressure_max_wait = 30
+
+        with pytest.raises(web.HTTPError) as exc_info:
+            asyncio.run(spawner._wait_for_host_capacity())
+
+        assert exc_info.value.status_code == 503
+
+    def test_host_is_not_sampled_without_thresholds(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, COMMIT_PRESSURE)
+        spawner.host_max_commit_percent = 0
+
+        asyncio.run(spawner._wait_for_host_capacity())
+
+
+class TestCrashLoopBackoff:
+    """Tests for the crash loop backoff of servers exiting right after being started."""
+
+    def _make_spawner(self, proc, uptime):
+        spawner = make_spawner()
+        spawner.proc = proc
+        spawner.pid = proc.pid
+        spawner._started_at = wps.time.monotonic() - uptime
+        return spawner
+
+    def test_early_exit_rejects_next_start_with_retry_after(self, monkeypatch):
+        monkeypatch.setattr(wps, "_crash_loops", CrashLoopTracker())
+        spawner = self._make_spawner(ExitedProc(), uptime=2)
+
+        assert asyncio.run(spawner.poll()) == 1
+        with pytest.raises(web.HTTPError) as exc_info:
+            asyncio.run(spawner.start())
+
+        assert exc_info.value.status_code == 503
+        assert 1 <= int(exc_info.value.headers["Retry-After"]) <= 10
+        assert spawner.get_state()["crash_loop"]["early_exits"] == 1
+
+    def test_late_exit_is_not_an_early_exit(self, monkeypatch):
+        monkeypatch.setattr(wps, "_crash_loops", CrashLoopTracker())
+        spawner = self._make_spawner(ExitedProc(), uptime=120)
+
+        asyncio.run(spawner.poll())
+
+        assert "crash_loop" not in spawner.get_state()
+
+    def test_server_staying_up_resets_backoff(self, monkeypatch):
+        tracker = CrashLoopTracker()
+        tracker.record_early_exit(("alice", ""))
+        monkeypatch.setattr(wps, "_crash_loops", tracker)
+        spawner = self._make_spawner(DummyProc(), uptime=120)
+
+        assert asyncio.run(spawner.poll()) is None
+
+        assert tracker.early_exits(("alice", "")) == 0
+
+    def test_exit_caused_by_stop_is_not_an_early_exit(self, monkeypatch):
+        monkeypatch.setattr(wps, "_crash_loops", CrashLoopTracker())
+        monkeypatch.setattr(
+            wps.LocalProcessSpawner, "stop", lambda self, now=False: asyncio.sleep(0)
+        )
+        spawner = self._make_spawner(ExitedProc(), uptime=2)
+
+        asyncio.run(spawner.stop())
+        asyncio.run(spawner.poll())
+
+        assert "crash_loop" not in spawner.get_state()
+
+
+class TestAuthStateCache:
+    """Tests for the auth_state cache used by start()."""
+
+    class CountingUser(DummyUser):
+        """DummyUser with an encrypted auth_state, counting decryptions."""
+
+        encrypted_auth_state = b"encrypted"
+        decrypted = 0
+
+        async def get_auth_state(self):
+            self.decrypted += 1
+            return await super().get_auth_state()
+
+    def test_repeated_spawns_decrypt_auth_state_once(self, monkeypatch):
+        monkeypatch.setattr(wps, "_auth_state_cache", AuthStateCache())
+        user = self.CountingUser("alice", {"auth_token": 123})
+        spawners = [make_spawner(), make_spawner()]
+        for spawner in spawners:
+            spawner.user = user
+
+        for spawner in spawners:
+            assert asyncio.run(spawner._get_auth_state()) == {"auth_token": 123}
+
+        assert user.decrypted == 1
+
+    def test_spawn_uses_the_auth_state_given_to_the_hook(self, monkeypatch):
+        monkeypatch.setattr(wps, "_auth_state_cache", AuthStateCache())
+        spawner = make_spawner()
+        spawner.user = user = self.CountingUser("alice", {"auth_token": 123})
+        hooked = []
+        spawner.auth_state_hook = lambda spawner, auth_state: hooked.append(auth_state)
+
+        async def spawn():
+            await spawner.run_auth_state_hook({"auth_token": 456, "other": "field"})
+            return await spawner._get_auth_state(), await spawner._get_auth_state()
+
+        assert asyncio.run(spawn()) == ({"auth_token": 456}, {"auth_token": 123})
+        assert hooked == [{"auth_token": 456, "other": "field"}]
+        # only the start without a hook value fell back to the cache
+        assert user.decrypted == 1
+
+    def test_clear_auth_state_cache_forces_decryption(self, monkeypatch):
+        monkeypatch.setattr(wps, "_auth_state_cache", AuthStateCache())
+        spawner = make_spawner()
+        spawner.user = user = self.CountingUser("alice", {"auth_token": 123})
+
+        asyncio.run(spawner._get_auth_state())
+        wps.WinLocalProcessSpawner.clear_auth_state_cache("alice")
+        asyncio.run(spawner._get_auth_state())
+
+        assert user.decrypted == 2
+
+
+class TestCoalescedStarts:
+    """Tests for the deduplication of overlapping start() calls."""
+
+    def test_overlapping_starts_share_one_launch(self, monkeypatch):
+        spawner = make_spawner()
+        popen_calls = []
+
+        def fake_popen(cmd, **kwargs):
+            popen_calls.append(cmd)
+            return subprocess.Popen([sys.executable, "-c", "raise SystemExit(0)"])
+
+        monkeypatch.setattr(wps, "random_port", lambda: 9995)
+        monkeypatch.setattr(wps.win32profile, "CreateEnvironmentBlock", lambda token, _: None)
+        monkeypatch.setattr(wps, "PopenAsUser", fake_popen)
+
+        async def start_twice():
+            return await asyncio.gather(spawner.start(), spawner.start())
+
+        results = asyncio.run(start_twice())
+
+        assert results == [("127.0.0.1", 9995), ("127.0.0.1", 9995)]
+        assert len(popen_calls) == 1
+        assert wps._inflight_starts == {}
+
+    def test_failed_launch_fails_all_callers_and_is_not_reused(self, monkeypatch):
+        spawner = make_spawner()
+        attempts = []
+
+        async def failing_launch():
+            attempts.append(1)
+            await asyncio.sleep(0)
+            raise RuntimeError("launch failed")
+
+        monkeypatch.setattr(spawner, "_launch", failing_launch)
+
+        async def start_twice():
+            return await asyncio.gather(spawner.start(), spawner.start(), return_exceptions=True)
+
+        results = asyncio.run(start_twice())
+        assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+        assert len(attempts) == 1
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(spawner.start())
+        assert len(attempts) == 2
+
+
+class TestStartStages:
+    """Tests for the concurrent stages of start()."""
+
+    def test_auth_state_stage_timeout_aborts_start_and_closes_job(self, monkeypatch):
+        spawner = make_spawner(auth_state={"auth_token": 123})
+        spawner.start_stage_timeouts = {"auth_state": 0.01}
+        jobs = []
+
+        def fake_create_job():
+            spawner._job = DummyJob()
+            jobs.append(spawner._job)
+            return spawner._job
+
+        async def slow_get_auth_state():
+            await asyncio.sleep(10)
+
+        monkeypatch.setattr(spawner, "_create_job", fake_create_job)
+        monkeypatch.setattr(spawner, "_get_auth_state", slow_get_auth_state)
+        monkeypatch.setattr(
+            wps, "PopenAsUser", lambda *args, **kwargs: pytest.fail("server was launched")
+        )
+
+        with pytest.raises(TimeoutError, match="auth_state"):
+            asyncio.run(spawner.start())
+
+        assert jobs[0].closed
+        assert spawner._job is None
+
+    def test_profile_stage_timeout_releases_token_and_profile_once_loaded(self, monkeypatch):
+        spawner = make_spawner(auth_state={"auth_token": 123})
+        spawner.start_stage_timeouts = {"profile": 0.01}
+        duplicate_handle = DummyDuplicateHandle()
+        duplicate_handle.install(monkeypatch)
+        monkeypatch.setattr(wps.pywintypes, "HANDLE", DummyHandleFactory())
+        loading = threading.Event()
+        closed_while_loading = []
+        released = []
+
+        def slow_load_profile_env(token):
+            loading.wait(5)
+            closed_while_loading.append(token.closed)
+            return {"APPDATA": "C:/Users/alice/AppData/Roaming"}
+
+        monkeypatch.setattr(spawner, "_load_profile_env", slow_load_profile_env)
+        monkeypatch.setattr(spawner, "_release_profile", lambda: released.append(True))
+        monkeypatch.setattr(spawner, "_create_job", lambda: None)
+        monkeypatch.setattr(
+            wps, "PopenAsUser", lambda *args, **kwargs: pytest.fail("server was launched")
+        )
+
+        async def start_then_finish_loading():
+            with pytest.raises(TimeoutError, match="profile"):
+                await spawner.start()
+            token = duplicate_handle.created[0]
+            released_on_timeout = (token.closed, list(released))
+            loading.set()
+            while not released:
+                await asyncio.sleep(0.01)
+            return released_on_timeout, token.closed
+
+        released_on_timeout, closed = asyncio.run(start_then_finish_loading())
+
+        assert released_on_timeout == (0, [])
+        assert closed_while_loading == [0]
+        assert closed == 1
+
+    def test_auth_state_stage_runs_while_the_command_line_is_built(self, monkeypatch):
+        spawner = make_spawner()
+        auth_state_started = threading.Event()
+        calls = []
+        get_env = spawner.get_env
+
+        async def get_auth_state():
+            auth_state_started.set()
+
+        def wait_for_auth_state_then_get_env():
+            calls.append(("env", auth_state_started.wait(5), threading.get_ident()))
+            return get_env()
+
+        def get_cwd(env, profile_env, token):
+            calls.append(("cwd", True, threading.get_ident()))
+            return "C:/Users/alice"
+
+        def popen(*args, **kwargs):
+            raise RuntimeError("launched")
+
+        monkeypatch.setattr(spawner, "_get_auth_state", get_auth_state)
+        monkeypatch.setattr(spawner, "get_env", wait_for_auth_state_then_get_env)
+        monkeypatch.setattr(spawner, "_get_cwd", get_cwd)
+        monkeypatch.setattr(spawner, "_create_job", lambda: None)
+        monkeypatch.setattr(spawner, "_load_profile_env", lambda token: None)
+        monkeypatch.setattr(wps, "PopenAsUser", popen)
+
+        with pytest.raises(RuntimeError, match="launched"):
+            asyncio.run(spawner.start())
+
+        # get_env and mkdtemp do not block the event loop
+        assert [call[:2] for call in calls] == [("env", True), ("cwd", True)]
+        assert threading.get_ident() not in [call[2] for call in calls]
+
+    def test_no_temp_dir_is_created_when_userprofile_is_known(self, monkeypatch):
+        spawner = make_spawner()
+        spawner.get_env = lambda: {"APPDATA": "C:/base/appdata", "USERPROFILE": "C:/Users/alice"}
+        monkeypatch.setattr(wps, "mkdtemp", lambda: pytest.fail("temp dir was created"))
+
+        cwd = spawner._get_cwd(spawner.get_env(), None, DummyToken(1))
+
+        assert cwd == "C:/Users/alice"
+
+
+class TestSpawnJournal:
+    """Tests for the spawn journal kept by the spawner."""
+
+    def _make_spawner(self, monkeypatch):
+        monkeypatch.setattr(wps, "spawn_journal", SpawnJournal())
+        spawner = make_spawner()
+        return spawner
+
+    def test_successful_spawn_is_journaled_with_its_phases(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch)
+
+        async def launch():
+            await spawner._run_stage("profile", asyncio.sleep(0))
+            spawner.pid = 4242
+            return ("127.0.0.1", 8888)
+
+        monkeypatch.setattr(spawner, "_launch", launch)
+
+        asyncio.run(spawner.start())
+
+        (entry,) = wps.spawn_journal.events()
+        assert entry["event"] == "spawn"
+        assert entry["result"] == "ok"
+        assert entry["pid"] == 4242
+        assert set(entry["durations"]) == {"profile", "total"}
+        assert entry["error"] is None
+
+    def test_failed_spawn_is_journaled_with_its_win32_error(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch)
+
+        async def launch():
+            raise wps.pywintypes.error(1314, "CreateProcessAsUser", "A required privilege...")
+
+        monkeypatch.setattr(spawner, "_launch", launch)
+
+        with pytest.raises(wps.pywintypes.error):
+            asyncio.run(spawner.start())
+
+        (entry,) = wps.spawn_journal.events()
+        assert entry["result"] == "failed"
+        assert entry["error"]["winerror"] == 1314
+
+    def test_rejected_spawn_is_journaled_as_rejected(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch)
+
+        async def launch():
+            spawner._reject_start(503, 30, "Busy.")
+
+        monkeypatch.setattr(spawner, "_launch", launch)
+
+        with pytest.raises(web.HTTPError):
+            asyncio.run(spawner.start())
+
+        assert wps.spawn_journal.stats()["spawns"]["rejected"] == 1
+
+    def test_exit_found_by_poll_is_journaled(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch)
+        spawner.load_state({"pid": 4242, "launcher_address": "tcp:127.0.0.1:1"})
+
+        async def poll_launcher():
+            return 3
+
+        monkeypatch.setattr(spawner, "_poll_launcher", poll_launcher)
+
+        assert asyncio.run(spawner.poll()) == 3
+
+        (entry,) = wps.spawn_journal.events()
+        assert (entry["event"], entry["pid"], entry["exit_code"]) == ("exit", 4242, 3)
+
+    def test_exit_caused_by_stop_is_journaled_as_stop(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch)
+        spawner.load_state({"pid": 4242, "launcher_address": "tcp:127.0.0.1:1"})
+
+        async def stop(now):
+            await spawner.poll()
+
+        async def poll_launcher():
+            return 1
+
+        monkeypatch.setattr(spawner, "_stop", stop)
+        monkeypatch.setattr(spawner, "_poll_launcher", poll_launcher)
+
+        asyncio.run(spawner.stop())
+
+        assert [(e["event"], e["pid"]) for e in wps.spawn_journal.events()] == [("stop", 4242)]
+
+
+class TestLauncher:
+    """Tests for servers started through a launcher service."""
+
+    def _make_spawner(self, monkeypatch, address):
+        monkeypatch.setattr(wps, "_launchers", {})
+        monkeypatch.setattr(wps, "random_port", lambda: 9993)
+        spawner = make_spawner(auth_state={"auth_token": 123})
+        spawner.launcher_address = address
+        spawner.launcher_key = "launcher-key"
+        return spawner
+
+    def test_launcher_key_defaults_to_environment_variable(self, monkeypatch):
+        monkeypatch.setenv(KEY_ENV_VAR, "from-env")
+
+        assert make_spawner().launcher_key == "from-env"
+
+    def test_connections_to_remote_agents_use_tls(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, "pipe:hub")
+        contexts = []
+        monkeypatch.setattr(
+            wps,
+            "client_ssl_context",
+            lambda *files: contexts.append(files) or "context",
+        )
+
+        assert spawner._get_launcher("pipe:hub").ssl_context is None
+        assert spawner._get_launcher("tcp:10.0.0.11:8765").ssl_context is None
+        assert spawner.log.messages[0][0] == "warning"
+        spawner.launcher_ssl_ca = "C:/ProgramData/jupyterhub/launchers-ca.pem"
+        assert spawner._get_launcher("tcp:10.0.0.12:8765").ssl_context == "context"
+        assert contexts == [("C:/ProgramData/jupyterhub/launchers-ca.pem", None, None)]
+
+    def test_start_poll_and_stop_through_launcher(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        monkeypatch.setattr(
+            launcher.win32profile,
+            "CreateEnvironmentBlock",
+            lambda token, _inherit: {"APPDATA": "C:/Users/alice/AppData/Roaming"},
+        )
+        monkeypatch.setattr(
+            launcher.token_utils, "duplicate_token_from_process", lambda pid, handle: None
+        )
+        # as if the Hub was connected over a named pipe
+        monkeypatch.setattr(launcher, "_client_pid", lambda writer: 4242)
+        monkeypatch.setattr(
+            wps, "PopenAsUser", lambda *args, **kwargs: pytest.fail("launched by the Hub")
+        )
+
+        async def scenario():
+            service, address = await start_service()
+            spawner = self._make_spawner(monkeypatch, address)
+            try:
+                ip_port = await spawner.start()
+                pid = spawner.pid
+                running = await spawner.poll()
+                await spawner.stop()
+                return ip_port, pid, running, spawner.pid
+            finally:
+                wps._launchers[address].close()
+                await service.close()
+
+        ip_port, pid, running, pid_after_stop = asyncio.run(scenario())
+
+        assert ip_port == ("127.0.0.1", 9993)
+        assert pid == launches.procs[0].pid
+        assert running is None
+        assert pid_after_stop == 0
+        assert launches.procs[0].cmd == ["python", "-m", "jupyterhub_singleuser", "--debug"]
+        assert launches.procs[0].env["APPDATA"] == "C:/Users/alice/AppData/Roaming"
+        assert launches.procs[0].exit_code == 1
+
+    def test_start_places_server_on_least_loaded_agent(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        monkeypatch.setattr(launcher.win32profile, "CreateEnvironmentBlock", lambda token, _: {})
+
+        class Token:
+            def Close(self):  # noqa: N802
+                pass
+
+        async def scenario():
+            busy, busy_address = await start_service(token_provider=lambda user: Token())
+            idle, idle_address = await start_service(token_provider=lambda user: Token())
+            spawner = self._make_spawner(monkeypatch, "")
+            spawner.launcher_hosts = {
+                busy_address: {},
+                idle_address: {"ip": "10.0.0.2"},
+                "tcp:127.0.0.1:1": {},
+            }
+            try:
+                await spawner._get_launcher(busy_address).request("launch", cmd=["python"])
+                ip, port = await spawner.start()
+                return ip, port, spawner.get_state(), idle_address
+            finally:
+                for client in wps._launchers.values():
+                    client.close()
+                await busy.close()
+                await idle.close()
+
+        ip, port, state, idle_address = asyncio.run(scenario())
+
+        assert ip == "10.0.0.2"
+        assert port != 9993
+        assert state["launcher_address"] == idle_address
+        assert state["agent_ip"] == "10.0.0.2"
+        assert "--debug" in launches.procs[1].cmd
+        assert "--ip=10.0.0.2" in launches.procs[1].cmd
+        assert isinstance(launches.procs[1].token, Token)
+
+    def test_agent_ip_does_not_outlive_the_server(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, "")
+        spawner.get_args = lambda: ["--ip=0.0.0.0", "--debug"]
+
+        spawner.load_state({"pid": 4242, "agent_ip": "10.0.0.2"})
+        agent_cmd = spawner._get_cmd()
+        spawner.clear_state()
+
+        assert agent_cmd[-2:] == ["--ip=10.0.0.2", "--debug"]
+        assert spawner._get_cmd()[-2:] == ["--ip=0.0.0.0", "--debug"]
+        assert spawner.ip == "127.0.0.1"
+        assert "agent_ip" not in spawner.get_state()
+
+    def test_agent_chooses_the_working_directory_of_its_servers(self, monkeypatch, tmp_path):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        profile = {"USERPROFILE": str(tmp_path), "APPDATA": str(tmp_path / "AppData")}
+        monkeypatch.setattr(
+            launcher.win32profile, "CreateEnvironmentBlock", lambda token, _: profile
+        )
+        monkeypatch.setattr(wps, "mkdtemp", lambda: pytest.fail("temp dir was created"))
+        hooked_tokens = []
+        apply_user_env_overrides = wps.WinLocalProcessSpawner._apply_user_env_overrides
+
+        def record_token(spawner, env, profile_env, token):
+            hooked_tokens.append(token)
+            apply_user_env_overrides(spawner, env, profile_env, token)
+
+        monkeypatch.setattr(wps.WinLocalProcessSpawner, "_apply_user_env_overrides", record_token)
+
+        class Token:
+            def Close(self):  # noqa: N802
+                pass
+
+        async def scenario():
+            agent, agent_address = await start_service(token_provider=lambda user: Token())
+            spawner = self._make_spawner(monkeypatch, "")
+            spawner.notebook_dir = "C:/Hub/notebooks"
+            spawner.launcher_hosts = {agent_address: {}}
+            try:
+                await spawner.start()
+            finally:
+                for client in wps._launchers.values():
+                    client.close()
+                await agent.close()
+
+        asyncio.run(scenario())
+
+        assert launches.procs[0].cwd == str(tmp_path)
+        assert hooked_tokens == [True]
+
+    def test_start_is_redirected_away_from_agent_under_pressure(self, monkeypatch):
+        launches = FakeLaunches()
+        launches.install(monkeypatch)
+        monkeypatch.setattr(launcher.win32profile, "CreateEnvironmentBlock", lambda token, _: {})
+
+        class Token:
+            def Close(self):  # noqa: N802
+                pass
+
+        async def scenario():
+            pressured, pressured_address = await start_service(token_provider=lambda u: Token())
+            calm, calm_address = await start_service(token_provider=lambda u: Token())
+            pressured.host_pressure = DummyHostPressure(COMMIT_PRESSURE)
+            calm.host_pressure = DummyHostPressure(CALM)
+            spawner = self._make_spawner(monkeypatch, "")
+            spawner.host_max_commit_percent = 90
+            spawner.launcher_hosts = {pressured_address: {}, calm_address: {}}
+            try:
+                await spawner.start()
+                return spawner.get_state(), calm_address
+            finally:
+                for client in wps._launchers.values():
+                    client.close()
+                await pressured.close()
+                await calm.close()
+
+        state, calm_address = asyncio.run(scenario())
+
+        assert state["launcher_address"] == calm_address
+
+    def test_start_is_rejected_when_no_agent_is_available(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, "")
+        spawner.launcher_hosts = {"tcp:127.0.0.1:1": {}}
+
+        with pytest.raises(web.HTTPError) as exc_info:
+            asyncio.run(spawner.start())
+
+        assert exc_info.value.status_code == 503
+        assert exc_info.value.headers == {"Retry-After": "30"}
+
+    def test_poll_assumes_running_server_when_launcher_is_unreachable(self, monkeypatch):
+        spawner = self._make_spawner(monkeypatch, "tcp:127.0.0.1:1")
+        spawner.load_state({"pid": 4242, "launcher_address": "tcp:127.0.0.1:1"})
+
+        assert asyncio.run(spawner.poll()) is None
+        assert spawner.pid == 4242
+
+
+class TestProgress:
+    """Tests for the progress events of a launch."""
+
+    async def _collect(self, spawner):
+        return [event async for event in spawner.progress()]
+
+    def test_phases_of_a_launch_are_streamed_then_the_bound_port(self, monkeypatch):
+        FakeLaunches().install(monkeypatch)
+        monkeypatch.setattr(
+            launcher.win32profile, "CreateEnvironmentBlock", lambda token, _: {"A": "B"}
+        )
+        monkeypatch.setattr(
+            launcher.token_utils, "duplicate_token_from_process", lambda pid, handle: None
+        )
+        # as if the Hub was connected over a named pipe
+        monkeypatch.setattr(launcher, "_client_pid", lambda writer: 4242)
+        monkeypatch.setattr(wps, "_launchers", {})
+
+        async def scenario():
+            service, address = await start_service()
+            # stands in for the server, listening on its port
+            listener = await asyncio.start_server(
+                lambda reader, writer: writer.close(), "127.0.0.1"
+            )
+            monkeypatch.setattr(wps, "random_port", lambda: listener.sockets[0].getsockname()[1])
+            spawner = make_spawner(auth_state={"auth_token": 123})
+            spawner.launcher_address = address
+            spawner.launcher_key = "launcher-key"
+            try:
+                start = asyncio.ensure_future(spawner.start())
+                # the Hub watches progress once the spawn is pending
+                await asyncio.sleep(0)
+                events = await self._collect(spawner)
+                await start
+                return events, spawner.pid, spawner.port
+            finally:
+                wps._launchers[address].close()
+                listener.close()
+                await service.close()
+
+        events, pid, port = asyncio.run(scenario())
+
+        assert [event["message"] for event in events] == [
+            "Authentication token acquired",
+            "User profile loaded",
+            "Server process started (pid {})".format(pid),
+            "Server listening on port {}".format(port),
+        ]
+        assert [event["progress"] for event in events] == [30, 50, 70, 90]
+
+    def test_failed_launch_ends_progress_without_port(self, monkeypatch):
+        spawner = make_spawner()
+
+        async def failing_launch():
+            await asyncio.sleep(0.01)
+            spawner._emit_progress(30, "Authentication token acquired")
+            raise RuntimeError("launch failed")
+
+        monkeypatch.setattr(spawner, "_launch", failing_launch)
+
+        async def scenario():
+            start = asyncio.ensure_future(spawner.start())
+            await asyncio.sleep(0)
+            events = await self._collect(spawner)
+            with pytest.raises(RuntimeError):
+                await start
+            return events
+
+        assert asyncio.run(scenario()) == [
+            {"progress": 30, "message": "Authentication token acquired"}
+        ]
+
+    def test_queued_launches_report_their_position(self, monkeypatch):
+        monkeypatch.setattr(wps, "_queued_launches", {})
+        alice = make_spawner()
+        bob = make_spawner()
+        bob.user = DummyUser("bob", None)
+
+        alice._report_queued()
+        bob._report_queued()
+        bob._report_queued()
+        wps._queued_launches.pop(alice._server_key)
+        bob._report_queued()
+
+        assert [event["message"] for event in bob._progress_events] == [
+            "Waiting to start your server: number 2 in the queue",
+            "Waiting to start your server: number 1 in the queue",
+        ]
+
+
+class TestUserProfiles:
+    """Tests for the user profiles shared by the servers of a user."""
+
+    class RecordingProfiles:
+        """UserProfileManager stub, recording the acquisitions and releases."""
+
+        def __init__(self, error=None):
+            """Initializes RecordingProfiles without references."""
+            self.grace = None
+            self.error = error
+            self.acquired = []
+            self.released = []
+            self.unloads = 0
+
+        def acquire(self, username, token, holder):
+            if self.error is not None:
+                raise self.error
+            self.acquired.append((username, holder))
+            return {"APPDATA": "C:/Users/alice/AppData/Roaming", "USERPROFILE": "C:/Users/alice"}
+
+        def release(self, username, holder):
+            self.released.append((username, holder))
+            return True
+
+        def unload_expired(self):
+            self.unloads += 1
+
+    def _make_spawner(self, monkeypatch, profiles):
+        monkeypatch.setattr(wps, "_user_profiles", profiles)
+        spawner = make_spawner()
+        spawner.load_user_profile = True
+        spawner.profile_unload_grace = 0
+        return spawner
+
+    def test_profile_is_acquired_for_the_server(self, monkeypatch):
+        profiles = self.RecordingProfiles()
+        spawner = self._make_spawner(monkeypatch, profiles)
+
+        profile_env = spawner._load_profile_env(DummyToken(1))
+
+        assert profile_env["USERPROFILE"] == "C:/Users/alice"
+        assert profiles.acquired == [("alice", ("alice", ""))]
+        assert profiles.grace == 0
+
+    def test_profile_env_falls_back_to_environment_block(self, monkeypatch):
+        profiles = self.RecordingProfiles(error=PermissionError("privilege not held"))
+        spawner = self._make_spawner(monkeypatch, profiles)
+        monkeypatch.setattr(
+            wps.win32profile, "CreateEnvironmentBlock", lambda token, inherit: {"APPDATA": "A"}
+        )
+
+        assert spawner._load_profile_env(DummyToken(1)) == {"APPDATA": "A"}
+        assert spawner.log.messages[0][0] == "warning"
+
+    def test_no_profile_is_loaded_without_token(self, monkeypatch):
+        profiles = self.RecordingProfiles()
+        spawner = self._make_spawner(monkeypatch, profiles)
+        monkeypatch.setattr(wps.win32profile, "CreateEnvironmentBlock", lambda token, inherit: {})
+
+        spawner._load_profile_env(None)
+
+        assert profiles.acquired == []
+
+    def test_clear_state_releases_profile_and_unloads_it_after_grace(self, monkeypatch):
+        profiles = self.RecordingProfiles()
+        spawner = self._make_spawner(monkeypatch, profiles)
+
+        async def clear_state():
+            spawner.clear_state()
+            await asyncio.sleep(0.1)
+
+        asyncio.run(clear_state())
+
+        assert profiles.released == [("alice", ("alice", ""))]
+        assert profiles.unloads == 1
+
+
+class TestDedicatedDesktops:
+    """Tests for the desktops dedicated to the servers."""
+
+    class RecordingDesktops:
+        """DesktopPool stub, recording the servers given a desktop."""
+
+        def __init__(self, error=None):
+            """Initializes RecordingDesktops without servers."""
+            self.heap_size = None
+            self.max_servers = None
+            self.error = error
+            self.servers = set()
+
+        def acquire(self, server):
+            if self.error is not None:
+                raise self.error
+            self.servers.add(server)
+            return "jupyterhub-0\\jupyterhub-1"
+
+        def release(self, server):
+            self.servers.discard(server)
+
+    def _make_spawner(self, monkeypatch, desktops):
+        monkeypatch.setattr(wps, "_desktops", desktops)
+        spawner = make_spawner()
+        spawner.dedicated_desktops = True
+        spawner.desktop_heap_size = 2048
+        spawner.desktop_max_servers = 50
+        return spawner
+
+    def test_server_is_given_a_dedicated_desktop(self, monkeypatch):
+        desktops = self.RecordingDesktops()
+        spawner = self._make_spawner(monkeypatch, desktops)
+
+        assert spawner._acquire_desktop() == "jupyterhub-0\\jupyterhub-1"
+        assert desktops.servers == {("alice", "")}
+        assert (desktops.heap_size, desktops.max_servers) == (2048, 50)
+
+    def test_servers_use_the_hub_desktop_by_default(self, monkeypatch):
+        desktops = self.RecordingDesktops()
+        spawner = self._make_spawner(monkeypatch, desktops)
+        spawner.dedicated_desktops = False
+
+        assert spawner._acquire_desktop() is None
+        assert desktops.servers == set()
+
+    @pytest.mark.parametrize(
+        "error",
+        [OSError(8), wps.pywintypes.error(1158, "CreateDesktopW", "Too many desktops")],
+    )
+    def test_failure_to_create_a_desktop_falls_back_to_the_hub_desktop(self, monkeypatch, error):
+        spawner = self._make_spawner(monkeypatch, self.RecordingDesktops(error=error))
+
+        assert spawner._acquire_desktop() is None
+        assert spawner.log.messages[0][0] == "warning"
+
+    def test_clear_state_releases_the_desktop(self, monkeypatch):
+        desktops = self.RecordingDesktops()
+        spawner = self._make_spawner(monkeypatch, desktops)
+        spawner._acquire_desktop()
+
+        spawner.clear_state()
+
+        assert desktops.servers == set()
+
+
+class TestBytecodeCache:
+    """Tests for the shared bytecode cache of the servers."""
+
+    class RecordingCache:
+        """BytecodeCache stub, recording the refreshes."""
+
+        def __init__(self):
+            """Initializes RecordingCache without refreshes."""
+            self.check_interval = None
+            self.refreshed = []
+
+        def due(self, cache_dir, python):
+            return not self.refreshed
+
+        def refresh(self, cache_dir, python):
+            self.refreshed.append((cache_dir, python))
+            return True
+
+    def test_get_env_points_servers_at_existing_cache(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(wps.LocalProcessSpawner, "get_env", lambda self: {})
+        spawner = wps.WinLocalProcessSpawner.__new__(wps.WinLocalProcessSpawner)
+        spawner.bytecode_cache_dir = str(tmp_path / "cache")
+
+        assert "PYTHONPYCACHEPREFIX" not in spawner.get_env()
+        (tmp_path / "cache").mkdir()
+        assert spawner.get_env()["PYTHONPYCACHEPREFIX"] == str(tmp_path / "cache")
+
+    def test_cache_is_refreshed_in_the_background_once_due(self, monkeypatch):
+        cache = self.RecordingCache()
+        monkeypatch.setattr(wps, "_bytecode_cache", cache)
+        spawner = make_spawner()
+        spawner.bytecode_cache_dir = "C:/ProgramData/jupyterhub/pycache"
+        spawner.bytecode_cache_python = "C:/Python38/python.exe"
+
+        async def refresh_twice():
+            await spawner._refresh_bytecode_cache()
+            assert spawner._refresh_bytecode_cache() is None
+
+        asyncio.run(refresh_twice())
+
+        assert cache.refreshed == [("C:/ProgramData/jupyterhub/pycache", "C:/Python38/python.exe")]
+        assert cache.check_interval == 300
+
+    def test_no_refresh_without_cache_dir(self, monkeypatch):
+        cache = self.RecordingCache()
+        monkeypatch.setattr(wps, "_bytecode_cache", cache)
+
+        assert make_spawner()._refresh_bytecode_cache() is None
+        assert cache.refreshed == []
 
 
 class TestApplyUserEnvOverrides:
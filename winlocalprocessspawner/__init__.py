@@ -1,5 +1,25 @@
 """Windows local process Jupyterhub spawner."""
 
-from winlocalprocessspawner.winlocalprocessspawner import WinLocalProcessSpawner
+import importlib
 
 __all__ = ["WinLocalProcessSpawner"]
+
+# Attributes imported on first access, so that importing a submodule such as token_utils does
+# not import the spawner, and JupyterHub with it: name -> module defining it
+_LAZY_ATTRIBUTES = {
+    "WinLocalProcessSpawner": "winlocalprocessspawner.winlocalprocessspawner",
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module_name), name)
+    # cached, so that __getattr__ is not called again for it
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
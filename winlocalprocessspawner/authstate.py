@@ -0,0 +1,61 @@
+"""In-memory cache of the decrypted auth_state fields used by the spawner."""
+
+from collections import OrderedDict
+
+from . import metrics
+
+
+class AuthStateCache:
+    """Bounded LRU cache of the auth_state fields the spawner needs, keyed by user name.
+
+    Each entry remembers the encrypted auth_state it was decrypted from. When the Authenticator
+    stores a new auth_state (at login, or when refreshing it), the encrypted value changes and
+    the entry is decrypted again; until then, repeated spawns skip the decryption.
+    """
+
+    # auth_state fields kept in the cache; the rest of the auth_state is never stored
+    fields = ("auth_token",)
+
+    def __init__(self, maxsize=1024):
+        """Create a new, empty AuthStateCache holding up to maxsize users."""
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    async def get(self, user):
+        """Return the cached auth_state fields of the user, decrypting them if needed.
+
+        :param user: A JupyterHub User.
+        :return: A dict with the cached fields present in the user's auth_state, or None if the
+            user has no auth_state.
+        """
+        encrypted = getattr(user, "encrypted_auth_state", None)
+        if encrypted is None or not self.maxsize:
+            self.invalidate(user.name)
+            return self.select(await user.get_auth_state())
+
+        entry = self._entries.get(user.name)
+        if entry is not None and entry[0] == encrypted:
+            self._entries.move_to_end(user.name)
+            metrics.AUTH_STATE_CACHE.labels(result="hit").inc()
+            return entry[1]
+
+        metrics.AUTH_STATE_CACHE.labels(result="miss").inc()
+        auth_state = self.select(await user.get_auth_state())
+        self._entries[user.name] = (encrypted, auth_state)
+        self._entries.move_to_end(user.name)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return auth_state
+
+    def invalidate(self, username=None):
+        """Forget the cached auth_state of a user, or of all users if username is None."""
+        if username is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(username, None)
+
+    def select(self, auth_state):
+        """Return the fields of an auth_state that the cache keeps, or None without auth_state."""
+        if auth_state is None:
+            return None
+        return {field: auth_state[field] for field in self.fields if field in auth_state}
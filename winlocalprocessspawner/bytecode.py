@@ -0,0 +1,159 @@
+"""Hub-wide cache of the bytecode of the servers' Python environment, see PYTHONPYCACHEPREFIX."""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import ntsecuritycon
+import win32security
+
+from . import token_utils
+
+logger = logging.getLogger("winlocalprocessspawner")
+
+FINGERPRINT_FILE = "fingerprint.json"
+
+# -s leaves out the user site-packages, whose modules must not end up in a cache shared by all
+_SYS_PATH_ARGS = ["-s", "-c", "import json, sys; print(json.dumps([sys.version, sys.path]))"]
+
+
+def environment(python):
+    """Returns the version and the import directories of the python interpreter."""
+    result = subprocess.run(
+        [python] + _SYS_PATH_ARGS,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    version, paths = json.loads(result.stdout)
+    return version, [path for path in paths if path and os.path.isdir(path)]
+
+
+def fingerprint(version, paths):
+    """Returns a digest of the version and import directories of an interpreter.
+
+    The modification time of a directory changes when files are added to or removed from it,
+    which is the case of site-packages when a package is installed, upgraded or uninstalled.
+    """
+    digest = hashlib.sha256(version.encode("utf-8"))
+    for path in paths:
+        digest.update("\0{}\0{}".format(path, os.stat(path).st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_only_for_users(path):
+    """Give users read access to a directory and its contents, and only the Hub write access.
+
+    Python then loads the cached bytecode in the servers, but never writes the bytecode of a
+    user's own modules into the cache, where other users could read it.
+    """
+    owner = token_utils.current_user_sid()
+    inherit = win32security.OBJECT_INHERIT_ACE | win32security.CONTAINER_INHERIT_ACE
+    read = ntsecuritycon.FILE_GENERIC_READ | ntsecuritycon.FILE_GENERIC_EXECUTE
+    dacl = win32security.ACL()
+    for sid, access in [
+        (owner, ntsecuritycon.FILE_ALL_ACCESS),
+        (
+            win32security.CreateWellKnownSid(win32security.WinLocalSystemSid),
+            ntsecuritycon.FILE_ALL_ACCESS,
+        ),
+        (
+            win32security.CreateWellKnownSid(win32security.WinBuiltinAdministratorsSid),
+            ntsecuritycon.FILE_ALL_ACCESS,
+        ),
+        (win32security.CreateWellKnownSid(win32security.WinBuiltinUsersSid), read),
+    ]:
+        dacl.AddAccessAllowedAceEx(win32security.ACL_REVISION_DS, inherit, access, sid)
+    win32security.SetNamedSecurityInfo(
+        path,
+        win32security.SE_FILE_OBJECT,
+        win32security.DACL_SECURITY_INFORMATION | win32security.PROTECTED_DACL_SECURITY_INFORMATION,
+        None,
+        None,
+        dacl,
+        None,
+    )
+
+
+def compile_environment(python, cache_dir, paths):
+    """Compile the modules in paths with python, writing their bytecode under cache_dir.
+
+    Returns whether all modules compiled. Some packages ship files that are not meant to compile,
+    such as templates, so a failure only means that those modules are not cached.
+    """
+    result = subprocess.run(
+        [python, "-s", "-X", "pycache_prefix=" + cache_dir, "-m", "compileall", "-q", "-j", "0"]
+        + paths,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        logger.debug("Modules that failed to compile into %s:\n%s", cache_dir, result.stdout)
+    return result.returncode == 0
+
+
+class BytecodeCache:
+    """Keeps the bytecode of the Python environments of the servers compiled in cache directories.
+
+    An environment is compiled again when its fingerprint changes, which is checked at most once
+    every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=300, clock=time.monotonic):
+        """Create a new BytecodeCache, which has not checked any cache yet."""
+        self.check_interval = check_interval
+        self._clock = clock
+        self._checked = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def due(self, cache_dir, python):
+        """Returns whether the cache should be checked, and marks it as being checked if so."""
+        key = (cache_dir, python)
+        now = self._clock()
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            checked = self._checked.get(key)
+            if checked is not None and now - checked < self.check_interval:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def refresh(self, cache_dir, python):
+        """Compile the environment of python into cache_dir, unless it is up to date.
+
+        Returns whether it was compiled. Blocks while compiling, and should be called after
+        due() returned True.
+        """
+        key = (cache_dir, python)
+        try:
+            version, paths = environment(python)
+            current = fingerprint(version, paths)
+            fingerprint_path = os.path.join(cache_dir, FINGERPRINT_FILE)
+            try:
+                with open(fingerprint_path) as f:
+                    if json.load(f).get("fingerprint") == current:
+                        return False
+            except (OSError, ValueError):
+                pass
+
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+                read_only_for_users(cache_dir)
+            logger.info("Compiling the bytecode of %s into %s", python, cache_dir)
+            complete = compile_environment(python, cache_dir, paths)
+            with open(fingerprint_path, "w") as f:
+                json.dump({"fingerprint": current, "version": version, "paths": paths}, f)
+            if not complete:
+                logger.info("Some modules of %s could not be compiled", python)
+            return True
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+                self._checked[key] = self._clock()
@@ -0,0 +1,42 @@
+"""Exponential backoff for servers that repeatedly exit shortly after being started."""
+
+import time
+
+
+class CrashLoopTracker:
+    """Counts the consecutive early exits of each server, identified by a (user, server) key.
+
+    After an early exit, the next launch of the server has to wait for a delay that doubles with
+    every consecutive early exit, from `base_delay` up to `max_delay` seconds.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Create a new CrashLoopTracker without any recorded exits."""
+        self._clock = clock
+        # key -> (consecutive early exits, time of the last one)
+        self._early_exits = {}
+
+    def record_early_exit(self, key):
+        """Record that the server exited shortly after being started."""
+        count, _ = self._early_exits.get(key, (0, None))
+        self._early_exits[key] = (count + 1, self._clock())
+
+    def reset(self, key):
+        """Forget the early exits of the server, e.g. once a launch stayed up."""
+        self._early_exits.pop(key, None)
+
+    def early_exits(self, key):
+        """Number of consecutive early exits of the server."""
+        return self._early_exits.get(key, (0, None))[0]
+
+    def retry_after(self, key, base_delay, max_delay):
+        """Seconds to wait before the server may be launched again, 0 if it may be launched now."""
+        count, last_exit = self._early_exits.get(key, (0, None))
+        if not count:
+            return 0.0
+        delay = min(max_delay, base_delay * 2 ** (count - 1))
+        return max(0.0, last_exit + delay - self._clock())
+
+    def __len__(self):
+        """Number of servers with recorded early exits."""
+        return len(self._early_exits)
@@ -0,0 +1,174 @@
+"""Window station and desktops dedicated to the servers, each desktop with its own heap.
+
+All processes of a session's window station share the heap of their desktop, whose exhaustion
+makes CreateProcessAsUser and the windows of the servers fail past a few hundred servers.
+"""
+
+import ctypes
+import threading
+import uuid
+from ctypes import wintypes
+
+import ntsecuritycon
+import win32security
+
+from . import token_utils
+
+_user32 = ctypes.WinDLL("user32", use_last_error=True)
+_user32.CreateWindowStationW.restype = wintypes.HANDLE
+_user32.GetProcessWindowStation.restype = wintypes.HANDLE
+_user32.CreateDesktopExW.restype = wintypes.HANDLE
+
+# Serializes the changes of the window station of the Hub process, which is shared by all its
+# threads, between the desktop pools
+_window_station_lock = threading.Lock()
+
+# Fail instead of opening a window station that already exists
+CWF_CREATE_ONLY = 0x1
+
+WINSTA_ALL_ACCESS = 0x37F
+DESKTOP_ALL_ACCESS = 0x1FF
+
+# Access of the servers: enumerate the desktops and use the global atoms, but not the clipboard,
+# which the servers of all users share
+WINSTA_USER_ACCESS = 0x1 | 0x2 | 0x20 | 0x100 | ntsecuritycon.READ_CONTROL
+
+# Access of the servers: read, create and write windows and menus, but not hook or journal the
+# input of the windows of other users' servers on the same desktop
+DESKTOP_USER_ACCESS = 0x1 | 0x2 | 0x4 | 0x40 | 0x80 | ntsecuritycon.READ_CONTROL
+
+
+def _set_access(handle, user_access, owner_access):
+    """Give the Hub, Local System and administrators owner_access, and users user_access."""
+    dacl = win32security.ACL()
+    for sid, access in [
+        (token_utils.current_user_sid(), owner_access),
+        (win32security.CreateWellKnownSid(win32security.WinLocalSystemSid), owner_access),
+        (win32security.CreateWellKnownSid(win32security.WinBuiltinAdministratorsSid), owner_access),
+        (win32security.CreateWellKnownSid(win32security.WinAuthenticatedUserSid), user_access),
+    ]:
+        dacl.AddAccessAllowedAce(win32security.ACL_REVISION, access, sid)
+    win32security.SetSecurityInfo(
+        handle,
+        win32security.SE_WINDOW_OBJECT,
+        win32security.DACL_SECURITY_INFORMATION,
+        None,
+        None,
+        dacl,
+        None,
+    )
+
+
+class DesktopPool:
+    """Desktops of a non-interactive window station, each used by up to max_servers servers.
+
+    Each desktop has a heap of heap_size KB of its own. The window station is created with the
+    first desktop. A desktop is closed once none of its servers runs anymore, and the window
+    station once no desktop is left.
+    """
+
+    def __init__(self, heap_size=4096, max_servers=100):
+        """Create a new DesktopPool without desktops."""
+        self.heap_size = heap_size
+        self.max_servers = max_servers
+        self._lock = threading.Lock()
+        self._window_station = None
+        self._window_station_name = None
+        self._created = 0
+        # desktop name -> (handle, servers using it)
+        self._desktops = {}
+        # server -> desktop name
+        self._servers = {}
+
+    def __len__(self):
+        """Number of open desktops."""
+        return len(self._desktops)
+
+    def acquire(self, server):
+        r"""Returns the "window station\desktop" name of the desktop to start a server in.
+
+        :param server: Identifies the server. A server acquiring a desktop again keeps its own.
+        """
+        with self._lock:
+            name = self._servers.get(server)
+            if name is None:
+                name = next(
+                    (
+                        name
+                        for name, (_, servers) in self._desktops.items()
+                        if len(servers) < self.max_servers
+                    ),
+                    None,
+                )
+            if name is None:
+                name = self._create_desktop()
+            self._desktops[name][1].add(server)
+            self._servers[server] = name
+            return "{}\\{}".format(self._window_station_name, name)
+
+    def release(self, server):
+        """Release the desktop of a server, closing it if no other server uses it."""
+        with self._lock:
+            name = self._servers.pop(server, None)
+            if name is None:
+                return
+            handle, servers = self._desktops[name]
+            servers.discard(server)
+            if servers:
+                return
+            # Windows destroys the desktop once the processes still running in it exit
+            del self._desktops[name]
+            _user32.CloseDesktop(handle)
+            if not self._desktops:
+                self._close_window_station()
+
+    def _create_desktop(self):
+        if self._window_station is None:
+            self._create_window_station()
+        self._created += 1
+        name = "jupyterhub-{}".format(self._created)
+        # Desktops are created in the window station of the process
+        with _window_station_lock:
+            original = _user32.GetProcessWindowStation()
+            if not _user32.SetProcessWindowStation(self._window_station):
+                raise ctypes.WinError(ctypes.get_last_error())
+            try:
+                handle = _user32.CreateDesktopExW(
+                    name, None, None, 0, DESKTOP_ALL_ACCESS, None, self.heap_size, None
+                )
+                error = ctypes.get_last_error()
+            finally:
+                _user32.SetProcessWindowStation(original)
+        try:
+            if not handle:
+                raise ctypes.WinError(error)
+            try:
+                _set_access(handle, DESKTOP_USER_ACCESS, DESKTOP_ALL_ACCESS)
+            except BaseException:
+                _user32.CloseDesktop(handle)
+                raise
+        except BaseException:
+            if not self._desktops:
+                self._close_window_station()
+            raise
+        self._desktops[name] = (handle, set())
+        return name
+
+    def _create_window_station(self):
+        name = "jupyterhub-" + uuid.uuid4().hex[:12]
+        handle = _user32.CreateWindowStationW(name, CWF_CREATE_ONLY, WINSTA_ALL_ACCESS, None)
+        if not handle:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            _set_access(handle, WINSTA_USER_ACCESS, WINSTA_ALL_ACCESS)
+        except BaseException:
+            _user32.CloseWindowStation(handle)
+            raise
+        self._window_station = handle
+        self._window_station_name = name
+
+    def _close_window_station(self):
+        if self._window_station is not None:
+            _user32.CloseWindowStation(self._window_station)
+        self._window_station = None
+        self._window_station_name = None
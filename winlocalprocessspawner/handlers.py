@@ -0,0 +1,36 @@
+"""JupyterHub API handlers of WinLocalProcessSpawner, to add to JupyterHub.extra_handlers."""
+
+import json
+
+from jupyterhub.apihandlers import APIHandler
+from jupyterhub.utils import admin_only
+from tornado import web
+
+from .journal import EVENTS
+from .winlocalprocessspawner import spawn_journal
+
+
+class SpawnJournalAPIHandler(APIHandler):
+    """Serves the spawn journal and its statistics to admins.
+
+    GET /hub/api/winlocalprocessspawner/journal?limit=100&user=alice&event=exit
+    """
+
+    @admin_only
+    def get(self):
+        """Returns the statistics and the latest events of the journal, oldest first."""
+        try:
+            limit = int(self.get_argument("limit", "100"))
+        except ValueError:
+            raise web.HTTPError(400, "limit must be an integer") from None
+        event = self.get_argument("event", None)
+        if event is not None and event not in EVENTS:
+            raise web.HTTPError(400, "event must be one of {}".format(", ".join(EVENTS)))
+
+        events = spawn_journal.events(
+            max(limit, 0), user=self.get_argument("user", None), event=event
+        )
+        self.write(json.dumps({"stats": spawn_journal.stats(), "events": events}))
+
+
+default_handlers = [(r"/api/winlocalprocessspawner/journal", SpawnJournalAPIHandler)]
@@ -0,0 +1,102 @@
+"""Cheap sampling of the memory and CPU pressure on the host running the servers."""
+
+import ctypes
+import time
+from collections import namedtuple
+
+_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+
+
+class _MemoryStatusEx(ctypes.Structure):
+    _fields_ = [
+        ("dwLength", ctypes.c_uint32),
+        ("dwMemoryLoad", ctypes.c_uint32),
+        ("ullTotalPhys", ctypes.c_uint64),
+        ("ullAvailPhys", ctypes.c_uint64),
+        ("ullTotalPageFile", ctypes.c_uint64),
+        ("ullAvailPageFile", ctypes.c_uint64),
+        ("ullTotalVirtual", ctypes.c_uint64),
+        ("ullAvailVirtual", ctypes.c_uint64),
+        ("ullAvailExtendedVirtual", ctypes.c_uint64),
+    ]
+
+
+# The pressure on a host: the available physical memory, the committed memory and the commit
+# limit, in bytes, and the CPU usage of all cores since the previous sample, in percent (None for
+# the first sample)
+HostPressure = namedtuple(
+    "HostPressure", ["available_memory", "commit", "commit_limit", "cpu_percent"]
+)
+
+
+def memory_status():
+    """Returns the available physical memory, the commit charge and the commit limit, in bytes."""
+    status = _MemoryStatusEx()
+    status.dwLength = ctypes.sizeof(status)
+    if not _kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        raise ctypes.WinError(ctypes.get_last_error())
+    return (
+        status.ullAvailPhys,
+        status.ullTotalPageFile - status.ullAvailPageFile,
+        status.ullTotalPageFile,
+    )
+
+
+def system_times():
+    """Returns the idle and total CPU time of all cores since boot, in units of 100 ns."""
+    idle, kernel, user = ctypes.c_uint64(), ctypes.c_uint64(), ctypes.c_uint64()
+    if not _kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+        raise ctypes.WinError(ctypes.get_last_error())
+    # the kernel time includes the idle time
+    return idle.value, kernel.value + user.value
+
+
+def exceeded(pressure, min_available_memory=0, max_commit_percent=0, max_cpu_percent=0):
+    """Returns the names of the thresholds a HostPressure crosses. 0 disables a threshold."""
+    reasons = []
+    if min_available_memory and pressure.available_memory < min_available_memory:
+        reasons.append("available memory")
+    if (
+        max_commit_percent
+        and pressure.commit_limit
+        and 100 * pressure.commit / pressure.commit_limit > max_commit_percent
+    ):
+        reasons.append("commit charge")
+    if (
+        max_cpu_percent
+        and pressure.cpu_percent is not None
+        and pressure.cpu_percent > max_cpu_percent
+    ):
+        reasons.append("CPU load")
+    return reasons
+
+
+class HostPressureSampler:
+    """Samples the pressure on the local host, at most once every max_age seconds.
+
+    The CPU usage is measured between two samples, so it covers at least max_age seconds.
+    """
+
+    def __init__(self, max_age=1, clock=time.monotonic):
+        """Create a new HostPressureSampler, which has not sampled yet."""
+        self.max_age = max_age
+        self._clock = clock
+        self._sample = None
+        self._sampled_at = None
+        self._system_times = None
+
+    def sample(self):
+        """Returns the latest HostPressure, sampling it again if it is older than max_age."""
+        now = self._clock()
+        if self._sample is not None and now - self._sampled_at < self.max_age:
+            return self._sample
+        available_memory, commit, commit_limit = memory_status()
+        idle, total = system_times()
+        cpu_percent = None
+        if self._system_times is not None and total > self._system_times[1]:
+            previous_idle, previous_total = self._system_times
+            cpu_percent = 100 * (1 - (idle - previous_idle) / (total - previous_total))
+        self._system_times = (idle, total)
+        self._sample = HostPressure(available_memory, commit, commit_limit, cpu_percent)
+        self._sampled_at = now
+        return self._sample
@@ -0,0 +1,235 @@
+"""Utilities for grouping the processes of a single-user server in a Windows job object."""
+
+import ctypes
+from ctypes import wintypes
+
+import pywintypes
+import win32api
+import win32con
+import win32job
+import win32process
+
+# Passing (SIZE_T)-1 as both working set limits asks Windows to trim the working set entirely.
+_SIZE_T_MAX = ctypes.c_size_t(-1).value
+
+# Not exported by win32con
+PROCESS_SUSPEND_RESUME = 0x0800
+
+# NtSuspendProcess and NtResumeProcess freeze and thaw all threads of a process at once. They
+# nest: a process suspended twice has to be resumed twice.
+_ntdll = ctypes.WinDLL("ntdll")
+# Without prototypes, ctypes passes integers as C ints, truncating 64-bit handles
+_ntdll.NtSuspendProcess.argtypes = [wintypes.HANDLE]
+_ntdll.NtSuspendProcess.restype = wintypes.LONG
+_ntdll.NtResumeProcess.argtypes = [wintypes.HANDLE]
+_ntdll.NtResumeProcess.restype = wintypes.LONG
+
+_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+_kernel32.QueryInformationJobObject.argtypes = [
+    wintypes.HANDLE,
+    ctypes.c_int,
+    ctypes.c_void_p,
+    wintypes.DWORD,
+    ctypes.POINTER(wintypes.DWORD),
+]
+_kernel32.QueryInformationJobObject.restype = wintypes.BOOL
+
+# JOBOBJECTINFOCLASS value not exported by win32job (Windows 10 and later)
+_JOB_OBJECT_MEMORY_USAGE_INFORMATION = 28
+
+
+class _JobMemoryUsageInformation(ctypes.Structure):
+    _fields_ = [("JobMemory", ctypes.c_uint64), ("PeakJobMemoryUsed", ctypes.c_uint64)]
+
+
+_JOB_NAME_PREFIX = "Local\\jupyterhub-winlocalprocessspawner-"
+
+
+def job_name(unique_id: str) -> str:
+    """Returns the session-local name of the job object with the given unique id."""
+    return _JOB_NAME_PREFIX + unique_id
+
+
+def create_job(name: str) -> pywintypes.HANDLEType:
+    """Creates a named job object and returns a handle to it."""
+    return win32job.CreateJobObject(None, name)
+
+
+def open_job(name: str) -> pywintypes.HANDLEType:
+    """Opens an existing named job object and returns a handle to it."""
+    return win32job.OpenJobObject(win32job.JOB_OBJECT_ALL_ACCESS, False, name)
+
+
+def pin_job(job_handle: pywintypes.HANDLEType, process_handle: pywintypes.HANDLEType):
+    """Keeps the job object, and so its name, alive for as long as the given process runs.
+
+    Windows drops the name of a job object once its last handle is closed, even if processes are
+    still assigned to it. A handle duplicated into the server's own process lets open_job() find
+    the job after the Hub or launcher that created it restarted. The duplicate only grants
+    SYNCHRONIZE, which lets the process do nothing but wait on the job.
+    """
+    win32api.DuplicateHandle(
+        win32api.GetCurrentProcess(), job_handle, process_handle, win32con.SYNCHRONIZE, False, 0
+    ).Detach()
+
+
+def get_job_pids(job_handle: pywintypes.HANDLEType) -> list:
+    """Returns the ids of all processes currently assigned to the job."""
+    return list(
+        win32job.QueryInformationJobObject(job_handle, win32job.JobObjectBasicProcessIdList)
+    )
+
+
+def get_working_set_size(pids) -> int:
+    """Returns the summed working set size, in bytes, of the given processes.
+
+    Processes that exited or cannot be opened are skipped.
+    """
+    total = 0
+    for pid in pids:
+        try:
+            process_handle = win32api.OpenProcess(
+                win32con.PROCESS_QUERY_INFORMATION | win32con.PROCESS_VM_READ, False, pid
+            )
+        except pywintypes.error:
+            continue
+        try:
+            total += win32process.GetProcessMemoryInfo(process_handle)["WorkingSetSize"]
+        except pywintypes.error:
+            pass
+        finally:
+            win32api.CloseHandle(process_handle)
+    return total
+
+
+def get_job_memory(job_handle: pywintypes.HANDLEType):
+    """Returns the private memory, in bytes, currently committed by all processes in the job.
+
+    Returns None on Windows versions that do not report it.
+    """
+    info = _JobMemoryUsageInformation()
+    if not _kernel32.QueryInformationJobObject(
+        int(job_handle),
+        _JOB_OBJECT_MEMORY_USAGE_INFORMATION,
+        ctypes.byref(info),
+        ctypes.sizeof(info),
+        None,
+    ):
+        return None
+    return info.JobMemory
+
+
+def get_job_accounting(job_handle: pywintypes.HANDLEType) -> dict:
+    """Returns the resources used by all processes of the job, past and present.
+
+    Asks the job object itself, so the cost does not grow with the number of processes in it.
+    The returned dict holds the total CPU time in seconds (cpu_seconds), the bytes read, written
+    and transferred otherwise (io_read_bytes, io_write_bytes, io_other_bytes), the number of
+    processes currently in the job (active_processes), the peak (peak_memory_bytes) and current
+    (memory_bytes, None if unknown) private memory committed by the job.
+    """
+    accounting = win32job.QueryInformationJobObject(
+        job_handle, win32job.JobObjectBasicAndIoAccountingInformation
+    )
+    limits = win32job.QueryInformationJobObject(
+        job_handle, win32job.JobObjectExtendedLimitInformation
+    )
+    basic, io = accounting["BasicInfo"], accounting["IoInfo"]
+    return {
+        # in units of 100 ns
+        "cpu_seconds": (basic["TotalUserTime"] + basic["TotalKernelTime"]) / 10**7,
+        "io_read_bytes": io["ReadTransferCount"],
+        "io_write_bytes": io["WriteTransferCount"],
+        "io_other_bytes": io["OtherTransferCount"],
+        "active_processes": basic["ActiveProcesses"],
+        "peak_memory_bytes": limits["PeakJobMemoryUsed"],
+        "memory_bytes": get_job_memory(job_handle),
+    }
+
+
+def trim_working_sets(pids) -> int:
+    """Removes as many pages as possible from the working set of each given process.
+
+    Trimmed pages stay in the standby list, so they are faulted back in cheaply if the process
+    touches them again. Processes that exited or cannot be opened are skipped.
+
+    Returns the number of working set bytes reclaimed.
+    """
+    reclaimed = 0
+    for pid in pids:
+        try:
+            process_handle = win32api.OpenProcess(
+                win32con.PROCESS_QUERY_INFORMATION
+                | win32con.PROCESS_VM_READ
+                | win32con.PROCESS_SET_QUOTA,
+                False,
+                pid,
+            )
+        except pywintypes.error:
+            continue
+        try:
+            before = win32process.GetProcessMemoryInfo(process_handle)["WorkingSetSize"]
+            win32process.SetProcessWorkingSetSize(process_handle, _SIZE_T_MAX, _SIZE_T_MAX)
+            after = win32process.GetProcessMemoryInfo(process_handle)["WorkingSetSize"]
+            reclaimed += max(0, before - after)
+        except pywintypes.error:
+            pass
+        finally:
+            win32api.CloseHandle(process_handle)
+    return reclaimed
+
+
+def trim_job(job_handle: pywintypes.HANDLEType, min_working_set: int = 0) -> int:
+    """Trims the working sets of all processes in the job, if they use at least min_working_set.
+
+    Returns the number of working set bytes reclaimed, which is 0 if the job was left untouched.
+    """
+    pids = get_job_pids(job_handle)
+    if not pids or get_working_set_size(pids) < min_working_set:
+        return 0
+    return trim_working_sets(pids)
+
+
+def _for_each_process(pids, access, nt_function) -> int:
+    done = 0
+    for pid in pids:
+        try:
+            process_handle = win32api.OpenProcess(access, False, pid)
+        except pywintypes.error:
+            continue
+        try:
+            if nt_function(int(process_handle)) == 0:
+                done += 1
+        finally:
+            win32api.CloseHandle(process_handle)
+    return done
+
+
+def suspend_processes(pids) -> int:
+    """Suspends all threads of the given processes. Returns how many processes were suspended."""
+    return _for_each_process(pids, PROCESS_SUSPEND_RESUME, _ntdll.NtSuspendProcess)
+
+
+def resume_processes(pids) -> int:
+    """Resumes all threads of the given processes. Returns how many processes were resumed."""
+    return _for_each_process(pids, PROCESS_SUSPEND_RESUME, _ntdll.NtResumeProcess)
+
+
+def suspend_job(job_handle: pywintypes.HANDLEType) -> int:
+    """Suspends all processes in the job, then trims their working sets.
+
+    Returns the number of working set bytes reclaimed.
+    """
+    pids = get_job_pids(job_handle)
+    suspend_processes(pids)
+    return trim_working_sets(pids)
+
+
+def resume_job(job_handle: pywintypes.HANDLEType) -> int:
+    """Resumes all processes in the job. Returns how many processes were resumed."""
+    return resume_processes(get_job_pids(job_handle))
+
+
+def terminate_job(job_handle: pywintypes.HANDLEType, exit_code: int = 1):
+    """Terminates all processes in the job, including suspended ones."""
+    win32job.TerminateJobObject(job_handle, exit_code)
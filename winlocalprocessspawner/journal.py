@@ -0,0 +1,160 @@
+"""In-memory journal of the spawns, stops and exits of servers, with rolling statistics."""
+
+import bisect
+import math
+import time
+from collections import Counter, deque
+
+import pywintypes
+
+EVENTS = ("spawn", "stop", "exit")
+
+# Results of a spawn: launched, failed, or rejected before launching (rate limits, crash loop
+# backoff, host pressure)
+SPAWN_RESULTS = ("ok", "failed", "rejected")
+
+
+def win32_error(exc):
+    """Returns {"winerror": code, "message": ...} of the Win32 error behind exc, or None.
+
+    Follows the causes and contexts of exc, so that errors wrapped by other exceptions are found.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, pywintypes.error):
+            return {
+                "winerror": exc.winerror,
+                "message": "{}: {}".format(exc.funcname, exc.strerror),
+            }
+        if isinstance(exc, OSError) and getattr(exc, "winerror", None):
+            return {"winerror": exc.winerror, "message": exc.strerror}
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+class RollingPercentiles:
+    """Percentiles of the latest `size` values, updated in O(size) per value.
+
+    The values are kept sorted as they are added, so reading a percentile is O(1).
+    """
+
+    def __init__(self, size):
+        """Create a new RollingPercentiles without values."""
+        self.size = size
+        self._window = deque()
+        self._sorted = []
+
+    def __len__(self):
+        """Number of values in the window."""
+        return len(self._window)
+
+    def add(self, value):
+        """Add a value, dropping the oldest one if the window is full."""
+        if len(self._window) >= self.size:
+            oldest = self._window.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._window.append(value)
+        bisect.insort(self._sorted, value)
+
+    def percentile(self, percent):
+        """Returns the nearest-rank percentile of the values in the window, or None if empty."""
+        if not self._sorted:
+            return None
+        rank = math.ceil(percent / 100 * len(self._sorted))
+        return self._sorted[max(rank, 1) - 1]
+
+
+class SpawnJournal:
+    """Bounded journal of spawn, stop and exit events.
+
+    Keeps the latest `size` events, and statistics updated as events are recorded: totals since
+    the Hub started, the failure rates over the latest `window` spawns, and the percentiles of
+    the phase durations of the latest `window` successful spawns.
+    """
+
+    def __init__(self, size=1000, window=200, clock=time.time):
+        """Create a new, empty SpawnJournal."""
+        self.window = window
+        self._clock = clock
+        self._events = deque(maxlen=size)
+        self._totals = Counter()
+        self._recent_results = deque()
+        self._recent_counts = Counter()
+        self._phases = {}
+
+    @property
+    def size(self):
+        """Maximum number of events kept."""
+        return self._events.maxlen
+
+    def resize(self, size):
+        """Change the maximum number of events kept, dropping the oldest ones if needed."""
+        if size != self._events.maxlen:
+            self._events = deque(self._events, maxlen=size)
+
+    def record(self, event, user, server="", **fields):
+        """Record an event.
+
+        :param event: One of EVENTS.
+        :param fields: pid, exit_code, error (see win32_error), and for spawns result (one of
+            SPAWN_RESULTS) and durations ({phase: seconds}).
+        """
+        entry = dict(fields, time=self._clock(), event=event, user=user, server=server)
+        self._events.append(entry)
+        self._totals[event] += 1
+        if event == "spawn":
+            self._record_spawn(entry.get("result", "ok"), entry.get("durations") or {})
+        elif event == "exit" and entry.get("exit_code"):
+            self._totals["exit_errors"] += 1
+        return entry
+
+    def _record_spawn(self, result, durations):
+        self._totals["spawn_" + result] += 1
+        if len(self._recent_results) >= self.window:
+            self._recent_counts[self._recent_results.popleft()] -= 1
+        self._recent_results.append(result)
+        self._recent_counts[result] += 1
+        if result != "ok":
+            return
+        for phase, seconds in durations.items():
+            if phase not in self._phases:
+                self._phases[phase] = RollingPercentiles(self.window)
+            self._phases[phase].add(seconds)
+
+    def events(self, limit=None, user=None, event=None):
+        """Returns the latest events, oldest first, optionally only those of a user or kind."""
+        events = [
+            entry
+            for entry in self._events
+            if (user is None or entry["user"] == user)
+            and (event is None or entry["event"] == event)
+        ]
+        if limit is not None:
+            events = events[-limit:] if limit else []
+        return events
+
+    def stats(self):
+        """Returns the statistics of the journal, as a JSON-serializable dict."""
+        recent = len(self._recent_results)
+        return {
+            "spawns": {
+                "total": self._totals["spawn"],
+                **{result: self._totals["spawn_" + result] for result in SPAWN_RESULTS},
+            },
+            "stops": self._totals["stop"],
+            "exits": {"total": self._totals["exit"], "errors": self._totals["exit_errors"]},
+            "window": {
+                "spawns": recent,
+                "failure_rate": self._recent_counts["failed"] / recent if recent else None,
+                "rejection_rate": self._recent_counts["rejected"] / recent if recent else None,
+            },
+            "phases": {
+                phase: {
+                    "samples": len(percentiles),
+                    "p50": percentiles.percentile(50),
+                    "p95": percentiles.percentile(95),
+                }
+                for phase, percentiles in sorted(self._phases.items())
+            },
+        }
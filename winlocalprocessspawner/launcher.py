@@ -0,0 +1,942 @@
+"""Launcher service running the privileged part of WinLocalProcessSpawner in its own process.
+
+The Hub talks to the launcher over a named pipe, or a localhost TCP socket for testing, with
+newline-delimited JSON messages. Each request carries an id, echoed by its response, so that
+requests can be batched and pipelined, and are answered as soon as each of them completes:
+
+    {"id": 1, "op": "launch", "cmd": [...], "env": {...}, "cwd": "...", "token": {...}}
+    {"id": 1, "result": {"pid": 4242, "job_id": "..."}}
+    {"id": 2, "error": {"type": "PermissionError", "message": "..."}}
+
+The launcher also streams events, which have no id, e.g. when a process it launched exits:
+
+    {"event": "exit", "pid": 4242, "exit_code": 1}
+
+The first request of a connection must be a "hello" carrying the key of the launcher. Tokens are
+passed either as {"pid": ..., "handle": ...}, a token handle of the Hub process that the launcher
+duplicates, accepted over named pipes only, as {"username": ..., "password": ...}, a service
+logon cached by the launcher, or as {"user": ...}, resolved by the token provider of the launcher.
+
+The same service runs as an agent on other hosts, serving TCP over TLS, for the Hub to spread
+servers over several hosts. Since token handles of the Hub are meaningless there, agents log users
+on with their token provider, and the Hub sends no "cwd": servers start in the USERPROFILE of their
+environment on the agent's host, or in a temporary directory.
+
+Run the service with `winlocalprocessspawner-launcher`, see `main()`.
+"""
+
+import argparse
+import asyncio
+import hmac
+import importlib
+import ipaddress
+import json
+import logging
+import os
+import socket
+import ssl
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+import ntsecuritycon
+import pywintypes
+import win32api
+import win32con
+import win32event
+import win32file
+import win32job
+import win32pipe
+import win32process
+import win32profile
+import win32security
+import winerror
+
+from . import hostpressure, job_utils, token_utils
+from .win_utils import PopenAsUser
+
+logger = logging.getLogger("winlocalprocessspawner.launcher")
+
+DEFAULT_ADDRESS = "pipe:jupyterhub-winlocalprocessspawner"
+
+KEY_ENV_VAR = "WINLOCALPROCESSSPAWNER_LAUNCHER_KEY"
+
+PIPE_PREFIX = "\\\\.\\pipe\\"
+
+# Maximum size of a message, large enough for the environment of a server
+MESSAGE_LIMIT = 2**20
+
+# Access to the processes adopted after a restart of the launcher. Not exported by win32con.
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+# Adopted processes are stopped through their job.
+_ADOPTED_PROCESS_ACCESS = win32con.SYNCHRONIZE | PROCESS_QUERY_LIMITED_INFORMATION
+
+# CreateNamedPipe flags not exported by win32pipe
+FILE_FLAG_FIRST_PIPE_INSTANCE = 0x00080000
+PIPE_REJECT_REMOTE_CLIENTS = 0x00000008
+
+# Access of the accounts allowed to connect to the pipe, the GENERIC_READ | GENERIC_WRITE that
+# clients ask for. For pipes, it includes the right to create instances of the pipe, so only
+# trusted accounts should be allowed.
+PIPE_CLIENT_ACCESS = ntsecuritycon.FILE_GENERIC_READ | ntsecuritycon.FILE_GENERIC_WRITE
+
+# Exceptions re-raised as themselves by the client, the others are raised as LauncherError
+_BUILTIN_ERRORS = {
+    error.__name__: error
+    for error in (PermissionError, FileNotFoundError, TimeoutError, ValueError, KeyError)
+}
+
+
+class LauncherError(Exception):
+    """Error reported by the launcher for a request."""
+
+    def __init__(self, type_name, message):
+        """Create a new LauncherError from the type name and message of the original error."""
+        super().__init__("{}: {}".format(type_name, message))
+        self.type_name = type_name
+
+
+def parse_address(address):
+    r"""Returns ("pipe", pipe name) or ("tcp", host, port) for a launcher address.
+
+    Addresses are "pipe:<name>", a full pipe name like \\.\pipe\<name>, or "tcp:<host>:<port>".
+    """
+    if address.startswith(PIPE_PREFIX):
+        return ("pipe", address)
+    scheme, _, rest = address.partition(":")
+    if scheme == "pipe" and rest:
+        return ("pipe", PIPE_PREFIX + rest)
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host and port.isdigit():
+            return ("tcp", host, int(port))
+    raise ValueError("Invalid launcher address: {!r}".format(address))
+
+
+def is_loopback_address(address):
+    """Returns whether a launcher address can only be reached from the local host."""
+    kind, *location = parse_address(address)
+    if kind == "pipe":
+        return True
+    host = location[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def server_ssl_context(certfile, keyfile=None, cafile=None):
+    """Returns the SSLContext of a launcher serving TCP over TLS.
+
+    With cafile, clients must present a certificate issued by one of its CAs.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=cafile)
+    context.load_cert_chain(certfile, keyfile)
+    if cafile:
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def client_ssl_context(cafile=None, certfile=None, keyfile=None):
+    """Returns the SSLContext of a client of launchers serving TCP over TLS.
+
+    The certificates of the launchers are verified against cafile, or the CAs of the system.
+    certfile is the certificate presented to launchers requiring one.
+    """
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def encode_message(message):
+    """Returns the line sent over the wire for a message."""
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def decode_message(line):
+    """Returns the message sent as a line over the wire."""
+    message = json.loads(line.decode("utf-8"))
+    if not isinstance(message, dict):
+        raise ValueError("Invalid message: {!r}".format(message))
+    return message
+
+
+def pipe_dacl(allow=()):
+    """Returns the DACL of the launcher's named pipe.
+
+    Local System, administrators and the account running the launcher get full access. The
+    accounts and groups named in allow, such as the account of the Hub, get PIPE_CLIENT_ACCESS.
+    """
+    dacl = win32security.ACL()
+    for sid in [
+        token_utils.current_user_sid(),
+        win32security.CreateWellKnownSid(win32security.WinLocalSystemSid),
+        win32security.CreateWellKnownSid(win32security.WinBuiltinAdministratorsSid),
+    ]:
+        dacl.AddAccessAllowedAce(win32security.ACL_REVISION, ntsecuritycon.FILE_ALL_ACCESS, sid)
+    for account in allow:
+        sid = win32security.LookupAccountName(None, account)[0]
+        dacl.AddAccessAllowedAce(win32security.ACL_REVISION, PIPE_CLIENT_ACCESS, sid)
+    return dacl
+
+
+def pipe_security_attributes(allow=()):
+    """Returns the SECURITY_ATTRIBUTES of the launcher's named pipe, with pipe_dacl(allow)."""
+    descriptor = win32security.SECURITY_DESCRIPTOR()
+    descriptor.SetSecurityDescriptorDacl(True, pipe_dacl(allow), False)
+    attributes = win32security.SECURITY_ATTRIBUTES()
+    attributes.SECURITY_DESCRIPTOR = descriptor
+    return attributes
+
+
+class _PipeServer:
+    """Named pipe server of the proactor event loop, closed like an asyncio.Server.
+
+    The loop's own start_serving_pipe creates the pipe with the default security descriptor,
+    which only lets Local System, administrators and the creator of the pipe write to it. This
+    server creates each instance of the pipe with the given SECURITY_ATTRIBUTES instead.
+    """
+
+    def __init__(self, address, security_attributes, protocol_factory):
+        """Create a new _PipeServer, and the first instance of its pipe."""
+        self._address = address
+        self._security_attributes = security_attributes
+        self._protocol_factory = protocol_factory
+        self._loop = asyncio.get_event_loop()
+        self._accept_future = None
+        # the instance waiting for a client
+        self._accepting = None
+        # A spare instance always exists while serving, so that clients connecting while the
+        # next instance is being set up do not fail with FileNotFoundError
+        self._pipe = self._create_pipe(first=True)
+
+    def _create_pipe(self, first=False):
+        # Windows only
+        from asyncio.windows_utils import BUFSIZE, PipeHandle
+
+        flags = win32pipe.PIPE_ACCESS_DUPLEX | win32file.FILE_FLAG_OVERLAPPED
+        if first:
+            # fail if another process already serves the pipe
+            flags |= FILE_FLAG_FIRST_PIPE_INSTANCE
+        handle = win32pipe.CreateNamedPipe(
+            self._address,
+            flags,
+            win32pipe.PIPE_TYPE_MESSAGE
+            | win32pipe.PIPE_READMODE_MESSAGE
+            | win32pipe.PIPE_WAIT
+            | PIPE_REJECT_REMOTE_CLIENTS,
+            win32pipe.PIPE_UNLIMITED_INSTANCES,
+            BUFSIZE,
+            BUFSIZE,
+            win32pipe.NMPWAIT_WAIT_FOREVER,
+            self._security_attributes,
+        )
+        return PipeHandle(handle.Detach())
+
+    def serve(self):
+        """Start accepting connections."""
+        self._loop.call_soon(self._accept)
+
+    def _accept(self, future=None):
+        if future is not None:
+            pipe, self._accepting = self._accepting, None
+            try:
+                future.result()
+            except asyncio.CancelledError:
+                pipe.close()
+                return
+            except OSError as exc:
+                pipe.close()
+                if not isinstance(exc, BrokenPipeError):
+                    logger.warning("Failed to accept a client on %s: %s", self._address, exc)
+            else:
+                if self._address is None:
+                    # a client connected while the server was closed
+                    pipe.close()
+                    return
+                self._loop._make_duplex_pipe_transport(
+                    pipe, self._protocol_factory(), extra={"addr": self._address}
+                )
+        if self._address is None:
+            return
+        try:
+            self._accepting, self._pipe = self._pipe, self._create_pipe()
+            future = self._loop._proactor.accept_pipe(self._accepting)
+        except (OSError, pywintypes.error) as exc:
+            logger.warning("Failed to serve a new instance of %s: %s", self._address, exc)
+            if self._accepting is not None:
+                self._accepting.close()
+                self._accepting = None
+            self._loop.call_later(1, self._accept)
+            return
+        self._accept_future = future
+        future.add_done_callback(self._accept)
+
+    def close(self):
+        """Stop accepting connections."""
+        self._address = None
+        if self._accept_future is not None:
+            # its callback closes the instance waiting for a client
+            self._accept_future.cancel()
+            self._accept_future = None
+        if self._pipe is not None:
+            self._pipe.close()
+            self._pipe = None
+
+    async def wait_closed(self):
+        """Named pipe servers are closed right away."""
+
+
+async def start_server(client_connected_cb, address, allow=(), ssl_context=None):
+    """Serve connections on a launcher address, calling client_connected_cb(reader, writer).
+
+    Named pipes require the proactor event loop, the default on Windows. Only Local System,
+    administrators, the account running the launcher, and the accounts and groups named in allow
+    can connect to them. TCP connections use TLS if an ssl_context is given.
+    Returns an object with the close() and wait_closed() methods of asyncio.Server.
+    """
+    kind, *location = parse_address(address)
+    if kind == "tcp":
+        return await asyncio.start_server(
+            client_connected_cb, *location, limit=MESSAGE_LIMIT, ssl=ssl_context
+        )
+
+    def protocol_factory():
+        reader = asyncio.StreamReader(limit=MESSAGE_LIMIT)
+        return asyncio.StreamReaderProtocol(reader, client_connected_cb)
+
+    server = _PipeServer(location[0], pipe_security_attributes(allow), protocol_factory)
+    server.serve()
+    return server
+
+
+async def open_connection(address, ssl_context=None):
+    """Connect to a launcher address. Returns a (reader, writer) pair, like asyncio's.
+
+    TCP connections use TLS if an ssl_context is given.
+    """
+    kind, *location = parse_address(address)
+    if kind == "tcp":
+        return await asyncio.open_connection(*location, limit=MESSAGE_LIMIT, ssl=ssl_context)
+
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=MESSAGE_LIMIT)
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.create_pipe_connection(lambda: protocol, location[0])
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+
+def _client_pid(writer):
+    """Returns the process id of the client of a named pipe connection, None for TCP."""
+    pipe = writer.get_extra_info("pipe")
+    handle = getattr(pipe, "handle", None)
+    if handle is None:
+        return None
+    try:
+        return win32pipe.GetNamedPipeClientProcessId(handle)
+    except pywintypes.error:
+        return None
+
+
+class LauncherClient:
+    """Connection of the Hub to a launcher service, shared by all spawners using it.
+
+    Requests are pipelined over a single connection, opened on first use and reopened after it
+    was lost. Exit events sent by the launcher are kept, so that polling an exited server does
+    not need a round trip.
+    """
+
+    # Number of exit codes kept for servers that were not polled since they exited
+    max_exit_codes = 10000
+
+    def __init__(self, address, key="", ssl_context=None):
+        """Create a new LauncherClient for the launcher at address, not connected yet.
+
+        :param ssl_context: The client SSLContext of a launcher serving TCP over TLS.
+        """
+        self.address = address
+        self.key = key
+        self.ssl_context = ssl_context
+        self._writer = None
+        self._connect_lock = None
+        self._next_id = 0
+        self._pending = {}
+        self._exit_codes = OrderedDict()
+        self._exit_callbacks = {}
+
+    async def _ensure_connected(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            reader, writer = await open_connection(self.address, self.ssl_context)
+            self._writer = writer
+            asyncio.ensure_future(self._read_loop(reader, writer))
+            (hello,) = self._send([("hello", {"key": self.key})])
+            await writer.drain()
+            await hello
+
+    async def request(self, op, **params):
+        """Send a request, and return its result."""
+        (result,) = await self.request_batch([(op, params)])
+        return result
+
+    async def request_batch(self, requests):
+        """Send several (op, params) requests at once, and return their results in order.
+
+        If any request failed, the error of the first one is raised.
+        """
+        await self._ensure_connected()
+        futures = self._send(requests)
+        await self._writer.drain()
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _send(self, requests):
+        loop = asyncio.get_event_loop()
+        futures = []
+        lines = []
+        for op, params in requests:
+            self._next_id += 1
+            futures.append(loop.create_future())
+            self._pending[self._next_id] = futures[-1]
+            lines.append(encode_message(dict(params, id=self._next_id, op=op)))
+        self._writer.write(b"".join(lines))
+        return futures
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._dispatch(decode_message(line))
+        except (ConnectionError, ValueError) as exc:
+            logger.warning("Lost connection to launcher %s: %s", self.address, exc)
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError("Lost connection to launcher {}".format(self.address))
+                    )
+
+    def _dispatch(self, message):
+        if message.get("event") == "exit":
+            self._record_exit(message["pid"], message["exit_code"])
+            return
+        future = self._pending.pop(message.get("id"), None)
+        if future is None or future.done():
+            return
+        error = message.get("error")
+        if error is None:
+            future.set_result(message.get("result"))
+            return
+        error_class = _BUILTIN_ERRORS.get(error.get("type"))
+        if error_class is not None:
+            future.set_exception(error_class(error.get("message")))
+        else:
+            future.set_exception(LauncherError(error.get("type"), error.get("message")))
+
+    def _record_exit(self, pid, exit_code):
+        self._exit_codes[pid] = exit_code
+        while len(self._exit_codes) > self.max_exit_codes:
+            self._exit_codes.popitem(last=False)
+        callback = self._exit_callbacks.pop(pid, None)
+        if callback is not None:
+            callback(exit_code)
+
+    def on_exit(self, pid, callback):
+        """Call callback(exit_code) once the launcher reports that the process exited."""
+        self._exit_callbacks[pid] = callback
+
+    def forget(self, pid):
+        """Drop the exit code and exit callback of a process."""
+        self._exit_codes.pop(pid, None)
+        self._exit_callbacks.pop(pid, None)
+
+    async def poll(self, pid, job_id=None):
+        """Return the exit code of a launched process, or None if it is still running."""
+        if pid in self._exit_codes:
+            return self._exit_codes[pid]
+        result = await self.request("poll", pid=pid, job_id=job_id)
+        return result["exit_code"]
+
+    async def stop(self, pid, job_id=None):
+        """Terminate a launched process and the processes of its job. Returns its exit code."""
+        result = await self.request("stop", pid=pid, job_id=job_id)
+        self._record_exit(pid, result["exit_code"])
+        return result["exit_code"]
+
+    def close(self):
+        """Close the connection to the launcher."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class _LaunchedServer:
+    """A process started by the launcher, and the job object grouping its processes."""
+
+    def __init__(self, pid, proc, job, job_id, process=None):
+        """Create a new _LaunchedServer.
+
+        Servers adopted after a restart of the launcher have no proc, but a process handle and a
+        job.
+        """
+        self.pid = pid
+        self.proc = proc
+        self.job = job
+        self.job_id = job_id
+        self.process = process
+
+    def poll(self):
+        """Returns the exit code of the process, or None if it is still running."""
+        if self.proc is not None:
+            return self.proc.poll()
+        exit_code = win32process.GetExitCodeProcess(self.process)
+        return None if exit_code == win32con.STILL_ACTIVE else exit_code
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the process to exit."""
+        if self.proc is not None:
+            self.proc.wait(timeout=timeout)
+        else:
+            win32event.WaitForSingleObject(self.process, int(timeout * 1000))
+
+    def terminate(self):
+        """Terminate the process, and the processes it started if it has a job."""
+        if self.job is not None:
+            job_utils.terminate_job(self.job)
+        else:
+            self.proc.terminate()
+
+    def close(self):
+        """Release the job object and the process handle of the process."""
+        if self.job is not None:
+            self.job.Close()
+            self.job = None
+        if self.process is not None:
+            self.process.Close()
+            self.process = None
+
+
+class LauncherService:
+    """Launches, polls and stops single-user servers on behalf of the Hub.
+
+    The service holds the privileges needed to call CreateProcessAsUser and to load user
+    profiles, so that the Hub does not need them. It keeps service logon tokens and profile
+    environments cached between launches, and reports exits of the processes it launched to all
+    connected Hubs.
+    """
+
+    # Number of exit codes kept for servers that exited, for Hubs polling them later
+    max_exit_codes = 10000
+
+    def __init__(
+        self,
+        key="",
+        token_cache_ttl=300,
+        profile_cache_ttl=300,
+        poll_interval=1,
+        token_provider=None,
+        allow=(),
+        ssl_context=None,
+    ):
+        """Create a new LauncherService accepting clients presenting key.
+
+        :param token_provider: A callable returning a token handle for a user name, owned by the
+            caller, for {"user": ...} token specs. None rejects them.
+        :param allow: The accounts and groups, besides Local System, administrators and the
+            account of the launcher, allowed to connect to its named pipe.
+        :param ssl_context: The server SSLContext of a launcher serving TCP over TLS.
+        """
+        self.key = key
+        self.allow = tuple(allow)
+        self.ssl_context = ssl_context
+        self.token_provider = token_provider
+        self.profile_cache_ttl = profile_cache_ttl
+        self.poll_interval = poll_interval
+        self.token_cache = token_utils.ServiceTokenCache(ttl=token_cache_ttl)
+        self.host_pressure = hostpressure.HostPressureSampler()
+        # username -> (profile environment, expiry time)
+        self._profile_envs = {}
+        # pid -> _LaunchedServer
+        self._servers = {}
+        self._exit_codes = OrderedDict()
+        self._connections = set()
+        self._server = None
+        self._watch_task = None
+
+    async def start(self, address):
+        """Start serving the launcher protocol on address."""
+        self._server = await start_server(
+            self._handle_connection, address, self.allow, self.ssl_context
+        )
+        self._watch_task = asyncio.ensure_future(self._watch_exits())
+
+    async def close(self):
+        """Stop serving, and close all connections. Launched servers keep running."""
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._connections):
+            writer.close()
+
+    async def _handle_connection(self, reader, writer):
+        client_pid = _client_pid(writer)
+        authenticated = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = decode_message(line)
+                except ValueError as exc:
+                    self._send(writer, _error_response(None, exc))
+                    continue
+                if authenticated:
+                    asyncio.ensure_future(self._handle_request(message, writer, client_pid))
+                elif message.get("op") == "hello" and hmac.compare_digest(
+                    str(message.get("key", "")).encode("utf-8"), self.key.encode("utf-8")
+                ):
+                    authenticated = True
+                    self._connections.add(writer)
+                    self._send(writer, {"id": message.get("id"), "result": {}})
+                else:
+                    logger.warning("Rejected launcher client presenting an invalid key")
+                    error = PermissionError("Invalid launcher key")
+                    self._send(writer, _error_response(message.get("id"), error))
+                    break
+        except (ConnectionError, ValueError) as exc:
+            logger.info("Launcher client disconnected: %s", exc)
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, message, writer, client_pid):
+        op = message.get("op")
+        handler = getattr(self, "_op_" + op, None) if isinstance(op, str) else None
+        try:
+            if handler is None:
+                raise ValueError("Unknown launcher operation: {!r}".format(op))
+            response = {"id": message.get("id"), "result": await handler(message, client_pid)}
+        except Exception as exc:
+            response = _error_response(message.get("id"), exc)
+        self._send(writer, response)
+
+    def _send(self, writer, message):
+        if not writer.is_closing():
+            writer.write(encode_message(message))
+
+    def _token(self, spec, client_pid):
+        """Returns a token handle owned by the launcher for a token spec, or None."""
+        if not spec:
+            return None
+        if "username" in spec:
+            return self.token_cache.get_token(spec["username"], spec["password"])
+        if "user" in spec:
+            if self.token_provider is None:
+                raise PermissionError("This launcher has no token provider to log users on")
+            return self.token_provider(spec["user"])
+        # The token can only come from the client process itself, whose pid is known for named
+        # pipe connections only: other clients could get the token of any process on the host
+        if client_pid is None:
+            raise PermissionError("Token handles can only be passed over a named pipe")
+        return token_utils.duplicate_token_from_process(client_pid, spec["handle"])
+
+    def _load_profile_env(self, spec, client_pid):
+        token = self._token(spec, client_pid)
+        try:
+            return dict(win32profile.CreateEnvironmentBlock(token, False))
+        finally:
+            if token:
+                token.Close()
+
+    async def _op_profile_env(self, message, client_pid):
+        username = message.get("username")
+        now = time.monotonic()
+        cached = self._profile_envs.get(username)
+        if username and cached is not None and cached[1] > now:
+            return cached[0]
+
+        profile_env = await asyncio.get_event_loop().run_in_executor(
+            None, self._load_profile_env, message.get("token"), client_pid
+        )
+        if username and self.profile_cache_ttl:
+            for expired in [
+                name for name, (_, expiry) in self._profile_envs.items() if expiry <= now
+            ]:
+                del self._profile_envs[expired]
+            self._profile_envs[username] = (profile_env, now + self.profile_cache_ttl)
+        return profile_env
+
+    def _launch(self, message, client_pid):
+        token = self._token(message.get("token"), client_pid)
+        job_id = uuid.uuid4().hex
+        job = None
+        try:
+            try:
+                job = job_utils.create_job(job_utils.job_name(job_id))
+            except pywintypes.error as exc:
+                logger.warning("Failed to create job object: %s", exc)
+                job_id = None
+            proc = PopenAsUser(
+                message["cmd"],
+                token=token,
+                cwd=message.get("cwd") or _server_cwd(message.get("env") or {}),
+                env=message.get("env"),
+                job=job,
+                **message.get("popen_kwargs", {})
+            )
+        except BaseException:
+            if job is not None:
+                job.Close()
+            raise
+        finally:
+            if token:
+                token.Close()
+        return _LaunchedServer(proc.pid, proc, job, job_id)
+
+    async def _op_launch(self, message, client_pid):
+        server = await asyncio.get_event_loop().run_in_executor(
+            None, self._launch, message, client_pid
+        )
+        self._servers[server.pid] = server
+        logger.info("Launched %s with pid %i", message["cmd"][0], server.pid)
+        return {"pid": server.pid, "job_id": server.job_id}
+
+    async def _op_status(self, message, client_pid):
+        return {
+            "servers": len(self._servers),
+            "pressure": self.host_pressure.sample()._asdict(),
+        }
+
+    async def _op_random_port(self, message, client_pid):
+        return {"port": _free_port()}
+
+    def _adopt(self, pid, job_id):
+        """Returns the server of a process launched before a restart of the launcher.
+
+        A process is only adopted if it is still in the job it was launched in: its pid alone
+        may have been reused by an unrelated process since the server exited. Returns None if the
+        server exited. Raises pywintypes.error if its job exists but the process cannot be
+        opened.
+        """
+        if not job_id:
+            return None
+        try:
+            # the server keeps its job alive for as long as it runs, see job_utils.pin_job
+            job = job_utils.open_job(job_utils.job_name(job_id))
+        except pywintypes.error as exc:
+            logger.info("Job object of process %i is gone: %s", pid, exc)
+            return None
+        process = None
+        adopted = False
+        try:
+            try:
+                process = win32api.OpenProcess(_ADOPTED_PROCESS_ACCESS, False, pid)
+            except pywintypes.error as exc:
+                if exc.winerror == winerror.ERROR_INVALID_PARAMETER:
+                    return None
+                raise
+            if not win32job.IsProcessInJob(process, job):
+                logger.warning("Process %i is not in the job object of its server", pid)
+                return None
+            adopted = True
+            return _LaunchedServer(pid, None, job, job_id, process=process)
+        finally:
+            if not adopted:
+                job.Close()
+                if process is not None:
+                    process.Close()
+
+    async def _get_server(self, message):
+        """Returns the server of a request, adopting it if it was launched before a restart.
+
+        Returns None if the process exited.
+        """
+        pid = message["pid"]
+        server = self._servers.get(pid)
+        if server is None and pid not in self._exit_codes:
+            server = await asyncio.get_event_loop().run_in_executor(
+                None, self._adopt, pid, message.get("job_id")
+            )
+            if server is not None:
+                logger.info("Adopted process %i launched before a restart", pid)
+                self._servers[pid] = server
+        return server
+
+    async def _op_poll(self, message, client_pid):
+        try:
+            server = await self._get_server(message)
+        except pywintypes.error as exc:
+            # Running, but out of reach: reporting an exit would make the Hub forget the server
+            logger.warning("Failed to adopt process %i: %s", message["pid"], exc)
+            return {"exit_code": None}
+        if server is None:
+            # exited while no launcher was watching it, with an exit code lost with it
+            return {"exit_code": self._exit_codes.get(message["pid"], 0)}
+        return {"exit_code": server.poll()}
+
+    async def _op_stop(self, message, client_pid):
+        server = await self._get_server(message)
+        if server is None:
+            return {"exit_code": self._exit_codes.get(message["pid"], 0)}
+
+        def terminate():
+            server.terminate()
+            server.wait(timeout=5)
+            return server.poll()
+
+        exit_code = await asyncio.get_event_loop().run_in_executor(None, terminate)
+        # terminated processes have exit code 1
+        self._forget_server(server, 1 if exit_code is None else exit_code)
+        return {"exit_code": self._exit_codes[server.pid]}
+
+    def _forget_server(self, server, exit_code):
+        self._servers.pop(server.pid, None)
+        server.close()
+        self._exit_codes[server.pid] = exit_code
+        while len(self._exit_codes) > self.max_exit_codes:
+            self._exit_codes.popitem(last=False)
+
+    async def _watch_exits(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            servers = list(self._servers.values())
+            if not servers:
+                continue
+            try:
+                exit_codes = await asyncio.get_event_loop().run_in_executor(
+                    None, lambda: [server.poll() for server in servers]
+                )
+            except Exception:
+                logger.exception("Error polling %i launched servers", len(servers))
+                continue
+            for server, exit_code in zip(servers, exit_codes):
+                if exit_code is None or self._servers.get(server.pid) is not server:
+                    continue
+                logger.info("Process %i exited with status %s", server.pid, exit_code)
+                self._forget_server(server, exit_code)
+                event = {"event": "exit", "pid": server.pid, "exit_code": exit_code}
+                for writer in list(self._connections):
+                    self._send(writer, event)
+
+
+def _server_cwd(env):
+    """Returns the working directory of a server launched without one, on this host."""
+    userprofile = env.get("USERPROFILE")
+    if userprofile and os.path.isdir(userprofile):
+        return userprofile
+    return tempfile.mkdtemp()
+
+
+def _free_port():
+    """Returns a TCP port that is currently free on this host."""
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def load_token_provider(name):
+    """Returns the callable named "module:function", used as the token provider of a launcher."""
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError("Token provider must be given as module:function, got {!r}".format(name))
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _error_response(request_id, exc):
+    return {"id": request_id, "error": {"type": type(exc).__name__, "message": str(exc)}}
+
+
+def main(argv=None):
+    """Run the launcher service until interrupted."""
+    parser = argparse.ArgumentParser(description="Launcher service for WinLocalProcessSpawner.")
+    parser.add_argument(
+        "--address",
+        default=DEFAULT_ADDRESS,
+        help="pipe:<name> or tcp:<host>:<port> to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--key-file",
+        help="file holding the key clients must present (default: ${})".format(KEY_ENV_VAR),
+    )
+    parser.add_argument(
+        "--allow",
+        action="append",
+        default=[],
+        metavar="ACCOUNT",
+        help="account or group allowed to connect to the named pipe, e.g. the account of the Hub"
+        " (repeatable)",
+    )
+    parser.add_argument(
+        "--ssl-cert",
+        help="certificate of the launcher, serving TCP over TLS, required for TCP addresses other"
+        " than the loopback",
+    )
+    parser.add_argument("--ssl-key", help="private key of --ssl-cert, if not in the same file")
+    parser.add_argument(
+        "--ssl-ca", help="CA certificates of the client certificates that clients must present"
+    )
+    parser.add_argument("--token-cache-ttl", type=float, default=300)
+    parser.add_argument("--profile-cache-ttl", type=float, default=300)
+    parser.add_argument(
+        "--token-provider",
+        help="module:function returning a token handle for a user name, for launcher agents",
+    )
+    args = parser.parse_args(argv)
+
+    if args.key_file:
+        with open(args.key_file, encoding="utf-8") as key_file:
+            key = key_file.read().strip()
+    else:
+        key = os.environ.get(KEY_ENV_VAR, "")
+    if not key:
+        parser.error("a key is required, from --key-file or ${}".format(KEY_ENV_VAR))
+    if not args.ssl_cert and not is_loopback_address(args.address):
+        parser.error("--ssl-cert is required to serve {}".format(args.address))
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s %(name)s] %(message)s")
+    service = LauncherService(
+        key=key,
+        token_cache_ttl=args.token_cache_ttl,
+        profile_cache_ttl=args.profile_cache_ttl,
+        token_provider=load_token_provider(args.token_provider) if args.token_provider else None,
+        allow=args.allow,
+        ssl_context=(
+            server_ssl_context(args.ssl_cert, args.ssl_key, args.ssl_ca) if args.ssl_cert else None
+        ),
+    )
+
+    async def serve():
+        await service.start(args.address)
+        logger.info("Launcher listening on %s", args.address)
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
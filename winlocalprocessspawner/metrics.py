@@ -0,0 +1,188 @@
+"""Prometheus metrics exported by WinLocalProcessSpawner.
+
+The metrics are registered in prometheus_client's default registry, so they are served by the
+Hub's own /hub/metrics endpoint next to JupyterHub's metrics. Names follow JupyterHub's
+`<prefix>_<noun>_<verb>_<type_suffix>` convention, with a `winlocalprocessspawner_` prefix.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+WORKING_SET_TRIMMED_BYTES = Counter(
+    "winlocalprocessspawner_working_set_trimmed_bytes",
+    "bytes of working set reclaimed from the processes of idle servers",
+)
+
+WORKING_SET_TRIMMED_SERVERS = Counter(
+    "winlocalprocessspawner_working_set_trimmed_servers",
+    "number of times an idle server had its processes' working sets trimmed",
+)
+
+WORKING_SET_TRIM_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_working_set_trim_duration_seconds",
+    "time taken to check and trim the working sets of all idle servers in one pass",
+)
+
+SUSPENDED_SERVERS = Gauge(
+    "winlocalprocessspawner_suspended_servers",
+    "number of idle servers whose processes are currently suspended",
+)
+
+SERVER_SUSPEND = Counter(
+    "winlocalprocessspawner_server_suspend",
+    "number of idle servers suspended",
+)
+
+SERVER_RESUME_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_server_resume_duration_seconds",
+    "time taken to resume a suspended server",
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, float("inf")],
+)
+
+SUSPENDED_SERVER_TIMEOUT = Counter(
+    "winlocalprocessspawner_suspended_server_timeout",
+    "number of suspended servers terminated because they were not resumed in time",
+)
+
+SPAWN_THROTTLED = Counter(
+    "winlocalprocessspawner_spawn_throttled",
+    "number of server launches deferred or rejected by the spawn rate limits",
+    ["scope", "action"],
+)
+
+CRASH_LOOP_EARLY_EXITS = Counter(
+    "winlocalprocessspawner_crash_loop_early_exits",
+    "number of servers that exited with an error shortly after being started",
+)
+
+CRASH_LOOP_SERVERS = Gauge(
+    "winlocalprocessspawner_crash_loop_servers",
+    "number of servers whose next launch is subject to a crash loop backoff",
+)
+
+CRASH_LOOP_REJECTED = Counter(
+    "winlocalprocessspawner_crash_loop_rejected",
+    "number of server launches rejected during a crash loop backoff",
+)
+
+AUTH_STATE_CACHE = Counter(
+    "winlocalprocessspawner_auth_state_cache",
+    "number of auth_state lookups served from the cache (hit) or decrypted (miss)",
+    ["result"],
+)
+
+START_COALESCED = Counter(
+    "winlocalprocessspawner_start_coalesced",
+    "number of start requests that joined the launch already in progress for the same server",
+)
+
+START_STAGE_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_start_stage_duration_seconds",
+    "time taken by each stage of starting a server",
+    ["stage"],
+)
+
+TOKEN_CALL_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_token_call_duration_seconds",
+    "time taken by the token_utils calls run on their thread pool",
+    ["call", "status"],
+)
+
+SERVICE_TOKEN_CACHE = Counter(
+    "winlocalprocessspawner_service_token_cache",
+    "number of service token lookups by result: hit, miss, or evicted as expired or invalid",
+    ["result"],
+)
+
+AGENT_PLACEMENTS = Counter(
+    "winlocalprocessspawner_agent_placements",
+    "number of servers placed on each launcher agent host",
+    ["host"],
+)
+
+SERVER_CPU_SECONDS = Gauge(
+    "winlocalprocessspawner_server_cpu_seconds",
+    "total CPU time used by the processes of each running server",
+    ["user", "server"],
+)
+
+SERVER_MEMORY_BYTES = Gauge(
+    "winlocalprocessspawner_server_memory_bytes",
+    "private memory currently committed by the processes of each running server",
+    ["user", "server"],
+)
+
+SERVER_PEAK_MEMORY_BYTES = Gauge(
+    "winlocalprocessspawner_server_peak_memory_bytes",
+    "peak private memory committed by the processes of each running server",
+    ["user", "server"],
+)
+
+SERVER_IO_BYTES = Gauge(
+    "winlocalprocessspawner_server_io_bytes",
+    "total bytes read, written and transferred otherwise by the processes of each running server",
+    ["user", "server", "operation"],
+)
+
+SERVER_PROCESSES = Gauge(
+    "winlocalprocessspawner_server_processes",
+    "number of processes currently running in each server",
+    ["user", "server"],
+)
+
+RESOURCE_SAMPLE_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_resource_sample_duration_seconds",
+    "time taken to sample the resource usage of all running servers in one pass",
+)
+
+HOST_AVAILABLE_MEMORY_BYTES = Gauge(
+    "winlocalprocessspawner_host_available_memory_bytes",
+    "physical memory available on each host running servers, as of its latest sample",
+    ["host"],
+)
+
+HOST_COMMIT_BYTES = Gauge(
+    "winlocalprocessspawner_host_commit_bytes",
+    "memory committed on each host running servers, as of its latest sample",
+    ["host"],
+)
+
+HOST_COMMIT_LIMIT_BYTES = Gauge(
+    "winlocalprocessspawner_host_commit_limit_bytes",
+    "commit limit of each host running servers",
+    ["host"],
+)
+
+HOST_CPU_PERCENT = Gauge(
+    "winlocalprocessspawner_host_cpu_percent",
+    "CPU usage of all cores of each host running servers, as of its latest sample",
+    ["host"],
+)
+
+HOST_PRESSURE_ADMISSIONS = Counter(
+    "winlocalprocessspawner_host_pressure_admissions",
+    "number of server launches queued, rejected or redirected to another host by host pressure",
+    ["action"],
+)
+
+BYTECODE_CACHE_COMPILE_DURATION_SECONDS = Histogram(
+    "winlocalprocessspawner_bytecode_cache_compile_duration_seconds",
+    "time taken to compile the servers' Python environment into the shared bytecode cache",
+    buckets=[1, 5, 10, 30, 60, 120, 300, 600, float("inf")],
+)
+
+LOADED_USER_PROFILES = Gauge(
+    "winlocalprocessspawner_loaded_user_profiles",
+    "number of user profiles loaded by the spawner, including those waiting to be unloaded",
+)
+
+USER_PROFILE_ACQUISITIONS = Counter(
+    "winlocalprocessspawner_user_profile_acquisitions",
+    "number of server launches that loaded their user's profile, or reused it already loaded",
+    ["result"],
+)
+
+CREATE_PROCESS_ERRORS = Counter(
+    "winlocalprocessspawner_create_process_errors",
+    "number of failed attempts to create the process of a server, by Win32 error and its class",
+    ["error_class", "error"],
+)
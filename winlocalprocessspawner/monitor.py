@@ -0,0 +1,52 @@
+"""Hub-wide periodic tasks that act on all running single-user servers in one batch."""
+
+import asyncio
+import logging
+import weakref
+
+logger = logging.getLogger("winlocalprocessspawner")
+
+
+class BatchTask:
+    """Periodically awaits `callback(spawners)` with every spawner currently registered.
+
+    A single background task serves all registered spawners, instead of one timer per server.
+    The task is started when the first spawner is added and ends once none are left.
+    """
+
+    def __init__(self, name, callback):
+        """Create a new BatchTask with the given name and coroutine function."""
+        self.name = name
+        self.callback = callback
+        self.interval = None
+        self._spawners = weakref.WeakSet()
+        self._task = None
+
+    def __contains__(self, spawner):
+        """Whether the spawner is currently registered."""
+        return spawner in self._spawners
+
+    def add(self, spawner, interval):
+        """Register a spawner, starting the background task if needed.
+
+        The interval of an already running task is updated to the latest value given.
+        """
+        self._spawners.add(spawner)
+        self.interval = interval
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def discard(self, spawner):
+        """Unregister a spawner. The background task ends once no spawners are left."""
+        self._spawners.discard(spawner)
+
+    async def _run(self):
+        while self._spawners:
+            await asyncio.sleep(self.interval)
+            spawners = list(self._spawners)
+            if not spawners:
+                break
+            try:
+                await self.callback(spawners)
+            except Exception:
+                logger.exception("Error running %s for %i servers", self.name, len(spawners))
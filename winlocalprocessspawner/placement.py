@@ -0,0 +1,81 @@
+"""Placement of new servers on the hosts running a launcher agent."""
+
+import hashlib
+import math
+import random
+from collections import namedtuple
+
+from .launcher import parse_address
+
+# A host running a launcher agent: the agent's address, the IP the servers it launches listen
+# on, the share of servers it gets relative to the other hosts, and its capacity (0: no limit)
+AgentHost = namedtuple("AgentHost", ["address", "ip", "weight", "max_servers"])
+
+POLICIES = ("least_loaded", "sticky", "weighted")
+
+
+def agent_hosts(config):
+    """Returns the AgentHosts of a {address: options} dict, as in launcher_hosts."""
+    hosts = []
+    for address, options in sorted(config.items()):
+        options = options or {}
+        kind, *location = parse_address(address)
+        ip = options.get("ip") or (location[0] if kind == "tcp" else "127.0.0.1")
+        hosts.append(
+            AgentHost(
+                address, ip, float(options.get("weight", 1)), int(options.get("max_servers", 0))
+            )
+        )
+    return hosts
+
+
+def least_loaded(hosts, loads):
+    """Returns the host running the fewest servers relative to its weight."""
+    return min(hosts, key=lambda host: (loads[host.address] / host.weight, host.address))
+
+
+def sticky(hosts, key):
+    """Returns the same host for a key, as long as that host is available.
+
+    Uses weighted rendezvous hashing: when a host becomes unavailable, only the keys placed on it
+    move to other hosts.
+    """
+
+    def score(host):
+        digest = hashlib.sha256("{}\0{}".format(key, host.address).encode("utf-8")).digest()
+        # uniform in (0, 1)
+        uniform = (int.from_bytes(digest[:8], "big") + 0.5) / 2**64
+        return -host.weight / math.log(uniform)
+
+    return max(hosts, key=score)
+
+
+def weighted(hosts, rng=random):
+    """Returns a random host, with a probability proportional to its weight."""
+    return rng.choices(hosts, weights=[host.weight for host in hosts])[0]
+
+
+def place(policy, hosts, loads, key, rng=random):
+    """Returns the host a new server should be placed on, or None if no host can take it.
+
+    :param policy: One of POLICIES.
+    :param hosts: The configured AgentHosts.
+    :param loads: {address: number of running servers} of the hosts that are available.
+    :param key: Identifies the owner of the server for the "sticky" policy, e.g. the user name.
+    """
+    candidates = [
+        host
+        for host in hosts
+        if host.address in loads
+        and host.weight > 0
+        and not (host.max_servers and loads[host.address] >= host.max_servers)
+    ]
+    if not candidates:
+        return None
+    if policy == "least_loaded":
+        return least_loaded(candidates, loads)
+    if policy == "sticky":
+        return sticky(candidates, key)
+    if policy == "weighted":
+        return weighted(candidates, rng)
+    raise ValueError("Unknown placement policy: {!r}".format(policy))
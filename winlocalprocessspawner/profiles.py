@@ -0,0 +1,130 @@
+"""Reference-counted loading of the Windows profiles of the users running servers."""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import pywintypes
+import win32api
+import win32profile
+
+from . import metrics, token_utils
+
+logger = logging.getLogger("winlocalprocessspawner")
+
+# A loaded profile: the token it was loaded with, kept open to unload it, the handle of its
+# registry hive, its environment, the servers using it, and when the last one released it
+_Profile = namedtuple("_Profile", ["token", "handle", "env", "holders", "released_at"])
+
+
+class UserProfileManager:
+    """Loads the profile of a user once, shared by all of the user's running servers.
+
+    The first server of a user loads the profile with LoadUserProfile and builds its environment
+    block. The other servers, and those started again within `grace` seconds of the last one
+    stopping, reuse both. Profiles are unloaded by unload_expired(), once no server has used them
+    for `grace` seconds.
+    """
+
+    def __init__(self, grace=300, clock=time.monotonic):
+        """Create a new UserProfileManager without loaded profiles."""
+        self.grace = grace
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._profiles = {}
+        # username -> lock held while loading the user's profile
+        self._loading = {}
+
+    def __len__(self):
+        """Number of loaded profiles, including those waiting to be unloaded."""
+        return len(self._profiles)
+
+    def holders(self, username):
+        """Returns the servers holding a reference to the profile of a user."""
+        profile = self._profiles.get(username)
+        return frozenset(profile.holders) if profile else frozenset()
+
+    def acquire(self, username, token, holder):
+        """Returns the profile environment of a user, loading the profile if needed.
+
+        :param token: A token of the user, used if the profile needs to be loaded. It stays owned
+            by the caller.
+        :param holder: Identifies the server using the profile. Acquiring the profile twice for
+            the same holder takes a single reference.
+        """
+        with self._lock:
+            loading = self._loading.setdefault(username, threading.Lock())
+        with loading:
+            with self._lock:
+                profile = self._profiles.get(username)
+                if profile is not None:
+                    profile.holders.add(holder)
+                    self._profiles[username] = profile._replace(released_at=None)
+                    metrics.USER_PROFILE_ACQUISITIONS.labels(result="reused").inc()
+                    return dict(profile.env)
+
+            profile = self._load(username, token)
+            profile.holders.add(holder)
+            with self._lock:
+                self._profiles[username] = profile
+                metrics.LOADED_USER_PROFILES.set(len(self._profiles))
+            metrics.USER_PROFILE_ACQUISITIONS.labels(result="loaded").inc()
+            return dict(profile.env)
+
+    def release(self, username, holder):
+        """Drop the reference of a server to the profile of a user.
+
+        Returns whether that was the last reference, so that the profile can be unloaded after
+        the grace period.
+        """
+        with self._lock:
+            profile = self._profiles.get(username)
+            if profile is None or holder not in profile.holders:
+                return False
+            profile.holders.discard(holder)
+            if profile.holders:
+                return False
+            self._profiles[username] = profile._replace(released_at=self._clock())
+            return True
+
+    def unload_expired(self):
+        """Unload the profiles no server has used for `grace` seconds. Returns their users."""
+        now = self._clock()
+        with self._lock:
+            expired = [
+                username
+                for username, profile in self._profiles.items()
+                if not profile.holders and now - profile.released_at >= self.grace
+            ]
+            profiles = [self._profiles.pop(username) for username in expired]
+            metrics.LOADED_USER_PROFILES.set(len(self._profiles))
+        for username, profile in zip(expired, profiles):
+            self._unload(username, profile)
+        return expired
+
+    def _load(self, username, token):
+        token = token_utils.duplicate_token(token)
+        try:
+            handle = win32profile.LoadUserProfile(token, {"UserName": username})
+            try:
+                env = dict(win32profile.CreateEnvironmentBlock(token, False))
+            except BaseException:
+                win32profile.UnloadUserProfile(token, handle)
+                raise
+        except BaseException:
+            win32api.CloseHandle(token)
+            raise
+        logger.info("Loaded the profile of %s", username)
+        return _Profile(token, handle, env, set(), None)
+
+    def _unload(self, username, profile):
+        try:
+            win32profile.UnloadUserProfile(profile.token, profile.handle)
+        except pywintypes.error as exc:
+            # Windows unloads the profile once the handles still open in it are closed
+            logger.warning("Failed to unload the profile of %s: %s", username, exc)
+        else:
+            logger.info("Unloaded the profile of %s", username)
+        finally:
+            win32api.CloseHandle(profile.token)
@@ -0,0 +1,92 @@
+"""Token-bucket rate limiting of server launches, per user, per group and globally."""
+
+import time
+
+
+class TokenBucket:
+    """Allows bursts of up to `burst` operations, refilled at `rate` operations per second."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """Create a new, full TokenBucket."""
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self):
+        """Whether the bucket holds its maximum number of tokens."""
+        self._refill()
+        return self._tokens >= self.burst
+
+    def wait_time(self):
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        """Take a token from the bucket. Check wait_time() first."""
+        self._refill()
+        self._tokens -= 1
+
+
+class SpawnRateLimiter:
+    """A set of token buckets, identified by a (scope, key) pair like ("user", "alice").
+
+    Buckets are created on first use, and dropped again once they are full, since a full bucket
+    behaves exactly like a new one.
+    """
+
+    # Number of buckets above which full buckets are looked for and dropped
+    prune_threshold = 1000
+
+    def __init__(self, clock=time.monotonic):
+        """Create a new SpawnRateLimiter without any buckets."""
+        self._clock = clock
+        self._buckets = {}
+
+    def _bucket(self, scope, key, rate, burst):
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            bucket = self._buckets[(scope, key)] = TokenBucket(rate, burst, self._clock)
+        else:
+            # pick up configuration changes
+            bucket.rate = rate
+            bucket.burst = burst
+        return bucket
+
+    def acquire(self, limits):
+        """Take one token from each of the given buckets, if all of them have one.
+
+        :param limits: An iterable of (scope, key, rate, burst) tuples. Limits with a rate of 0
+            are ignored.
+        :return: None if the tokens were taken. Otherwise, the (scope, retry_after) of the bucket
+            that has to wait the longest for a token, and no token is taken from any bucket.
+        """
+        buckets = [
+            (scope, self._bucket(scope, key, rate, burst))
+            for scope, key, rate, burst in limits
+            if rate > 0
+        ]
+        waits = [(bucket.wait_time(), scope) for scope, bucket in buckets]
+        longest_wait = max(waits, default=(0.0, None))
+        if longest_wait[0] > 0:
+            return longest_wait[1], longest_wait[0]
+
+        for _, bucket in buckets:
+            bucket.take()
+        if len(self._buckets) > self.prune_threshold:
+            self._prune()
+        return None
+
+    def _prune(self):
+        for key in [key for key, bucket in self._buckets.items() if bucket.full]:
+            del self._buckets[key]
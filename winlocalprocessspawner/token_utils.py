@@ -1,10 +1,86 @@
-"""Utilities for creating and restricting a security token for a Windows user."""
+"""Utilities for creating and restricting a security token for a Windows user.
+
+The `*_async` variants run the blocking calls on a bounded thread pool, so that a slow logon
+(e.g. waiting on a domain controller) does not stall the event loop of the Hub.
+ServiceTokenCache avoids logging on the same service user over and over, and restrict_tokens
+restricts many tokens at once, e.g. when a whole class logs in.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import ntsecuritycon
 import pywintypes
 import win32api
+import win32con
 import win32security
 
+_executor = None
+_executor_max_workers = 8
+
+
+def set_executor_max_workers(max_workers: int):
+    """Sets the number of threads running the calls of the `*_async` functions.
+
+    Calls already running finish on the previous thread pool.
+    """
+    global _executor, _executor_max_workers
+    _executor_max_workers = max_workers
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _metrics():
+    # imported on first use: prometheus_client takes much longer to import than token_utils
+    from . import metrics
+
+    return metrics
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=_executor_max_workers, thread_name_prefix="token_utils"
+        )
+    return _executor
+
+
+def _close_late_result(future):
+    # The call completed after its caller gave up on it: nobody will close the returned handle
+    if not future.cancelled() and future.exception() is None and future.result():
+        win32api.CloseHandle(future.result())
+
+
+async def _run_in_executor(func, *args, timeout=None):
+    future = asyncio.get_event_loop().run_in_executor(_get_executor(), func, *args)
+    started = time.perf_counter()
+    status = "failure"
+    try:
+        # shielded, since the blocking call cannot be interrupted anyway
+        result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        status = "success"
+        return result
+    except asyncio.TimeoutError:
+        status = "timeout"
+        future.add_done_callback(_close_late_result)
+        raise
+    except asyncio.CancelledError:
+        status = "cancelled"
+        future.add_done_callback(_close_late_result)
+        raise
+    finally:
+        _metrics().TOKEN_CALL_DURATION_SECONDS.labels(call=func.__name__, status=status).observe(
+            time.perf_counter() - started
+        )
+
 
 def create_service_token(username: str, password: str) -> pywintypes.HANDLEType:
     """Logs on a Windows Service user, given its password, and returns a handle to the token."""
@@ -50,3 +126,221 @@ def restrict_token(token_handle: pywintypes.HANDLEType) -> pywintypes.HANDLEType
         raise
 
     return restricted_token
+
+
+async def create_service_token_async(
+    username: str, password: str, timeout: float = None
+) -> pywintypes.HANDLEType:
+    """Awaitable version of create_service_token, run on the token_utils thread pool.
+
+    Raises asyncio.TimeoutError if the logon takes longer than timeout seconds. The token of a
+    logon that completes after a timeout or a cancellation is closed.
+    """
+    return await _run_in_executor(create_service_token, username, password, timeout=timeout)
+
+
+async def restrict_token_async(
+    token_handle: pywintypes.HANDLEType, timeout: float = None
+) -> pywintypes.HANDLEType:
+    """Awaitable version of restrict_token, run on the token_utils thread pool.
+
+    Raises asyncio.TimeoutError if the call takes longer than timeout seconds. The restricted
+    token of a call that completes after a timeout or a cancellation is closed.
+    """
+    return await _run_in_executor(restrict_token, token_handle, timeout=timeout)
+
+
+# Result of restricting one token: the restricted token, or the exception raised
+RestrictResult = namedtuple("RestrictResult", ["token", "error"])
+
+
+def _restrict_result(future):
+    try:
+        return RestrictResult(future.result(), None)
+    except Exception as e:
+        return RestrictResult(None, e)
+
+
+def restrict_tokens(token_handles) -> list:
+    """Restricts many tokens like restrict_token, in parallel on the token_utils thread pool.
+
+    Returns a RestrictResult per token handle, in the same order: a failure to restrict one token
+    does not fail the others. The caller is responsible for closing the restricted tokens. If the
+    call is interrupted, the tokens restricted so far are closed.
+
+    Must not be called from the token_utils thread pool itself; use restrict_tokens_async from a
+    coroutine.
+    """
+    started = time.perf_counter()
+    futures = []
+    try:
+        for token_handle in token_handles:
+            futures.append(_get_executor().submit(restrict_token, token_handle))
+        results = [_restrict_result(future) for future in futures]
+    except BaseException:
+        for future in futures:
+            if not future.cancel():
+                future.add_done_callback(_close_late_result)
+        raise
+    _metrics().TOKEN_CALL_DURATION_SECONDS.labels(call="restrict_tokens", status="success").observe(
+        time.perf_counter() - started
+    )
+    return results
+
+
+async def restrict_tokens_async(token_handles, timeout: float = None) -> list:
+    """Awaitable version of restrict_tokens, with a timeout for each token.
+
+    A token that could not be restricted in time has an asyncio.TimeoutError as its error. If the
+    coroutine is cancelled, the tokens restricted so far, and later, are closed.
+    """
+    tasks = [
+        asyncio.ensure_future(_run_in_executor(restrict_token, token_handle, timeout=timeout))
+        for token_handle in token_handles
+    ]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            if task.done():
+                _close_late_result(task)
+            else:
+                task.cancel()
+        raise
+    return [_restrict_result(task) for task in tasks]
+
+
+def duplicate_token(token_handle: pywintypes.HANDLEType) -> pywintypes.HANDLEType:
+    """Returns a new handle to the same token, with the same access. The caller closes it."""
+    current_process = win32api.GetCurrentProcess()
+    return win32api.DuplicateHandle(
+        current_process,
+        token_handle,
+        current_process,
+        0,
+        False,
+        win32con.DUPLICATE_SAME_ACCESS,
+    )
+
+
+def duplicate_token_from_process(pid: int, token_handle: int) -> pywintypes.HANDLEType:
+    """Returns a handle, owned by the calling process, to a token handle of another process.
+
+    Requires the PROCESS_DUP_HANDLE access right on the other process. The caller closes it.
+    """
+    source_process = win32api.OpenProcess(win32con.PROCESS_DUP_HANDLE, False, pid)
+    try:
+        return win32api.DuplicateHandle(
+            source_process,
+            token_handle,
+            win32api.GetCurrentProcess(),
+            0,
+            False,
+            win32con.DUPLICATE_SAME_ACCESS,
+        )
+    finally:
+        win32api.CloseHandle(source_process)
+
+
+def current_user_sid():
+    """Returns the PySID of the user the calling process runs as."""
+    token = win32security.OpenProcessToken(win32api.GetCurrentProcess(), win32security.TOKEN_QUERY)
+    try:
+        return win32security.GetTokenInformation(token, win32security.TokenUser)[0]
+    finally:
+        token.Close()
+
+
+def is_valid_token(token_handle: pywintypes.HANDLEType) -> bool:
+    """Returns whether the handle still refers to a token that can be queried."""
+    try:
+        win32security.GetTokenInformation(token_handle, win32security.TokenStatistics)
+    except pywintypes.error:
+        return False
+    return True
+
+
+class ServiceTokenCache:
+    """TTL-bounded cache of service logon tokens, to avoid a LogonUser call for every spawn.
+
+    Tokens are keyed by username and by a hash of the password, salted with a random value
+    private to the cache, so the passwords themselves are never kept in memory. The cached tokens
+    stay owned by the cache: get_token() hands out duplicated handles, that the caller closes.
+    """
+
+    def __init__(self, ttl: float = 300, clock=time.monotonic):
+        """Create a new, empty ServiceTokenCache keeping tokens for ttl seconds."""
+        self.ttl = ttl
+        self._clock = clock
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        # (username, password hash) -> (token, expiry time)
+        self._entries = {}
+
+    def _key(self, username, password):
+        password_hash = hmac.new(self._salt, password.encode("utf-8"), hashlib.sha256).digest()
+        return username, password_hash
+
+    def get_token(self, username: str, password: str) -> pywintypes.HANDLEType:
+        """Returns a duplicated handle to the logon token of a Windows Service user.
+
+        The user is logged on with create_service_token if no valid token is cached for the
+        username and password. The caller is responsible for closing the returned handle.
+        """
+        key = self._key(username, password)
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is not None and not is_valid_token(entry[0]):
+                _metrics().SERVICE_TOKEN_CACHE.labels(result="invalid").inc()
+                self._close_entry(key)
+                entry = None
+            if entry is not None:
+                _metrics().SERVICE_TOKEN_CACHE.labels(result="hit").inc()
+                return duplicate_token(entry[0])
+
+        _metrics().SERVICE_TOKEN_CACHE.labels(result="miss").inc()
+        # log on outside of the lock, so that logons of different users do not wait on each other
+        token_handle = create_service_token(username, password)
+        try:
+            duplicate = duplicate_token(token_handle)
+        except pywintypes.error:
+            win32api.CloseHandle(token_handle)
+            raise
+        with self._lock:
+            self._close_entry(key)
+            self._entries[key] = (token_handle, self._clock() + self.ttl)
+        return duplicate
+
+    async def get_token_async(
+        self, username: str, password: str, timeout: float = None
+    ) -> pywintypes.HANDLEType:
+        """Awaitable version of get_token, run on the token_utils thread pool."""
+        return await _run_in_executor(self.get_token, username, password, timeout=timeout)
+
+    def invalidate(self, username: str = None):
+        """Closes and forgets the cached tokens of a user, or of all users if username is None."""
+        with self._lock:
+            for key in list(self._entries):
+                if username is None or key[0] == username:
+                    self._close_entry(key)
+
+    def __len__(self):
+        """Number of cached tokens, including expired ones not evicted yet."""
+        return len(self._entries)
+
+    def _evict_expired(self):
+        now = self._clock()
+        for key in [key for key, (_, expiry) in self._entries.items() if expiry <= now]:
+            _metrics().SERVICE_TOKEN_CACHE.labels(result="expired").inc()
+            self._close_entry(key)
+
+    def _close_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            try:
+                win32api.CloseHandle(entry[0])
+            except pywintypes.error:
+                pass
@@ -0,0 +1,67 @@
+"""Classification of the Win32 errors of process creation, as transient or permanent."""
+
+import random
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# Errors caused by the load on the host or by another process holding a resource for a while:
+# running out of memory, quotas or handles, and files (such as a profile hive) locked by another
+# process. The same call is expected to succeed a moment later.
+TRANSIENT_ERRORS = {
+    4: "ERROR_TOO_MANY_OPEN_FILES",
+    8: "ERROR_NOT_ENOUGH_MEMORY",
+    14: "ERROR_OUTOFMEMORY",
+    32: "ERROR_SHARING_VIOLATION",
+    33: "ERROR_LOCK_VIOLATION",
+    121: "ERROR_SEM_TIMEOUT",
+    164: "ERROR_MAX_THRDS_REACHED",
+    170: "ERROR_BUSY",
+    231: "ERROR_PIPE_BUSY",
+    1237: "ERROR_RETRY",
+    1450: "ERROR_NO_SYSTEM_RESOURCES",
+    1451: "ERROR_NONPAGED_SYSTEM_RESOURCES",
+    1452: "ERROR_PAGED_SYSTEM_RESOURCES",
+    1453: "ERROR_WORKING_SET_QUOTA",
+    1454: "ERROR_PAGEFILE_QUOTA",
+    1455: "ERROR_COMMITMENT_LIMIT",
+    1460: "ERROR_TIMEOUT",
+    1816: "ERROR_NOT_ENOUGH_QUOTA",
+}
+
+# Common errors that retrying cannot fix, named in the metrics
+PERMANENT_ERRORS = {
+    2: "ERROR_FILE_NOT_FOUND",
+    3: "ERROR_PATH_NOT_FOUND",
+    5: "ERROR_ACCESS_DENIED",
+    6: "ERROR_INVALID_HANDLE",
+    87: "ERROR_INVALID_PARAMETER",
+    193: "ERROR_BAD_EXE_FORMAT",
+    267: "ERROR_DIRECTORY",
+    1312: "ERROR_NO_SUCH_LOGON_SESSION",
+    1314: "ERROR_PRIVILEGE_NOT_HELD",
+}
+
+
+def winerror(exc):
+    """Returns the Win32 error code of a pywintypes.error or OSError, or None."""
+    return getattr(exc, "winerror", None)
+
+
+def classify(code):
+    """Returns TRANSIENT for the Win32 error codes worth retrying, PERMANENT for the others."""
+    return TRANSIENT if code in TRANSIENT_ERRORS else PERMANENT
+
+
+def error_name(code):
+    """Returns the symbolic name of a Win32 error code, or "other" if it is not a known one."""
+    return TRANSIENT_ERRORS.get(code) or PERMANENT_ERRORS.get(code) or "other"
+
+
+def retry_delay(attempt, base_delay, max_delay, rng=random):
+    """Returns the seconds to wait before retry number attempt (from 0), with full jitter.
+
+    The delay is drawn uniformly up to a bound that doubles with every attempt, from base_delay
+    up to max_delay, so that launches failing together do not retry together.
+    """
+    return rng.uniform(0, min(max_delay, base_delay * 2**attempt))
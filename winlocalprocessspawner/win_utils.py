@@ -1,17 +1,226 @@
 """Windows process-launching helpers for running JupyterHub single-user servers as another user."""
 
+import ctypes
 import logging
 import os
 import sys
+import time
+from ctypes import wintypes
 from subprocess import Handle, Popen, list2cmdline
 
+import pywintypes
 import win32api
 import win32con
 import win32event
+import win32job
 import win32process
 
+from . import job_utils, metrics, win32errors
+
 logger = logging.getLogger("winlocalprocessspawner")
 
+_advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+
+# Not exported by win32process
+EXTENDED_STARTUPINFO_PRESENT = 0x00080000
+PROC_THREAD_ATTRIBUTE_HANDLE_LIST = 0x00020002
+
+# Upper bound of the delay before retrying a process creation that failed with a transient error
+_MAX_RETRY_DELAY = 10
+
+
+class _StartupInfo(ctypes.Structure):
+    _fields_ = [
+        ("cb", wintypes.DWORD),
+        ("lpReserved", wintypes.LPWSTR),
+        ("lpDesktop", wintypes.LPWSTR),
+        ("lpTitle", wintypes.LPWSTR),
+        ("dwX", wintypes.DWORD),
+        ("dwY", wintypes.DWORD),
+        ("dwXSize", wintypes.DWORD),
+        ("dwYSize", wintypes.DWORD),
+        ("dwXCountChars", wintypes.DWORD),
+        ("dwYCountChars", wintypes.DWORD),
+        ("dwFillAttribute", wintypes.DWORD),
+        ("dwFlags", wintypes.DWORD),
+        ("wShowWindow", wintypes.WORD),
+        ("cbReserved2", wintypes.WORD),
+        ("lpReserved2", ctypes.c_void_p),
+        ("hStdInput", wintypes.HANDLE),
+        ("hStdOutput", wintypes.HANDLE),
+        ("hStdError", wintypes.HANDLE),
+    ]
+
+
+class _StartupInfoEx(ctypes.Structure):
+    _fields_ = [("StartupInfo", _StartupInfo), ("lpAttributeList", ctypes.c_void_p)]
+
+
+class _ProcessInformation(ctypes.Structure):
+    _fields_ = [
+        ("hProcess", wintypes.HANDLE),
+        ("hThread", wintypes.HANDLE),
+        ("dwProcessId", wintypes.DWORD),
+        ("dwThreadId", wintypes.DWORD),
+    ]
+
+
+# Without prototypes, ctypes passes integers as C ints, truncating 64-bit handles and sizes
+_kernel32.InitializeProcThreadAttributeList.argtypes = [
+    ctypes.c_void_p,
+    wintypes.DWORD,
+    wintypes.DWORD,
+    ctypes.POINTER(ctypes.c_size_t),
+]
+_kernel32.InitializeProcThreadAttributeList.restype = wintypes.BOOL
+_kernel32.UpdateProcThreadAttribute.argtypes = [
+    ctypes.c_void_p,
+    wintypes.DWORD,
+    ctypes.c_size_t,
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_void_p,
+    ctypes.POINTER(ctypes.c_size_t),
+]
+_kernel32.UpdateProcThreadAttribute.restype = wintypes.BOOL
+_kernel32.DeleteProcThreadAttributeList.argtypes = [ctypes.c_void_p]
+_kernel32.DeleteProcThreadAttributeList.restype = None
+_advapi32.CreateProcessAsUserW.argtypes = [
+    wintypes.HANDLE,
+    wintypes.LPCWSTR,
+    wintypes.LPWSTR,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    wintypes.BOOL,
+    wintypes.DWORD,
+    ctypes.c_void_p,
+    wintypes.LPCWSTR,
+    ctypes.POINTER(_StartupInfoEx),
+    ctypes.POINTER(_ProcessInformation),
+]
+_advapi32.CreateProcessAsUserW.restype = wintypes.BOOL
+
+
+def _handle_value(handle):
+    """Returns the integer value of a PyHANDLE, subprocess Handle, or None for NULL."""
+    if handle is None:
+        return None
+    return int(handle) or None
+
+
+def filter_handle_list(handles):
+    """Returns the handles that can be inherited, without duplicates.
+
+    Console pseudo-handles, whose two low bits are set, cannot be in an inherited handle list.
+    """
+    values = []
+    for handle in handles:
+        value = _handle_value(handle)
+        if value is not None and value & 0x3 != 0x3 and value not in values:
+            values.append(value)
+    return values
+
+
+def inheritable_std_handles():
+    """Returns the standard handles of the calling process that can be inherited.
+
+    Without STARTF_USESTDHANDLES, a new process gets the standard handles of the calling process,
+    which are only valid in it if they are inherited.
+    """
+    handles = []
+    for std_handle in (
+        win32api.STD_INPUT_HANDLE,
+        win32api.STD_OUTPUT_HANDLE,
+        win32api.STD_ERROR_HANDLE,
+    ):
+        try:
+            handle = win32api.GetStdHandle(std_handle)
+            if _handle_value(handle) is None:
+                continue
+            if win32api.GetHandleInformation(handle) & win32con.HANDLE_FLAG_INHERIT:
+                handles.append(handle)
+        except pywintypes.error:
+            # not a handle, e.g. a console pseudo-handle before Windows 8
+            continue
+    return handles
+
+
+def environment_block(env):
+    """Returns the Unicode environment block of CreateProcess for a {name: value} dict."""
+    return "".join("{}={}\0".format(name, value) for name, value in env.items()) + "\0"
+
+
+def create_process_as_user_with_handles(
+    token, executable, args, handles, creationflags, env, cwd, startupinfo
+):
+    """CreateProcessAsUser, letting the new process inherit only the given handles.
+
+    win32process.CreateProcessAsUser cannot pass the STARTUPINFOEX attribute list this needs.
+    Takes the arguments, and returns the (process handle, thread handle, pid, tid), of
+    win32process.CreateProcessAsUser. The handles must be inheritable.
+    """
+    size = ctypes.c_size_t()
+    # fails with ERROR_INSUFFICIENT_BUFFER, giving the size of the attribute list
+    _kernel32.InitializeProcThreadAttributeList(None, 1, 0, ctypes.byref(size))
+    attribute_list = ctypes.create_string_buffer(size.value)
+    if not _kernel32.InitializeProcThreadAttributeList(attribute_list, 1, 0, ctypes.byref(size)):
+        raise ctypes.WinError(ctypes.get_last_error())
+    try:
+        handle_array = (wintypes.HANDLE * len(handles))(*handles)
+        if not _kernel32.UpdateProcThreadAttribute(
+            attribute_list,
+            0,
+            ctypes.c_size_t(PROC_THREAD_ATTRIBUTE_HANDLE_LIST),
+            handle_array,
+            ctypes.c_size_t(ctypes.sizeof(handle_array)),
+            None,
+            None,
+        ):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+        info = _StartupInfoEx()
+        info.StartupInfo.cb = ctypes.sizeof(info)
+        info.StartupInfo.lpDesktop = getattr(startupinfo, "lpDesktop", None)
+        info.StartupInfo.dwFlags = startupinfo.dwFlags
+        info.StartupInfo.wShowWindow = getattr(startupinfo, "wShowWindow", 0)
+        if startupinfo.dwFlags & win32process.STARTF_USESTDHANDLES:
+            info.StartupInfo.hStdInput = _handle_value(startupinfo.hStdInput)
+            info.StartupInfo.hStdOutput = _handle_value(startupinfo.hStdOutput)
+            info.StartupInfo.hStdError = _handle_value(startupinfo.hStdError)
+        info.lpAttributeList = ctypes.cast(attribute_list, ctypes.c_void_p)
+
+        process_information = _ProcessInformation()
+        if not _advapi32.CreateProcessAsUserW(
+            _handle_value(token),
+            executable,
+            # CreateProcessW may modify the command line in place
+            ctypes.create_unicode_buffer(args),
+            None,
+            None,
+            True,
+            creationflags
+            | EXTENDED_STARTUPINFO_PRESENT
+            | (win32process.CREATE_UNICODE_ENVIRONMENT if env is not None else 0),
+            ctypes.create_unicode_buffer(environment_block(env)) if env is not None else None,
+            cwd,
+            ctypes.byref(info),
+            ctypes.byref(process_information),
+        ):
+            error = ctypes.get_last_error()
+            raise pywintypes.error(
+                error, "CreateProcessAsUser", win32api.FormatMessage(error).strip()
+            )
+    finally:
+        _kernel32.DeleteProcThreadAttributeList(attribute_list)
+
+    return (
+        pywintypes.HANDLE(process_information.hProcess),
+        pywintypes.HANDLE(process_information.hThread),
+        process_information.dwProcessId,
+        process_information.dwThreadId,
+    )
+
 
 class PopenAsUser(Popen):
     """Popen implementation that launches new process using the windows auth token provided.
@@ -19,6 +228,11 @@ class PopenAsUser(Popen):
     This is needed to be able to launch a process as another user.
     """
 
+    _handle_list = ()
+    _desktop = None
+    _retries = 0
+    _retry_delay = 0.5
+
     def __init__(
         self,
         args,
@@ -37,9 +251,36 @@ class PopenAsUser(Popen):
         encoding=None,
         errors=None,
         token=None,
+        job=None,
+        close_fds=True,
+        handle_list=(),
+        desktop=None,
+        retries=0,
+        retry_delay=0.5,
     ):
-        """Create new PopenAsUser instance."""
+        r"""Create new PopenAsUser instance.
+
+        If a job object handle is given, the process is assigned to it before it starts running,
+        so every process it creates belongs to the job as well.
+
+        As with Popen on Windows, close_fds=True lets the process inherit only its own standard
+        handles, plus the inheritable handles in handle_list, instead of every inheritable handle
+        of the calling process. close_fds=False inherits all of them, unless handle_list is given:
+        the process then inherits its standard handles and those in handle_list only.
+
+        desktop, "window station\desktop", starts the process in that desktop instead of the one
+        of the calling process.
+
+        A creation of the process failing with a transient Win32 error (see win32errors) is
+        retried up to `retries` times, after a random delay of up to `retry_delay` seconds that
+        doubles with every retry.
+        """
         self._token = token
+        self._job = job
+        self._handle_list = tuple(handle_list)
+        self._desktop = desktop
+        self._retries = retries
+        self._retry_delay = retry_delay
 
         super().__init__(
             args,
@@ -49,7 +290,7 @@ class PopenAsUser(Popen):
             stdout,
             stderr,
             None,
-            False,
+            close_fds,
             shell,
             cwd,
             env,
@@ -187,6 +428,8 @@ class PopenAsUser(Popen):
         # Process startup details
         if startupinfo is None:
             startupinfo = win32process.STARTUPINFO()
+        if self._desktop is not None:
+            startupinfo.lpDesktop = self._desktop
         if -1 not in (p2cread, c2pwrite, errwrite):
             startupinfo.dwFlags |= win32process.STARTF_USESTDHANDLES
             startupinfo.hStdInput = p2cread
@@ -199,44 +442,62 @@ class PopenAsUser(Popen):
             comspec = os.environ.get("COMSPEC", "cmd.exe")
             args = '{} /c "{}"'.format(comspec, args)
 
+        if self._job is not None:
+            # Keep the main thread suspended until the process is in the job, so that no child
+            # process can be created outside of it.
+            creationflags |= win32process.CREATE_SUSPENDED
+
+        # Only the handles in the list are inherited, even if other threads are creating
+        # inheritable handles for their own processes at the same time.
+        handle_list = list(self._handle_list)
+        if close_fds or handle_list:
+            if startupinfo.dwFlags & win32process.STARTF_USESTDHANDLES:
+                handle_list.extend([p2cread, c2pwrite, errwrite])
+            else:
+                handle_list.extend(inheritable_std_handles())
+        handle_list = filter_handle_list(handle_list)
+
         # Start the process
         try:
-            hp, ht, pid, tid = win32process.CreateProcessAsUser(
-                self._token,
+            hp, ht, pid, tid = self._create_process(
                 executable,
                 args,
-                # no special security
-                None,
-                None,
-                int(not close_fds),
+                close_fds,
+                handle_list,
                 creationflags,
                 env,
                 os.fspath(cwd) if cwd is not None else None,
                 startupinfo,
             )
-            err = win32api.GetLastError()
-            if err:
+            if self._job is not None:
+                try:
+                    win32job.AssignProcessToJobObject(self._job, hp)
+                except pywintypes.error as exc:
+                    logger.warning("Failed to assign process %s to its job object: %s", pid, exc)
+                else:
+                    try:
+                        job_utils.pin_job(self._job, hp)
+                    except pywintypes.error as exc:
+                        logger.warning(
+                            "Failed to pin the job object of process %s, which will not be found "
+                            "again after a restart: %s",
+                            pid,
+                            exc,
+                        )
+                win32process.ResumeThread(ht)
+            # CreateProcessAsUser raises its errors: the last error of the thread is stale here.
+            # Wait at least one second before checking the exit code.
+            win32event.WaitForSingleObject(hp, 1000)
+            exit_code = win32process.GetExitCodeProcess(hp)
+            if exit_code != win32con.STILL_ACTIVE:
                 logger.error(
-                    "Error %r when calling CreateProcessAsUser executable %s args %s with the \
-                            token %r ",
-                    err,
+                    "ExitCode %r when calling CreateProcessAsUser executable %s args %s "
+                    "with the token %r",
+                    exit_code,
                     executable,
                     args,
                     self._token,
                 )
-            else:
-                win32event.WaitForSingleObject(
-                    hp, 1000
-                )  # Wait at least one second before checking exit code
-                exit_code = win32process.GetExitCodeProcess(hp)
-                if exit_code != win32con.STILL_ACTIVE:
-                    logger.error(
-                        "ExitCode %r when calling CreateProcessAsUser executable %s args %s with the token %r ",
-                        win32process.GetExitCodeProcess(hp),
-                        executable,
-                        args,
-                        self._token,
-                    )
         finally:
             # Child is launched. Close the parent's copy of those pipe
             # handles that only the child should have open.  You need
@@ -261,3 +522,56 @@ class PopenAsUser(Popen):
             self.pid = pid
         finally:
             win32api.CloseHandle(ht)
+
+    def _create_process(
+        self, executable, args, close_fds, handle_list, creationflags, env, cwd, startupinfo
+    ):
+        """CreateProcessAsUser, retrying the transient failures."""
+        attempt = 0
+        while True:
+            try:
+                if handle_list:
+                    return create_process_as_user_with_handles(
+                        self._token,
+                        executable,
+                        args,
+                        handle_list,
+                        creationflags,
+                        env,
+                        cwd,
+                        startupinfo,
+                    )
+                return win32process.CreateProcessAsUser(
+                    self._token,
+                    executable,
+                    args,
+                    # no special security
+                    None,
+                    None,
+                    int(not close_fds),
+                    creationflags,
+                    env,
+                    cwd,
+                    startupinfo,
+                )
+            except (pywintypes.error, OSError) as exc:
+                code = win32errors.winerror(exc)
+                error_class = win32errors.classify(code)
+                metrics.CREATE_PROCESS_ERRORS.labels(
+                    error_class=error_class, error=win32errors.error_name(code)
+                ).inc()
+                if error_class != win32errors.TRANSIENT or attempt >= self._retries:
+                    raise
+                delay = win32errors.retry_delay(attempt, self._retry_delay, _MAX_RETRY_DELAY)
+                attempt += 1
+                logger.warning(
+                    "Transient error %s when calling CreateProcessAsUser executable %s args %s, "
+                    "retry %i of %i in %.2f seconds",
+                    exc,
+                    executable,
+                    args,
+                    attempt,
+                    self._retries,
+                    delay,
+                )
+                time.sleep(delay)
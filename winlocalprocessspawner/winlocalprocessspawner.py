@@ -1,26 +1,1043 @@
 """Windows-specific JupyterHub spawner for launching single-user servers as local processes."""
 
+import asyncio
+import functools
+import math
 import os
 import pipes
 import shutil
+import sys
+import time
+import uuid
+from datetime import datetime
 from tempfile import mkdtemp
 
 import pywintypes
 import win32profile
 from jupyterhub.spawner import LocalProcessSpawner
+from jupyterhub.traitlets import ByteSpecification
 from jupyterhub.utils import random_port
+from tornado import web
+from traitlets import Bool, Dict, Enum, Float, Integer, Unicode, default
 
+from . import hostpressure, job_utils, metrics, placement, token_utils
+from .authstate import AuthStateCache
+from .bytecode import BytecodeCache
+from .crashloop import CrashLoopTracker
+from .desktops import DesktopPool
+from .journal import SpawnJournal, win32_error
+from .launcher import (
+    KEY_ENV_VAR,
+    LauncherClient,
+    LauncherError,
+    client_ssl_context,
+    is_loopback_address,
+    parse_address,
+)
+from .monitor import BatchTask
+from .profiles import UserProfileManager
+from .ratelimit import SpawnRateLimiter
 from .win_utils import PopenAsUser
 
 
+async def _trim_idle_servers(spawners):
+    """Trim the working sets of the processes of all idle servers in a single executor call."""
+    now = datetime.utcnow()
+    idle = [
+        spawner
+        for spawner in spawners
+        if spawner._job is not None
+        and spawner._suspended_since is None
+        and spawner._idle_seconds(now) >= spawner.trim_idle_working_set_after
+    ]
+    if not idle:
+        return
+
+    def trim_all(jobs):
+        reclaimed = []
+        for job, min_working_set in jobs:
+            try:
+                reclaimed.append(job_utils.trim_job(job, min_working_set))
+            except pywintypes.error:
+                # the server stopped and its job was closed in the meantime
+                reclaimed.append(0)
+        return reclaimed
+
+    jobs = [(spawner._job, spawner.trim_min_working_set) for spawner in idle]
+    with metrics.WORKING_SET_TRIM_DURATION_SECONDS.time():
+        reclaimed = await asyncio.get_event_loop().run_in_executor(None, trim_all, jobs)
+
+    for spawner, reclaimed_bytes in zip(idle, reclaimed):
+        if reclaimed_bytes:
+            spawner.log.debug(
+                "Trimmed %i bytes of working set from idle server %s",
+                reclaimed_bytes,
+                spawner._log_name,
+            )
+            metrics.WORKING_SET_TRIMMED_BYTES.inc(reclaimed_bytes)
+            metrics.WORKING_SET_TRIMMED_SERVERS.inc()
+
+
+_trim_task = BatchTask("working set trim", _trim_idle_servers)
+
+
+async def _suspend_idle_servers(spawners):
+    """Suspend all idle servers, and terminate those that stayed suspended for too long."""
+    now = datetime.utcnow()
+    idle = [
+        spawner
+        for spawner in spawners
+        if spawner._job is not None
+        and spawner._suspended_since is None
+        and spawner._idle_seconds(now) >= spawner.suspend_idle_after
+    ]
+    expired = [
+        spawner
+        for spawner in spawners
+        if spawner._suspended_since is not None
+        and spawner.suspended_timeout
+        and time.time() - spawner._suspended_since >= spawner.suspended_timeout
+    ]
+    if not idle and not expired:
+        return
+
+    def suspend_and_terminate(idle_jobs, expired_jobs):
+        suspended = []
+        for job in idle_jobs:
+            try:
+                job_utils.suspend_job(job)
+                suspended.append(True)
+            except pywintypes.error:
+                suspended.append(False)
+        for job in expired_jobs:
+            try:
+                job_utils.terminate_job(job)
+            except pywintypes.error:
+                pass
+        return suspended
+
+    suspended = await asyncio.get_event_loop().run_in_executor(
+        None,
+        suspend_and_terminate,
+        [spawner._job for spawner in idle],
+        [spawner._job for spawner in expired],
+    )
+
+    for spawner in expired:
+        spawner.log.info("Terminated %s after it stayed suspended too long", spawner._log_name)
+        metrics.SUSPENDED_SERVER_TIMEOUT.inc()
+        spawner._clear_suspended()
+        spawner.clear_state()
+        spawner._save_state()
+
+    for spawner, ok in zip(idle, suspended):
+        if not ok:
+            continue
+        spawner.log.info("Suspended idle server %s", spawner._log_name)
+        spawner._mark_suspended()
+        metrics.SERVER_SUSPEND.inc()
+        # Let the Hub see the server as stopped: it removes the proxy route, so that the
+        # user's next request leads to start(), which resumes the server.
+        await spawner.poll_and_notify()
+
+
+_suspend_task = BatchTask("idle server suspension", _suspend_idle_servers)
+
+
+async def _sample_servers(spawners):
+    """Sample the resource usage of all running servers in a single executor call."""
+    running = [spawner for spawner in spawners if spawner._job is not None]
+    if not running:
+        return
+
+    def sample_all(jobs):
+        samples = []
+        for job in jobs:
+            try:
+                samples.append(job_utils.get_job_accounting(job))
+            except pywintypes.error:
+                # the server stopped and its job was closed in the meantime
+                samples.append(None)
+        return samples
+
+    with metrics.RESOURCE_SAMPLE_DURATION_SECONDS.time():
+        samples = await asyncio.get_event_loop().run_in_executor(
+            None, sample_all, [spawner._job for spawner in running]
+        )
+
+    now = time.time()
+    active = [
+        spawner
+        for spawner, usage in zip(running, samples)
+        if usage is not None and spawner._record_resource_usage(usage, now)
+    ]
+    if active:
+        utcnow = datetime.utcnow()
+        for spawner in active:
+            spawner._report_activity(utcnow)
+        # all spawners share the Hub's database session
+        active[0].db.commit()
+
+
+_sample_task = BatchTask("resource sampling", _sample_servers)
+
+_spawn_rate_limiter = SpawnRateLimiter()
+
+_crash_loops = CrashLoopTracker()
+
+_auth_state_cache = AuthStateCache()
+
+# (user name, server name) -> future of the launch in progress for that server
+_inflight_starts = {}
+
+# Spawns, stops and exits of all servers, served to admins by handlers.SpawnJournalAPIHandler
+spawn_journal = SpawnJournal()
+
+# (user name, server name) of the launches deferred by rate limits or host pressure, in order
+_queued_launches = {}
+
+# launcher address -> LauncherClient shared by all spawners using that launcher
+_launchers = {}
+
+# Seconds between two attempts to connect to the port of a new server, while progress is watched
+_PORT_PROBE_INTERVAL = 0.2
+
+_host_pressure = hostpressure.HostPressureSampler()
+
+# Seconds between two checks of the host pressure by a queued launch
+_HOST_PRESSURE_RETRY_INTERVAL = 2
+
+_bytecode_cache = BytecodeCache()
+
+_user_profiles = UserProfileManager()
+
+_desktops = DesktopPool()
+
+
+def _export_host_pressure(host, pressure):
+    """Export a HostPressure of the given host as metrics."""
+    metrics.HOST_AVAILABLE_MEMORY_BYTES.labels(host=host).set(pressure.available_memory)
+    metrics.HOST_COMMIT_BYTES.labels(host=host).set(pressure.commit)
+    metrics.HOST_COMMIT_LIMIT_BYTES.labels(host=host).set(pressure.commit_limit)
+    if pressure.cpu_percent is not None:
+        metrics.HOST_CPU_PERCENT.labels(host=host).set(pressure.cpu_percent)
+
+
 class WinLocalProcessSpawner(LocalProcessSpawner):
     """A Spawner that start single-user servers as local Windows processes.
 
     It uses the authentication token stored in the field 'auth_token' of the current
     auth_state. Its the Authenticator's job to fill the 'auth_token' with a valid Windows
     authentication token handle.
+
+    The processes of each server are grouped in a Windows job object, which is used to act on
+    the server as a whole (e.g. trimming the working sets of an idle server and its kernels).
+
+    Idle servers can be suspended instead of culled: their processes are frozen and the Hub sees
+    them as stopped, but they keep their port and API token. The next start() resumes them in
+    milliseconds instead of launching a new server.
+
+    With `launcher_address` set, servers are launched by a separate launcher service instead, so
+    that the Hub itself does not need the privileges to create processes as other users. With
+    `launcher_hosts` set, they are spread over launcher agents running on several hosts.
+
+    With `resource_sample_interval` set, the resource usage of each server is sampled from its
+    job object and kept in `resource_usage`, for culling and admin tooling. With
+    `idle_sample_count` set as well, servers using CPU or I/O have their activity reported to the
+    Hub, and quiet ones get an `idle_since` time, without any HTTP round-trip to the server.
     """
 
+    trim_idle_working_set_after = Integer(
+        0,
+        help="""
+        Seconds a server must have been idle before the working sets of its processes are trimmed.
+
+        Trimming hands the resident memory of idle servers and kernels back to the OS, which only
+        pages it out if active servers need the memory. 0 disables trimming.
+        """,
+    ).tag(config=True)
+
+    trim_interval = Integer(
+        300,
+        help="""
+        Seconds between two passes checking all running servers for idleness and trimming them.
+        """,
+    ).tag(config=True)
+
+    trim_min_working_set = ByteSpecification(
+        "64M",
+        help="""
+        Only trim idle servers whose processes together use at least this much working set.
+
+        Allows the suffixes K, M, G and T.
+        """,
+    ).tag(config=True)
+
+    suspend_idle_after = Integer(
+        0,
+        help="""
+        Seconds a server must have been idle before all of its processes are suspended.
+
+        A suspended server is reported to the Hub as stopped, so the user's next request to it
+        goes through the Hub, and the spawn resumes the frozen processes instead of starting a
+        new server. Its memory is left to the OS to page out. 0 disables suspension.
+        """,
+    ).tag(config=True)
+
+    suspend_check_interval = Integer(
+        60,
+        help="""
+        Seconds between two passes checking all running servers for idleness and suspending them.
+        """,
+    ).tag(config=True)
+
+    suspended_timeout = Integer(
+        0,
+        help="""
+        Seconds a server may stay suspended before its processes are terminated.
+
+        0 keeps suspended servers until they are resumed.
+        """,
+    ).tag(config=True)
+
+    resource_sample_interval = Integer(
+        0,
+        help="""
+        Seconds between two samples of the resource usage of all running servers.
+
+        A single background task asks the job object of each server for the CPU time, memory,
+        I/O and number of processes used by all of its processes. The results are exported as
+        metrics labelled by user and server, and kept in the spawner's `resource_usage`.
+        0 disables sampling.
+        """,
+    ).tag(config=True)
+
+    idle_sample_count = Integer(
+        0,
+        help="""
+        Consecutive resource samples below all idle thresholds after which a server is idle.
+
+        Requires `resource_sample_interval`. A sample above any threshold is reported to the Hub
+        as activity on the server, like the activity reports of the server itself, and idle
+        servers get an `idle_since` time. 0 disables idle detection.
+        """,
+    ).tag(config=True)
+
+    idle_max_cpu_percent = Float(
+        2,
+        help="""
+        CPU usage, in percent of one core, below which a resource sample counts as idle.
+        """,
+    ).tag(config=True)
+
+    idle_max_io_rate = ByteSpecification(
+        "64K",
+        help="""
+        Bytes per second read, written or transferred otherwise below which a resource sample
+        counts as idle.
+
+        Allows the suffixes K, M, G and T.
+        """,
+    ).tag(config=True)
+
+    idle_max_processes = Integer(
+        0,
+        help="""
+        Number of processes in a server at or below which a resource sample counts as idle, e.g.
+        1 to only consider servers without running kernels idle. 0 disables this threshold.
+        """,
+    ).tag(config=True)
+
+    user_spawn_rate_limit = Float(
+        0,
+        help="""
+        Servers each user may start per minute, on average. 0 disables the limit.
+
+        Bursts of up to `user_spawn_burst` launches are allowed.
+        """,
+    ).tag(config=True)
+
+    user_spawn_burst = Integer(
+        3, help="Launches each user may make in a burst, before user_spawn_rate_limit applies."
+    ).tag(config=True)
+
+    group_spawn_rate_limit = Float(
+        0,
+        help="""
+        Servers the members of each group may start per minute altogether, on average.
+        0 disables the limit.
+
+        Bursts of up to `group_spawn_burst` launches are allowed.
+        """,
+    ).tag(config=True)
+
+    group_spawn_burst = Integer(
+        10, help="Launches each group may make in a burst, before group_spawn_rate_limit applies."
+    ).tag(config=True)
+
+    global_spawn_rate_limit = Float(
+        0,
+        help="""
+        Servers all users may start per minute altogether, on average. 0 disables the limit.
+
+        Bursts of up to `global_spawn_burst` launches are allowed.
+        """,
+    ).tag(config=True)
+
+    global_spawn_burst = Integer(
+        30, help="Launches that may be made in a burst, before global_spawn_rate_limit applies."
+    ).tag(config=True)
+
+    spawn_rate_limit_max_wait = Float(
+        0,
+        help="""
+        Seconds a launch exceeding the spawn rate limits may wait for them to allow it.
+
+        Launches that would have to wait longer are rejected with a 429 error and a Retry-After
+        header. Waiting counts towards `start_timeout`.
+        """,
+    ).tag(config=True)
+
+    crash_loop_early_exit = Float(
+        30,
+        help="""
+        A server exiting with an error less than this many seconds after it was started counts
+        as an early exit. 0 disables the crash loop backoff.
+
+        After an early exit, the next launch of the server is rejected with a 503 error and a
+        Retry-After header until a backoff delay has passed. The delay starts at
+        `crash_loop_backoff_base` and doubles with every consecutive early exit, up to
+        `crash_loop_backoff_max`. It is reset once a launch stays up.
+        """,
+    ).tag(config=True)
+
+    crash_loop_backoff_base = Float(
+        10, help="Seconds to wait before relaunching a server after its first early exit."
+    ).tag(config=True)
+
+    crash_loop_backoff_max = Float(
+        600, help="Maximum seconds to wait before relaunching a server after an early exit."
+    ).tag(config=True)
+
+    auth_state_cache_size = Integer(
+        1024,
+        help="""
+        Number of users whose decrypted auth_token is kept in memory between spawns.
+
+        Spawns use the auth_state JupyterHub decrypted for its auth_state_hook. The cache is only
+        used when JupyterHub did not run the hook before start(). An entry is decrypted again
+        whenever the Authenticator stores a new auth_state for the user, e.g. at login. 0 disables
+        the cache.
+        """,
+    ).tag(config=True)
+
+    host_min_available_memory = ByteSpecification(
+        0,
+        help="""
+        Physical memory that must be available on the host for a new server to be launched.
+
+        Allows the suffixes K, M, G and T. 0 disables this threshold.
+        """,
+    ).tag(config=True)
+
+    host_max_commit_percent = Float(
+        0,
+        help="""
+        Percentage of the host's commit limit above which no new server is launched, e.g. 90.
+
+        Servers launched close to the commit limit make the whole host page heavily, or fail to
+        allocate memory. 0 disables this threshold.
+        """,
+    ).tag(config=True)
+
+    host_max_cpu_percent = Float(
+        0,
+        help="""
+        CPU usage of all cores of the host, in percent, above which no new server is launched.
+
+        0 disables this threshold.
+        """,
+    ).tag(config=True)
+
+    host_pressure_action = Enum(
+        ["queue", "reject"],
+        "queue",
+        help="""
+        What to do with a launch while the host is over one of the host pressure thresholds.
+
+        - "queue": wait up to `host_pressure_max_wait` seconds for the pressure to go down.
+        - "reject": reject the launch right away with a 503 error.
+
+        With `launcher_hosts`, each agent reports the pressure on its host, and launches are
+        redirected to the hosts under the thresholds. The action only applies when none is.
+        """,
+    ).tag(config=True)
+
+    host_pressure_max_wait = Integer(
+        60,
+        help="""
+        Seconds a launch queued by host pressure may wait, before it is rejected with a 503 error.
+        """,
+    ).tag(config=True)
+
+    spawn_journal_size = Integer(
+        1000,
+        help="""
+        Number of spawn, stop and exit events kept in memory in the spawn journal.
+
+        The journal and its statistics are served to admins by
+        `winlocalprocessspawner.handlers.SpawnJournalAPIHandler`.
+        """,
+    ).tag(config=True)
+
+    load_user_profile = Bool(
+        True,
+        help="""
+        Load the profile of users with LoadUserProfile before starting their servers.
+
+        A profile is loaded once, shared by all running servers of its user, and unloaded
+        `profile_unload_grace` seconds after the last of them stopped, so that starting a server
+        again soon after skips loading the profile. Requires the Hub to hold the SeBackupPrivilege
+        and SeRestorePrivilege privileges; if the profile cannot be loaded, only its environment
+        block is built, as with False.
+        """,
+    ).tag(config=True)
+
+    profile_unload_grace = Integer(
+        300,
+        help="""
+        Seconds a user profile stays loaded after the last server of its user stopped.
+        """,
+    ).tag(config=True)
+
+    dedicated_desktops = Bool(
+        False,
+        help="""
+        Start the servers in desktops of a window station of their own, instead of the desktop
+        of the Hub.
+
+        The processes of a desktop share its heap, which runs out past a few hundred servers:
+        servers then fail to start, or crash. The dedicated desktops are shared by at most
+        `desktop_max_servers` servers each, with a heap of `desktop_heap_size`. They are created
+        as needed, and closed once their servers stopped. Not available through a launcher.
+        """,
+    ).tag(config=True)
+
+    desktop_heap_size = Integer(
+        4096,
+        help="""
+        Size of the heap of each dedicated desktop, in KB. See `dedicated_desktops`.
+
+        The heaps of all desktops are allocated from the desktop heap of the session, whose
+        size is set by the SharedSection value of the Windows subsystem in the registry.
+        """,
+    ).tag(config=True)
+
+    desktop_max_servers = Integer(
+        100,
+        help="""
+        Number of servers started in each dedicated desktop. See `dedicated_desktops`.
+        """,
+    ).tag(config=True)
+
+    bytecode_cache_dir = Unicode(
+        "",
+        help="""
+        Directory of a bytecode cache shared by all servers, given to them as PYTHONPYCACHEPREFIX.
+
+        The Hub compiles the modules of `bytecode_cache_python` into it with compileall, so that
+        the first start of each user's server loads bytecode instead of compiling it, and
+        compiles them again when packages are installed, upgraded or removed. The Hub creates
+        the directory readable by users and writable by the Hub only. An existing directory
+        keeps its permissions: users must not be able to write to it.
+
+        The servers only use the cache once the directory exists. With `launcher_hosts`, it
+        must be reachable at the same path from every host. Empty disables the cache.
+        """,
+    ).tag(config=True)
+
+    bytecode_cache_python = Unicode(
+        help="""
+        Python interpreter of the servers' environment, compiling the `bytecode_cache_dir`.
+
+        Defaults to the Hub's interpreter.
+        """,
+    ).tag(config=True)
+
+    @default("bytecode_cache_python")
+    def _default_bytecode_cache_python(self):
+        return sys.executable
+
+    bytecode_cache_check_interval = Integer(
+        300,
+        help="""
+        Minimum seconds between two checks of whether `bytecode_cache_dir` is out of date.
+
+        The cache is checked when the Hub polls or starts a server, in the background.
+        """,
+    ).tag(config=True)
+
+    create_process_retries = Integer(
+        3,
+        help="""
+        Number of times the creation of a server's process is retried after a transient error.
+
+        Errors caused by the load on the host, such as running out of memory, quotas or handles,
+        or by files locked for a moment, such as a profile hive, are retried after a random delay
+        of up to `create_process_retry_delay` seconds, doubling with every retry. Other errors,
+        such as access denied or a missing executable, fail the launch right away.
+        """,
+    ).tag(config=True)
+
+    create_process_retry_delay = Float(
+        0.5,
+        help="""
+        Bound of the random delay before the first retry of a process creation, in seconds.
+        """,
+    ).tag(config=True)
+
+    start_stage_timeouts = Dict(
+        {"auth_state": 15, "profile": 30, "placement": 5},
+        help="""
+        Seconds each stage of start() may take before the launch is aborted.
+
+        The stages are "auth_state" (retrieving the Windows token from the auth_state) and
+        "profile" (loading the user's profile environment). Stages missing from the dict are
+        only bounded by `start_timeout`. Independent stages run concurrently.
+
+        With `launcher_hosts`, "placement" is the time given to the agents to report their load;
+        agents that do not answer in time are left out of the placement.
+        """,
+    ).tag(config=True)
+
+    launcher_address = Unicode(
+        "",
+        help="""
+        Address of the launcher service starting, polling and stopping servers on behalf of the
+        Hub: "pipe:<name>" for a named pipe, or "tcp:<host>:<port>" for a TCP socket.
+
+        The launcher, run with `winlocalprocessspawner-launcher`, holds the privileges needed to
+        call CreateProcessAsUser and load user profiles, so that the Hub does not have to run as
+        Local System. Empty launches servers from the Hub process itself.
+
+        Working set trimming and suspension of idle servers are not available through a
+        launcher.
+        """,
+    ).tag(config=True)
+
+    launcher_key = Unicode(
+        help="""
+        Key presented to the launcher service at `launcher_address`.
+
+        Defaults to the WINLOCALPROCESSSPAWNER_LAUNCHER_KEY environment variable.
+        """,
+    ).tag(config=True)
+
+    @default("launcher_key")
+    def _default_launcher_key(self):
+        return os.environ.get(KEY_ENV_VAR, "")
+
+    launcher_ssl_ca = Unicode(
+        "",
+        help="""
+        CA certificates to verify the certificates of the launchers serving TCP, in PEM format.
+
+        Connections to launchers at "tcp:" addresses use TLS when this or `launcher_ssl_cert`
+        is set. Empty verifies their certificates against the CAs of the system.
+        """,
+    ).tag(config=True)
+
+    launcher_ssl_cert = Unicode(
+        "",
+        help="""
+        Certificate presented to the launchers serving TCP that require client certificates.
+        """,
+    ).tag(config=True)
+
+    launcher_ssl_key = Unicode(
+        "",
+        help="""
+        Private key of `launcher_ssl_cert`, if it is not in the same file.
+        """,
+    ).tag(config=True)
+
+    launcher_hosts = Dict(
+        help="""
+        Launcher agents to spread servers over, instead of the single `launcher_address`.
+
+        Maps the address of each agent, "tcp:<host>:<port>", to a dict of options:
+
+        - "ip": the IP the servers it launches listen on, reachable from the proxy. Defaults to
+          the host of the address.
+        - "weight": the share of servers it gets, relative to the other hosts (default 1).
+          0 drains the host: it gets no new servers.
+        - "max_servers": the number of servers above which it gets no new ones (default: no
+          limit).
+
+        Agents are `winlocalprocessspawner-launcher` services presenting the same
+        `launcher_key`, and given a `--token-provider` that logs users on to their host. The Hub
+        API must be reachable from the agents' hosts, see `JupyterHub.hub_connect_ip`.
+        """,
+    ).tag(config=True)
+
+    launcher_placement = Enum(
+        placement.POLICIES,
+        default_value="least_loaded",
+        help="""
+        How to choose the host of a new server among `launcher_hosts`:
+
+        - "least_loaded": the host running the fewest servers, relative to its weight.
+        - "sticky": the same host for all servers of a user, as long as it is available.
+        - "weighted": a random host, with a probability proportional to its weight.
+        """,
+    ).tag(config=True)
+
+    _launcher_address = None
+    # IP of the launcher agent's host the server listens on, see launcher_hosts
+    _agent_ip = None
+    _job = None
+    _job_id = None
+    _started_at = None
+    _suspended_since = None
+    _resume_api_token = None
+    # (auth_state,) passed by JupyterHub to run_auth_state_hook for the next start
+    _hook_auth_state = None
+
+    # The latest resource usage sample of the server, see resource_sample_interval
+    resource_usage = None
+    # When the server became idle according to its resource samples, see idle_sample_count
+    idle_since = None
+    _idle_samples = 0
+    _idle_start = None
+    _progress_events = ()
+    _stage_durations = None
+    _stopping = False
+    _progress_waiter = None
+    _queue_position = None
+
+    def load_state(self, state):
+        """Restore the pid and reopen the job object of a server started before a Hub restart."""
+        super().load_state(state)
+        self._launcher_address = state.get("launcher_address")
+        self._agent_ip = state.get("agent_ip")
+        if "suspended_since" in state:
+            # The API token of a server suspended before a Hub restart is lost, so start() will
+            # terminate it rather than resume it.
+            self._mark_suspended(state["suspended_since"])
+            self.port = state.get("port", 0)
+        job_id = state.get("job_id")
+        if job_id and self._launcher_address:
+            # the job belongs to the launcher, which reopens it if needed
+            self._job_id = job_id
+        elif job_id:
+            try:
+                self._job = job_utils.open_job(job_utils.job_name(job_id))
+                self._job_id = job_id
+            except pywintypes.error as exc:
+                self.log.warning("Failed to reopen job object for %s: %s", self._log_name, exc)
+            else:
+                self._start_monitoring()
+
+    def get_state(self):
+        """Save the pid and the id of the server's job object."""
+        state = super().get_state()
+        if self._job_id:
+            state["job_id"] = self._job_id
+        if self._launcher_address:
+            state["launcher_address"] = self._launcher_address
+        if self._agent_ip:
+            state["agent_ip"] = self._agent_ip
+        if self._suspended_since is not None:
+            state["suspended_since"] = self._suspended_since
+            state["port"] = self.port
+        early_exits = _crash_loops.early_exits(self._server_key)
+        if early_exits:
+            # Kept after the server stopped, so admins can see why it cannot be started
+            retry_after = _crash_loops.retry_after(
+                self._server_key, self.crash_loop_backoff_base, self.crash_loop_backoff_max
+            )
+            state["crash_loop"] = {
+                "early_exits": early_exits,
+                "backoff_until": time.time() + retry_after,
+            }
+        return state
+
+    def clear_state(self):
+        """Clear the stored state of the server and release its job object.
+
+        The state of a suspended server is kept, so that it can be resumed.
+        """
+        if self._suspended_since is not None:
+            return
+        if self._launcher_address and self.pid:
+            self._get_launcher().forget(self.pid)
+        super().clear_state()
+        self._launcher_address = None
+        self._agent_ip = None
+        self._stop_monitoring()
+        self._close_job()
+        self._release_profile()
+        _desktops.release(self._server_key)
+
+    def _save_state(self):
+        if self.orm_spawner is not None:
+            self.orm_spawner.state = self.get_state()
+            self.db.commit()
+
+    def _mark_suspended(self, since=None):
+        self._suspended_since = since or time.time()
+        self._resume_api_token = self.api_token if since is None else None
+        self.will_resume = True
+        metrics.SUSPENDED_SERVERS.inc()
+
+    def _clear_suspended(self):
+        self._suspended_since = None
+        self._resume_api_token = None
+        self.will_resume = False
+        metrics.SUSPENDED_SERVERS.dec()
+
+    async def _resume(self):
+        """Resume a suspended server. Returns its (ip, port), or None if it cannot be resumed."""
+        api_token = self._resume_api_token
+        if self._job is None or api_token is None:
+            self.log.info("Terminating suspended server %s: it cannot be resumed", self._log_name)
+            await self.stop(now=True)
+            self.clear_state()
+            return None
+
+        self._clear_suspended()
+
+        with metrics.SERVER_RESUME_DURATION_SECONDS.time():
+            await asyncio.get_event_loop().run_in_executor(None, job_utils.resume_job, self._job)
+        if await super().poll() is not None:
+            self.log.info("Suspended server %s exited before it could be resumed", self._log_name)
+            self.clear_state()
+            return None
+
+        self.log.info("Resumed suspended server %s", self._log_name)
+        # Let the Hub reuse the API token the server was started with
+        self.api_token = api_token
+        return (self.ip or "127.0.0.1", self.port)
+
+    def _create_job(self):
+        """Create the job object grouping all processes of the server about to be started."""
+        self._close_job()
+        job_id = uuid.uuid4().hex
+        try:
+            self._job = job_utils.create_job(job_utils.job_name(job_id))
+        except pywintypes.error as exc:
+            self.log.warning("Failed to create job object for %s: %s", self._log_name, exc)
+            return None
+        self._job_id = job_id
+        return self._job
+
+    def _close_job(self):
+        # Closing the handle does not affect the processes still assigned to the job
+        if self._job is not None:
+            self._job.Close()
+        self._job = None
+        self._job_id = None
+
+    def _start_monitoring(self):
+        if self._job is None:
+            return
+        if self.trim_idle_working_set_after > 0:
+            _trim_task.add(self, self.trim_interval)
+        if self.suspend_idle_after > 0:
+            _suspend_task.add(self, self.suspend_check_interval)
+        if self.resource_sample_interval > 0:
+            _sample_task.add(self, self.resource_sample_interval)
+
+    def _stop_monitoring(self):
+        _trim_task.discard(self)
+        _suspend_task.discard(self)
+        _sample_task.discard(self)
+        self._clear_resource_usage()
+
+    def _record_resource_usage(self, usage, sampled_at):
+        """Keep a sample from job_utils.get_job_accounting and export it as metrics.
+
+        Returns whether the sample shows activity that should be reported to the Hub.
+        """
+        previous = self.resource_usage
+        cpu_percent = None
+        active = False
+        if previous is not None and sampled_at > previous["sampled_at"]:
+            elapsed = sampled_at - previous["sampled_at"]
+            cpu_percent = 100 * (usage["cpu_seconds"] - previous["cpu_seconds"]) / elapsed
+            if self.idle_sample_count > 0:
+                io_bytes = sum(
+                    usage[key] - previous[key]
+                    for key in ("io_read_bytes", "io_write_bytes", "io_other_bytes")
+                )
+                active = not self._update_idle(
+                    cpu_percent, io_bytes / elapsed, usage["active_processes"], previous
+                )
+        self.resource_usage = dict(usage, cpu_percent=cpu_percent, sampled_at=sampled_at)
+
+        labels = (self.user.name, self.name)
+        metrics.SERVER_CPU_SECONDS.labels(*labels).set(usage["cpu_seconds"])
+        metrics.SERVER_PEAK_MEMORY_BYTES.labels(*labels).set(usage["peak_memory_bytes"])
+        if usage["memory_bytes"] is not None:
+            metrics.SERVER_MEMORY_BYTES.labels(*labels).set(usage["memory_bytes"])
+        for operation in ("read", "write", "other"):
+            metrics.SERVER_IO_BYTES.labels(*labels, operation).set(
+                usage["io_{}_bytes".format(operation)]
+            )
+        metrics.SERVER_PROCESSES.labels(*labels).set(usage["active_processes"])
+        return active
+
+    def _update_idle(self, cpu_percent, io_rate, processes, previous):
+        """Count a sample towards idleness. Returns whether it is below all idle thresholds."""
+        idle = (
+            cpu_percent <= self.idle_max_cpu_percent
+            and io_rate <= self.idle_max_io_rate
+            and not (self.idle_max_processes and processes > self.idle_max_processes)
+        )
+        if not idle:
+            self._idle_samples = 0
+            self.idle_since = None
+            return False
+        if self._idle_samples == 0:
+            # idle since the start of the first quiet interval
+            self._idle_start = previous["sampled_at"]
+        self._idle_samples += 1
+        if self._idle_samples >= self.idle_sample_count:
+            self.idle_since = self._idle_start
+        return True
+
+    def is_idle(self, threshold=0):
+        """Whether the resource samples showed the server idle for at least threshold seconds.
+
+        Needs no request to the server, so it can be called for every server by a culler
+        running in the Hub.
+        """
+        return self.idle_since is not None and time.time() - self.idle_since >= threshold
+
+    def _report_activity(self, now):
+        """Record activity on the server, as the Hub does for activity reports from servers."""
+        if self.orm_spawner is not None:
+            last_activity = self.orm_spawner.last_activity
+            if last_activity is None or now > last_activity:
+                self.orm_spawner.last_activity = now
+        last_activity = getattr(self.user, "last_activity", None)
+        if last_activity is None or now > last_activity:
+            self.user.last_activity = now
+
+    def _clear_resource_usage(self):
+        self.idle_since = None
+        self._idle_samples = 0
+        if self.resource_usage is None:
+            return
+        self.resource_usage = None
+        labels = (self.user.name, self.name)
+        series = [
+            (gauge, labels)
+            for gauge in (
+                metrics.SERVER_CPU_SECONDS,
+                metrics.SERVER_MEMORY_BYTES,
+                metrics.SERVER_PEAK_MEMORY_BYTES,
+                metrics.SERVER_PROCESSES,
+            )
+        ]
+        series += [
+            (metrics.SERVER_IO_BYTES, labels + (operation,))
+            for operation in ("read", "write", "other")
+        ]
+        for gauge, series_labels in series:
+            try:
+                gauge.remove(*series_labels)
+            except KeyError:
+                pass
+
+    def _get_launcher(self, address=None):
+        """Return the client of the launcher at address, by default the one of this server."""
+        address = address or self._launcher_address
+        launcher = _launchers.get(address)
+        if launcher is None:
+            launcher = _launchers[address] = LauncherClient(
+                address, self.launcher_key, self._launcher_ssl_context(address)
+            )
+        return launcher
+
+    def _launcher_ssl_context(self, address):
+        """Returns the SSLContext of the connections to the launcher at address, or None."""
+        if parse_address(address)[0] != "tcp":
+            return None
+        if not (self.launcher_ssl_ca or self.launcher_ssl_cert):
+            if not is_loopback_address(address):
+                self.log.warning(
+                    "Connecting to launcher %s without TLS, see launcher_ssl_ca", address
+                )
+            return None
+        return client_ssl_context(
+            self.launcher_ssl_ca or None,
+            self.launcher_ssl_cert or None,
+            self.launcher_ssl_key or None,
+        )
+
+    def _on_launcher_exit(self, exit_code):
+        # Let the Hub know right away, instead of at its next poll
+        asyncio.ensure_future(self.poll_and_notify())
+
+    @staticmethod
+    def clear_auth_state_cache(username=None):
+        """Forget the cached auth_token of a user, or of all users if username is None.
+
+        Authenticators invalidating a user's token without storing a new auth_state (e.g. closing
+        it at logout) should call this.
+        """
+        _auth_state_cache.invalidate(username)
+
+    async def run_auth_state_hook(self, auth_state):
+        """Keep the auth_state JupyterHub decrypted for this spawn, and run auth_state_hook."""
+        self._hook_auth_state = (_auth_state_cache.select(auth_state),)
+        await super().run_auth_state_hook(auth_state)
+
+    async def _get_auth_state(self):
+        hook_auth_state, self._hook_auth_state = self._hook_auth_state, None
+        if hook_auth_state is not None:
+            return hook_auth_state[0]
+        _auth_state_cache.maxsize = self.auth_state_cache_size
+        return await _auth_state_cache.get(self.user)
+
+    @property
+    def _server_key(self):
+        """Identifies the server across spawner instances: (user name, server name)."""
+        return (self.user.name, self.name)
+
+    def _track_early_exit(self, status):
+        """Record an early exit of the server, or forget earlier ones once it stayed up."""
+        if self._started_at is None or not self.crash_loop_early_exit:
+            return
+        uptime = time.monotonic() - self._started_at
+        if status is None and uptime < self.crash_loop_early_exit:
+            return
+
+        self._started_at = None
+        if status and uptime < self.crash_loop_early_exit:
+            _crash_loops.record_early_exit(self._server_key)
+            self.log.warning(
+                "Server %s exited with status %s %.1f seconds after it was started "
+                "(%i early exits in a row)",
+                self._log_name,
+                status,
+                uptime,
+                _crash_loops.early_exits(self._server_key),
+            )
+            metrics.CRASH_LOOP_EARLY_EXITS.inc()
+        elif _crash_loops.early_exits(self._server_key):
+            self.log.info("Server %s stayed up, resetting its crash loop backoff", self._log_name)
+            _crash_loops.reset(self._server_key)
+        metrics.CRASH_LOOP_SERVERS.set(len(_crash_loops))
+
+    def _idle_seconds(self, now):
+        """Seconds since the Hub last recorded activity on this server, or 0 if unknown."""
+        last_activity = self.orm_spawner.last_activity if self.orm_spawner else None
+        if last_activity is None:
+            return 0
+        return (now - last_activity).total_seconds()
+
     def user_env(self, env):
         """Augment environment of spawned process with user specific env variables."""
         env["USER"] = self.user.name
@@ -34,8 +1051,34 @@ class WinLocalProcessSpawner(LocalProcessSpawner):
         for key in win_env_keep:
             if key in os.environ:
                 env[key] = os.environ[key]
+        if self.bytecode_cache_dir and os.path.isdir(self.bytecode_cache_dir):
+            env["PYTHONPYCACHEPREFIX"] = self.bytecode_cache_dir
         return env
 
+    def _refresh_bytecode_cache(self):
+        """Recompile the bytecode cache in the background if it may be out of date."""
+        cache_dir, python = self.bytecode_cache_dir, self.bytecode_cache_python
+        _bytecode_cache.check_interval = self.bytecode_cache_check_interval
+        if not cache_dir or not _bytecode_cache.due(cache_dir, python):
+            return None
+
+        def refresh():
+            started = time.perf_counter()
+            if _bytecode_cache.refresh(cache_dir, python):
+                metrics.BYTECODE_CACHE_COMPILE_DURATION_SECONDS.observe(
+                    time.perf_counter() - started
+                )
+
+        def log_error(future):
+            if not future.cancelled() and future.exception() is not None:
+                self.log.error(
+                    "Failed to refresh the bytecode cache %s: %s", cache_dir, future.exception()
+                )
+
+        future = asyncio.get_event_loop().run_in_executor(None, refresh)
+        future.add_done_callback(log_error)
+        return future
+
     def _apply_user_env_overrides(self, env, profile_env, token):
         """Merge the Windows user profile environment into the spawner-built env.
 
@@ -46,7 +1089,8 @@ class WinLocalProcessSpawner(LocalProcessSpawner):
         :param env: The spawner-built environment dict from get_env(). Modified in place.
         :param profile_env: The Windows user profile env from CreateEnvironmentBlock, or None on
             failure.
-        :param token: The Windows auth token, or None.
+        :param token: The Windows auth token, or None. When a launcher holds the token, True if
+            there is one.
         """
         if token and profile_env:
             # Merge the Windows profile block into the spawner env.
@@ -61,91 +1105,655 @@ class WinLocalProcessSpawner(LocalProcessSpawner):
             # Fall back to the PUBLIC directory, which is always writable.
             env["USERPROFILE"] = profile_env.get("PUBLIC", env.get("PUBLIC", ""))
 
-    async def start(self):
-        """Start the single-user server."""
-        self.port = random_port()
-        cmd = []
-        env = self.get_env()
-        token = None
+    async def poll(self):
+        """Poll the spawned process to see if it is still running.
 
-        cmd.extend(self.cmd)
+        A suspended server is reported as stopped, with exit code 0.
+        """
+        self._refresh_bytecode_cache()
+        if self._suspended_since is not None:
+            return 0
+        pid = self.pid
+        if self._launcher_address and pid:
+            status = await self._poll_launcher()
+        else:
+            status = await super().poll()
+        self._track_early_exit(status)
+        if status is not None and pid and not self._stopping:
+            self._record_journal("exit", pid=pid, exit_code=status)
+        return status
 
-        cmd.extend(self.get_args())
+    async def _poll_launcher(self):
+        try:
+            status = await self._get_launcher().poll(self.pid, self._job_id)
+        except (ConnectionError, OSError) as exc:
+            # Without the launcher, the server cannot be checked: assume it is still running
+            self.log.warning("Failed to poll %s through the launcher: %s", self._log_name, exc)
+            return None
+        if status is not None:
+            self.clear_state()
+        return status
 
-        if self.shell_cmd:
-            # using shell_cmd (e.g. bash -c),
-            # add our cmd list as the last (single) argument:
-            cmd = self.shell_cmd + [" ".join(pipes.quote(s) for s in cmd)]
+    async def stop(self, now=False):
+        """Stop the single-user server, terminating it right away if it is suspended."""
+        pid = self.pid
+        # Exits caused by stopping the server are journaled as stops
+        self._stopping = True
+        try:
+            await self._stop(now)
+        finally:
+            self._stopping = False
+        self._record_journal("stop", pid=pid or None)
 
-        self.log.info("Spawning %s", " ".join(pipes.quote(s) for s in cmd))
+    async def _stop(self, now):
+        # Exits caused by stopping the server are not early exits
+        self._started_at = None
+        if self._suspended_since is not None:
+            self._clear_suspended()
+            if self._job is not None:
+                job_utils.terminate_job(self._job)
+                return
+        if self._launcher_address and self.pid:
+            await self._get_launcher().stop(self.pid, self._job_id)
+            await self.poll()
+            return
+        await super().stop(now=now)
 
-        auth_state = await self.user.get_auth_state()
-        if auth_state:
-            token = auth_state.get("auth_token")
-            if token:
-                token = pywintypes.HANDLE(token)
+    async def _acquire_spawn_rate_limits(self):
+        """Wait until the spawn rate limits allow a launch, or reject it with a 429 error."""
+        limits = [("user", self.user.name, self.user_spawn_rate_limit / 60, self.user_spawn_burst)]
+        limits.extend(
+            ("group", group.name, self.group_spawn_rate_limit / 60, self.group_spawn_burst)
+            for group in getattr(self.user, "groups", [])
+        )
+        limits.append(("global", "", self.global_spawn_rate_limit / 60, self.global_spawn_burst))
+
+        deadline = time.monotonic() + self.spawn_rate_limit_max_wait
+        deferred = False
+        while True:
+            throttled = _spawn_rate_limiter.acquire(limits)
+            if throttled is None:
+                return
+            scope, retry_after = throttled
+            if time.monotonic() + retry_after > deadline:
+                break
+            self._report_queued()
+            if not deferred:
+                self.log.info(
+                    "Deferring start of %s by %.1f seconds: %s spawn rate limit reached",
+                    self._log_name,
+                    retry_after,
+                    scope,
+                )
+                metrics.SPAWN_THROTTLED.labels(scope=scope, action="deferred").inc()
+                deferred = True
+            await asyncio.sleep(retry_after)
 
-        profile_env = None
-        cwd = None
+        self.log.warning(
+            "Rejecting start of %s: %s spawn rate limit reached", self._log_name, scope
+        )
+        metrics.SPAWN_THROTTLED.labels(scope=scope, action="rejected").inc()
+        self._reject_start(429, retry_after, "Too many servers started recently.")
+
+    def _host_pressure_reasons(self, pressure):
+        """Return the names of the host pressure thresholds crossed by a HostPressure."""
+        return hostpressure.exceeded(
+            pressure,
+            self.host_min_available_memory,
+            self.host_max_commit_percent,
+            self.host_max_cpu_percent,
+        )
 
+    async def _wait_for_host_capacity(self):
+        """Wait until the pressure on this host allows a launch, or reject it with a 503 error."""
+        if not (
+            self.host_min_available_memory
+            or self.host_max_commit_percent
+            or self.host_max_cpu_percent
+        ):
+            return
+        max_wait = self.host_pressure_max_wait if self.host_pressure_action == "queue" else 0
+        deadline = time.monotonic() + max_wait
+        queued = False
+        while True:
+            pressure = await asyncio.get_event_loop().run_in_executor(None, _host_pressure.sample)
+            _export_host_pressure("localhost", pressure)
+            reasons = self._host_pressure_reasons(pressure)
+            if not reasons:
+                return
+            if time.monotonic() + _HOST_PRESSURE_RETRY_INTERVAL > deadline:
+                break
+            self._report_queued()
+            if not queued:
+                self.log.info(
+                    "Queueing start of %s: host over its %s threshold",
+                    self._log_name,
+                    " and ".join(reasons),
+                )
+                metrics.HOST_PRESSURE_ADMISSIONS.labels(action="queued").inc()
+                queued = True
+            await asyncio.sleep(_HOST_PRESSURE_RETRY_INTERVAL)
+
+        self.log.warning(
+            "Rejecting start of %s: host over its %s threshold",
+            self._log_name,
+            " and ".join(reasons),
+        )
+        metrics.HOST_PRESSURE_ADMISSIONS.labels(action="rejected").inc()
+        self._reject_start(503, 30, "The server host is too busy to start your server.")
+
+    def _check_crash_loop_backoff(self):
+        """Reject the launch of a server that exited early, until its backoff delay has passed."""
+        retry_after = _crash_loops.retry_after(
+            self._server_key, self.crash_loop_backoff_base, self.crash_loop_backoff_max
+        )
+        if not retry_after:
+            return
+        self.log.warning(
+            "Rejecting start of %s: backing off after %i early exits in a row",
+            self._log_name,
+            _crash_loops.early_exits(self._server_key),
+        )
+        metrics.CRASH_LOOP_REJECTED.inc()
+        self._reject_start(503, retry_after, "Your server keeps exiting right after it starts.")
+
+    async def _run_stage(self, name, awaitable):
+        """Await one stage of start(), applying its timeout from start_stage_timeouts."""
+        timeout = self.start_stage_timeouts.get(name)
+        started = time.perf_counter()
         try:
-            # Load the Windows user profile environment for the authenticated token.
-            profile_env = win32profile.CreateEnvironmentBlock(token, False)
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                "Stage {} of the start of {} took longer than {} seconds".format(
+                    name, self._log_name, timeout
+                )
+            ) from None
+        finally:
+            self._record_stage_duration(name, time.perf_counter() - started)
+
+    def _duplicate_auth_token(self, auth_token):
+        """Return a handle to the auth_token owned by this launch, to be closed by the caller.
+
+        The auth_token handle is shared by every server of the user, and stays owned by the
+        Authenticator, so each launch works on its own duplicate. Launches of several named
+        servers of the same user can then run concurrently.
+        """
+        shared_token = pywintypes.HANDLE(auth_token)
+        try:
+            return token_utils.duplicate_token(shared_token)
+        finally:
+            shared_token.Detach()
+
+    def _load_profile_env(self, token):
+        """Load the Windows user profile environment for the token, or None on failure."""
+        if token and self.load_user_profile:
+            _user_profiles.grace = self.profile_unload_grace
+            try:
+                return _user_profiles.acquire(self.user.name, token, self._server_key)
+            except Exception as exc:
+                self.log.warning("Failed to load user profile of %s: %s", self.user.name, exc)
+        try:
+            return win32profile.CreateEnvironmentBlock(token, False)
         except Exception as exc:
             self.log.warning("Failed to load user environment for %s: %s", self.user.name, exc)
+            return None
+
+    def _release_profile(self):
+        """Release the user profile used by the server, unloading it after the grace period."""
+        if not _user_profiles.release(self.user.name, self._server_key):
+            return
+        loop = asyncio.get_event_loop()
+        loop.call_later(
+            self.profile_unload_grace,
+            lambda: loop.run_in_executor(None, _user_profiles.unload_expired),
+        )
+
+    def _close_launch_token(self, token, profile_stage, release_profile):
+        """Close the token of a launch, and release its user profile if the launch failed.
 
-        self._apply_user_env_overrides(env, profile_env, token)
+        A profile stage that timed out still runs in its thread, with the token, and may acquire
+        the profile once done: both are then released when the thread is done.
+        """
+
+        def release(_=None):
+            if token:
+                token.Close()
+            if release_profile:
+                self._release_profile()
+
+        if profile_stage is None or profile_stage.done():
+            release()
+        else:
+            profile_stage.add_done_callback(release)
+
+    def _acquire_desktop(self):
+        """Returns the dedicated desktop to start the server in, or None for the Hub's."""
+        if not self.dedicated_desktops:
+            return None
+        _desktops.heap_size = self.desktop_heap_size
+        _desktops.max_servers = self.desktop_max_servers
+        try:
+            return _desktops.acquire(self._server_key)
+        except (OSError, pywintypes.error) as exc:
+            self.log.warning("Failed to create a desktop for %s: %s", self._log_name, exc)
+            return None
 
+    def _get_cwd(self, env, profile_env, token):
+        """Choose the working directory of the server, creating a temporary one if needed."""
         # On Posix, the cwd is set to ~ before spawning the singleuser server (preexec_fn).
         # Windows Popen doesn't have preexec_fn support, so we need to set cwd directly.
         if self.notebook_dir:
-            cwd = os.getcwd()
-        elif env.get("APPDATA"):
+            return os.getcwd()
+        if env.get("APPDATA"):
             if token:
                 # Merge happened — USERPROFILE in env reflects any subclass overrides.
-                cwd = env.get("USERPROFILE", mkdtemp())
+                userprofile = env.get("USERPROFILE")
             else:
                 # Merge was skipped — read USERPROFILE directly from the profile block.
-                cwd = profile_env.get("USERPROFILE", mkdtemp()) if profile_env else mkdtemp()
-        else:
-            # Set CWD to a temp directory, since we failed to load the user profile
-            cwd = mkdtemp()
+                userprofile = profile_env.get("USERPROFILE") if profile_env else None
+            if userprofile is not None:
+                return userprofile
+        # Set CWD to a temp directory, since we failed to load the user profile
+        return mkdtemp()
+
+    def _reject_start(self, status_code, retry_after, reason):
+        """Raise an HTTP error asking the client to retry the launch after some seconds."""
+        retry_after = math.ceil(retry_after)
+        err = web.HTTPError(status_code, "{} Try again in {} seconds.".format(reason, retry_after))
+        # JupyterHub's write_error only sends the headers of the exception: the headers set on the
+        # handler are cleared before the error is written
+        err.headers = {"Retry-After": str(retry_after)}
+        raise err
+
+    async def start(self):
+        """Start the single-user server, or resume it if it is suspended.
+
+        Overlapping calls for the same server wait for the launch already in progress and share
+        its result, instead of launching a second server.
+        """
+        key = self._server_key
+        launch = _inflight_starts.get(key)
+        if launch is not None:
+            self.log.info("Start of %s already in progress, waiting for it", self._log_name)
+            metrics.START_COALESCED.inc()
+            return await asyncio.shield(launch)
+
+        self._progress_events = []
+        self._queue_position = None
+        self._stage_durations = {}
+        started = time.perf_counter()
+        launch = _inflight_starts[key] = asyncio.ensure_future(self._launch())
+        launch.add_done_callback(functools.partial(self._journal_spawn, started))
+        launch.add_done_callback(lambda _: _inflight_starts.pop(key, None))
+        launch.add_done_callback(lambda _: _queued_launches.pop(key, None))
+        # shielded, so that a cancelled caller does not cancel the launch the others wait for
+        return await asyncio.shield(launch)
+
+    async def progress(self):
+        """Yield the phases of the launch in progress as they happen.
+
+        Once the launch is done, wait for the server to listen on its port. The Hub then reports
+        the server ready, once it answers HTTP requests.
+        """
+        launch = _inflight_starts.get(self._server_key)
+        index = 0
+        while True:
+            for event in self._progress_events[index:]:
+                yield event
+            index = len(self._progress_events)
+            if launch is None or launch.done():
+                break
+            if self._progress_waiter is None:
+                self._progress_waiter = asyncio.get_event_loop().create_future()
+            await asyncio.wait([launch, self._progress_waiter], return_when=asyncio.FIRST_COMPLETED)
+        for event in self._progress_events[index:]:
+            yield event
 
-        popen_kwargs = dict(
-            token=token,
-            cwd=cwd,
+        if launch is None or launch.cancelled() or launch.exception() is not None:
+            return
+        ip, port = launch.result()
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(
+                    "127.0.0.1" if ip in ("", "0.0.0.0") else ip, port
+                )
+            except OSError:
+                await asyncio.sleep(_PORT_PROBE_INTERVAL)
+            else:
+                writer.close()
+                break
+        yield {"progress": 90, "message": "Server listening on port {}".format(port)}
+
+    def _emit_progress(self, progress, message):
+        """Record a phase of the launch for progress(), waking it up."""
+        self._progress_events = [
+            *self._progress_events,
+            {"progress": progress, "message": message},
+        ]
+        if self._progress_waiter is not None and not self._progress_waiter.done():
+            self._progress_waiter.set_result(None)
+        self._progress_waiter = None
+
+    def _report_queued(self):
+        """Add the launch to the queue of deferred launches, and report its position."""
+        _queued_launches.setdefault(self._server_key, None)
+        position = list(_queued_launches).index(self._server_key) + 1
+        if position != self._queue_position:
+            self._queue_position = position
+            self._emit_progress(
+                10, "Waiting to start your server: number {} in the queue".format(position)
+            )
+
+    def _record_journal(self, event, **fields):
+        spawn_journal.resize(self.spawn_journal_size)
+        spawn_journal.record(event, self.user.name, self.name, **fields)
+
+    def _journal_spawn(self, started, launch):
+        """Record the outcome of a launch in the spawn journal."""
+        durations = dict(self._stage_durations or {}, total=time.perf_counter() - started)
+        exc = None if launch.cancelled() else launch.exception()
+        if launch.cancelled() or exc is not None:
+            result = "rejected" if isinstance(exc, web.HTTPError) else "failed"
+        else:
+            result = "ok"
+        self._record_journal(
+            "spawn",
+            pid=self.pid or None,
+            result=result,
+            durations=durations,
+            error=win32_error(exc),
         )
 
-        popen_kwargs.update(self.popen_kwargs)
-        # don't let user config override env
-        popen_kwargs["env"] = env
+    def _record_stage_duration(self, name, seconds):
+        metrics.START_STAGE_DURATION_SECONDS.labels(stage=name).observe(seconds)
+        if self._stage_durations is not None:
+            self._stage_durations[name] = seconds
+
+    async def _launch(self):
+        self._refresh_bytecode_cache()
+        if self._suspended_since is not None:
+            self._emit_progress(50, "Resuming your suspended server")
+            resumed = await self._resume()
+            if resumed:
+                return resumed
+
+        admission_started = time.perf_counter()
+        self._check_crash_loop_backoff()
+        await self._acquire_spawn_rate_limits()
+        if not self.launcher_hosts:
+            await self._wait_for_host_capacity()
+        self._record_stage_duration("admission", time.perf_counter() - admission_started)
+
+        self.port = random_port()
+        self._agent_ip = None
+        if self.launcher_hosts or self.launcher_address:
+            await self._launch_with_launcher()
+            return self._server_address()
+
+        loop = asyncio.get_event_loop()
+
+        # Stages that depend on nothing else run concurrently with building the command line,
+        # which is built on the executor for that.
+        auth_state_stage = asyncio.ensure_future(
+            self._run_stage("auth_state", self._get_auth_state())
+        )
+        job_stage = loop.run_in_executor(None, self._create_job)
+        profile_stage = None
+        token = None
+        launched = False
         try:
-            self.proc = PopenAsUser(cmd, **popen_kwargs)
-        except PermissionError:
-            # use which to get abspath
-            script = shutil.which(cmd[0]) or cmd[0]
-            self.log.error(
-                "Permission denied trying to run %r. Does %s have access to this file?",
-                script,
-                self.user.name,
+            env = await loop.run_in_executor(None, self.get_env)
+            cmd = await loop.run_in_executor(None, self._get_cmd)
+
+            auth_state = await auth_state_stage
+            if auth_state and auth_state.get("auth_token"):
+                token = self._duplicate_auth_token(auth_state["auth_token"])
+                self._emit_progress(30, "Authentication token acquired")
+
+            profile_stage = loop.run_in_executor(None, self._load_profile_env, token)
+            # Shielded, so that profile_stage tells when a timed out stage is actually done
+            profile_env = await self._run_stage("profile", asyncio.shield(profile_stage))
+            if profile_env:
+                self._emit_progress(50, "User profile loaded")
+            job = await job_stage
+
+            self._apply_user_env_overrides(env, profile_env, token)
+            # may create a temporary directory
+            cwd = await loop.run_in_executor(None, self._get_cwd, env, profile_env, token)
+
+            popen_kwargs = dict(
+                token=token,
+                cwd=cwd,
+                job=job,
+                desktop=self._acquire_desktop(),
+                retries=self.create_process_retries,
+                retry_delay=self.create_process_retry_delay,
             )
-            if token:
-                token.Detach()
+
+            popen_kwargs.update(self.popen_kwargs)
+            # don't let user config override env
+            popen_kwargs["env"] = env
+            started = time.perf_counter()
+            try:
+                # CreateProcessAsUser and the early exit check of PopenAsUser block
+                self.proc = await loop.run_in_executor(
+                    None, functools.partial(PopenAsUser, cmd, **popen_kwargs)
+                )
+            except PermissionError:
+                self._log_permission_denied(cmd)
+                raise
+            finally:
+                self._record_stage_duration("process", time.perf_counter() - started)
+            launched = True
+        except BaseException:
+            auth_state_stage.cancel()
+            # the job object is created quickly, wait for it so that it is not leaked
+            await asyncio.wait([job_stage])
+            self._close_job()
+            _desktops.release(self._server_key)
             raise
+        finally:
+            # The process has its own handle to the token, and keeps the profile until it stops
+            self._close_launch_token(token, profile_stage, release_profile=not launched)
 
         self.pid = self.proc.pid
-        if token:
-            token.Detach()
+        self._started_at = time.monotonic()
+        self._emit_progress(70, "Server process started (pid {})".format(self.pid))
+
+        self._start_monitoring()
+        return self._server_address()
+
+    async def _launch_with_launcher(self):
+        """Launch the server through a launcher agent, or the launcher at launcher_address."""
+        token = None
+        if self.launcher_hosts:
+            host = await self._place_on_agent_host()
+            self._launcher_address = host.address
+            launcher = self._get_launcher()
+            # The server listens on the agent's host, on a port that is free there
+            self._agent_ip = host.ip
+            self.port = (await launcher.request("random_port"))["port"]
+            # Handles of the Hub are meaningless on another host: the agent logs the user on
+            token = {"user": self.user.name}
+        else:
+            self._launcher_address = self.launcher_address
+            launcher = self._get_launcher()
+
+        env = self.get_env()
+        cmd = self._get_cmd()
 
+        if token is None:
+            auth_state = await self._run_stage("auth_state", self._get_auth_state())
+            if auth_state and auth_state.get("auth_token"):
+                # The launcher duplicates the auth_token handle from the Hub process
+                token = {"pid": os.getpid(), "handle": int(auth_state["auth_token"])}
+                self._emit_progress(30, "Authentication token acquired")
+
+        try:
+            profile_env = await self._run_stage(
+                "profile", launcher.request("profile_env", token=token, username=self.user.name)
+            )
+        except LauncherError as exc:
+            self.log.warning("Failed to load user environment for %s: %s", self.user.name, exc)
+            profile_env = None
+        if profile_env:
+            self._emit_progress(50, "User profile loaded")
+
+        # The launcher holds the token: only tell the hooks whether there is one
+        self._apply_user_env_overrides(env, profile_env, token is not None)
+        if self.launcher_hosts:
+            # Paths of the Hub's host are meaningless on the agent's host: the agent chooses it
+            cwd = None
+        else:
+            cwd = self._get_cwd(env, profile_env, token is not None)
+
+        started = time.perf_counter()
+        try:
+            result = await launcher.request(
+                "launch",
+                cmd=cmd,
+                env=env,
+                cwd=cwd,
+                token=token,
+                popen_kwargs={
+                    "retries": self.create_process_retries,
+                    "retry_delay": self.create_process_retry_delay,
+                    **self.popen_kwargs,
+                },
+            )
+        except PermissionError:
+            self._log_permission_denied(cmd)
+            raise
+        finally:
+            self._record_stage_duration("process", time.perf_counter() - started)
+
+        self.pid = result["pid"]
+        self._job_id = result["job_id"]
+        self._started_at = time.monotonic()
+        launcher.on_exit(self.pid, self._on_launcher_exit)
+        self._emit_progress(70, "Server process started (pid {})".format(self.pid))
+
+    async def _place_on_agent_host(self):
+        """Choose the launcher agent of a new server, rejecting the launch if there is none.
+
+        Agents whose host is over a host pressure threshold are skipped. If that leaves no agent,
+        the launch is queued until one is under the thresholds, as set by host_pressure_action.
+        """
+        hosts = placement.agent_hosts(self.launcher_hosts)
+        max_wait = self.host_pressure_max_wait if self.host_pressure_action == "queue" else 0
+        deadline = time.monotonic() + max_wait
+        queued = False
+        while True:
+            loads, pressured = await self._query_agent_hosts(hosts)
+            host = placement.place(self.launcher_placement, hosts, loads, self.user.name)
+            if (
+                host is not None
+                or not pressured
+                or time.monotonic() + _HOST_PRESSURE_RETRY_INTERVAL > deadline
+            ):
+                break
+            self._report_queued()
+            if not queued:
+                self.log.info("Queueing start of %s: all agent hosts are busy", self._log_name)
+                metrics.HOST_PRESSURE_ADMISSIONS.labels(action="queued").inc()
+                queued = True
+            await asyncio.sleep(_HOST_PRESSURE_RETRY_INTERVAL)
+
+        if host is None:
+            self.log.warning("Rejecting start of %s: no launcher agent available", self._log_name)
+            if pressured:
+                metrics.HOST_PRESSURE_ADMISSIONS.labels(action="rejected").inc()
+            self._reject_start(503, 30, "No host is available to start your server.")
+        if pressured:
+            metrics.HOST_PRESSURE_ADMISSIONS.labels(action="redirected").inc()
+        self.log.info("Placing %s on launcher agent %s", self._log_name, host.address)
+        metrics.AGENT_PLACEMENTS.labels(host=host.address).inc()
+        return host
+
+    async def _query_agent_hosts(self, hosts):
+        """Ask all agents for their status.
+
+        Returns the {address: number of servers} of the agents available for a new server, and
+        the addresses of those skipped because their host is over a host pressure threshold.
+        """
+        requests = {
+            asyncio.ensure_future(self._get_launcher(host.address).request("status")): host
+            for host in hosts
+        }
+        started = time.perf_counter()
+        done, pending = await asyncio.wait(
+            requests, timeout=self.start_stage_timeouts.get("placement")
+        )
+        self._record_stage_duration("placement", time.perf_counter() - started)
+
+        loads = {}
+        pressured = []
+        for request, host in requests.items():
+            if request in pending:
+                request.cancel()
+                self.log.warning("Launcher agent %s did not report its load in time", host.address)
+            elif request.exception() is not None:
+                self.log.warning(
+                    "Launcher agent %s is unavailable: %s", host.address, request.exception()
+                )
+            else:
+                status = request.result()
+                reasons = []
+                if status.get("pressure"):
+                    pressure = hostpressure.HostPressure(**status["pressure"])
+                    _export_host_pressure(host.address, pressure)
+                    reasons = self._host_pressure_reasons(pressure)
+                if reasons:
+                    self.log.info(
+                        "Skipping launcher agent %s: host over its %s threshold",
+                        host.address,
+                        " and ".join(reasons),
+                    )
+                    pressured.append(host.address)
+                else:
+                    loads[host.address] = status["servers"]
+        return loads, pressured
+
+    def _get_cmd(self):
+        """Build the command line of the server, and log it."""
+        cmd = []
+        cmd.extend(self.cmd)
+
+        args = self.get_args()
+        if self._agent_ip:
+            # listen on the agent's host rather than on the configured ip
+            args = ["--ip=" + self._agent_ip] + [arg for arg in args if not arg.startswith("--ip=")]
+        cmd.extend(args)
+
+        if self.shell_cmd:
+            # using shell_cmd (e.g. bash -c),
+            # add our cmd list as the last (single) argument:
+            cmd = self.shell_cmd + [" ".join(pipes.quote(s) for s in cmd)]
+
+        self.log.info("Spawning %s", " ".join(pipes.quote(s) for s in cmd))
+        return cmd
+
+    def _log_permission_denied(self, cmd):
+        # use which to get abspath
+        script = shutil.which(cmd[0]) or cmd[0]
+        self.log.error(
+            "Permission denied trying to run %r. Does %s have access to this file?",
+            script,
+            self.user.name,
+        )
+
+    def _server_address(self):
+        """Return the (ip, port) of the server that was just started."""
         if self.__class__ is not LocalProcessSpawner:
             # subclasses may not pass through return value of super().start,
             # relying on deprecated 0.6 way of setting ip, port,
             # so keep a redundant copy here for now.
             # A deprecation warning will be shown if the subclass
             # does not return ip, port.
-            if self.ip:
-                self.server.ip = self.ip
+            if self._agent_ip or self.ip:
+                self.server.ip = self._agent_ip or self.ip
             self.server.port = self.port
             self.db.commit()
 
-        return (self.ip or "127.0.0.1", self.port)
+        return (self._agent_ip or self.ip or "127.0.0.1", self.port)